@@ -0,0 +1,159 @@
+"""Script to summarise the timing records of the miriad tasks across all days.
+
+The reduce scripts write a record of every miriad task they execute to
+`calibration_if*_tasks.jsonl` in each day folder. This collects the most recent
+run of each of those files and reports, for each stage, task and IF, the median
+and 95th percentile wall time and the throughput in MB of visibilities per
+second. A report can be saved and later used as the baseline of a regression
+check, i.e. after a miriad upgrade or a change to the flagging.
+"""
+import sys
+import math
+import glob
+import json
+import argparse
+import statistics
+
+from run_calibrations import find_days
+
+
+def load_records(days: list, all_runs: bool=False):
+    """Read the task records of each day
+
+    Arguments:
+        days {list} -- Day folders to read records from
+
+    Keyword Arguments:
+        all_runs {bool} -- Keep every run rather than only the latest of each
+                           file (default: {False})
+    """
+    records = []
+    for day in days:
+        for path in sorted(glob.glob(f"{day}/calibration_if*_tasks.jsonl")):
+            with open(path, 'r') as infile:
+                file_records = [json.loads(l) for l in infile if l.strip() != '']
+            if len(file_records) == 0:
+                continue
+            if not all_runs:
+                latest = max(r.get('run', '') for r in file_records)
+                file_records = [r for r in file_records if r.get('run', '') == latest]
+            records.extend(file_records)
+
+    return records
+
+
+def stage_kind(stage: str):
+    """Drop the IF and source from a stage name, i.e. `mosaic_a.5500` becomes `mosaic`
+
+    Arguments:
+        stage {str} -- Name of the stage
+    """
+    return stage.split('_')[0] if stage else 'none'
+
+
+def percentile(values: list, q: float):
+    """Nearest rank percentile of a list of values
+
+    Arguments:
+        values {list} -- Values to take the percentile of
+        q {float} -- Percentile between 0 and 100
+    """
+    values = sorted(values)
+    rank = max(0, min(len(values) - 1, math.ceil(q * len(values) / 100) - 1))
+
+    return values[rank]
+
+
+def summarise(records: list):
+    """Reduce the task records to statistics for each stage, task and IF
+
+    Arguments:
+        records {list} -- Task records
+
+    Returns:
+        dict -- Statistics keyed by `stage/task/freq`
+    """
+    groups = {}
+    for r in records:
+        key = f"{stage_kind(r.get('stage'))}/{r['task']}/{r.get('freq', '-')}"
+        groups.setdefault(key, []).append(r)
+
+    summary = {}
+    for key, group in sorted(groups.items()):
+        wall = [r['wall'] for r in group]
+        mb = sum(r.get('vis_bytes') or 0 for r in group) / 1e6
+        summary[key] = {'count': len(group),
+                        'total': sum(wall),
+                        'median': statistics.median(wall),
+                        'p95': percentile(wall, 95),
+                        'cpu': sum((r.get('cpu_user') or 0) + (r.get('cpu_sys') or 0) for r in group),
+                        'mb_per_s': mb / sum(wall) if sum(wall) > 0 else 0.,
+                        'failed': sum(1 for r in group if r.get('returncode', 0) != 0)}
+
+    return summary
+
+
+def report(summary: dict, baseline: dict=None, threshold: float=0.3):
+    """Print the statistics, comparing the median wall time against a baseline
+
+    Arguments:
+        summary {dict} -- Statistics from `summarise`
+
+    Keyword Arguments:
+        baseline {dict} -- Statistics of an earlier run to compare against (default: {None})
+        threshold {float} -- Fractional slow down that counts as a regression (default: {0.3})
+
+    Returns:
+        list -- Keys of the rows that have regressed
+    """
+    regressions = []
+    print(f"{'Stage/Task/IF':<32} {'N':>6} {'Total (s)':>10} {'Median':>8} {'p95':>8} "\
+          f"{'CPU (s)':>9} {'MB/s':>8} {'Fail':>5} {'vs base':>8}")
+    for key, s in summary.items():
+        change = ''
+        if baseline is not None and key in baseline and baseline[key]['median'] > 0:
+            ratio = s['median'] / baseline[key]['median'] - 1
+            change = f"{ratio:+.0%}"
+            if ratio > threshold:
+                regressions.append(key)
+                change += ' !'
+        print(f"{key:<32} {s['count']:>6} {s['total']:>10.1f} {s['median']:>8.2f} {s['p95']:>8.2f} "\
+              f"{s['cpu']:>9.1f} {s['mb_per_s']:>8.1f} {s['failed']:>5} {change:>8}")
+
+    if baseline is not None:
+        print(f"{len(regressions)} of {len(summary)} rows slower than the baseline by more "\
+              f"than {threshold:.0%}")
+
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark report of the reduction across days')
+    parser.add_argument('days', nargs='*', help='Day folders to include. Defaults to Data/201*')
+    parser.add_argument('--all-runs', action='store_true',
+                        help='Include every recorded run, not only the latest of each day and IF')
+    parser.add_argument('--save', help='Save the statistics to this JSON file, for use as a baseline')
+    parser.add_argument('--baseline', help='Statistics saved from an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.3,
+                        help='Fractional increase in median wall time reported as a regression')
+    args = parser.parse_args()
+
+    records = load_records(find_days(args.days), all_runs=args.all_runs)
+    if len(records) == 0:
+        print('No task records found')
+        sys.exit(1)
+
+    summary = summarise(records)
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as infile:
+            baseline = json.load(infile)
+
+    regressions = report(summary, baseline=baseline, threshold=args.threshold)
+
+    if args.save is not None:
+        with open(args.save, 'w') as out:
+            json.dump(summary, out, indent=1)
+
+    sys.exit(1 if len(regressions) > 0 else 0)
@@ -0,0 +1,169 @@
+"""Script to consolidate the pointings of every day into a single dataset per
+pointing with uvcat, in place of build_uvcat_files.sh.
+
+Run it from a folder alongside the days, i.e. `Data/uvcat_5500`:
+
+    python3 ../../build_uvcat_files.py 5500
+
+The per-day files of each pointing (`<day>/f<freq>_sources/<pointing>`, see
+`mir_utils.mv_srcs`) are taken from the catalogue (see `catalogue.py`), or
+found by globbing the days with `--glob`. The uvcat of each pointing is run
+side by side, with at most `--io` running at once as they are limited by disk
+rather than CPU. Each merge is checkpointed with the names, sizes and
+modification times of its inputs, so a rerun only merges pointings with new
+or changed days.
+"""
+import os
+import sys
+import glob
+import time
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import catalogue
+import mir_utils as mu
+from checkpoint import Checkpoints, digest, file_manifest
+
+logger = logging.getLogger()
+
+IO_SLOTS = 4
+
+
+def catalogue_pointings(freq: str):
+    """Per-day files of each pointing of an IF recorded in the catalogue
+
+    Arguments:
+        freq {str} -- Frequency of the IF
+
+    Returns:
+        dict -- Mapping of each pointing to the list of its per-day files
+    """
+    pointings = {}
+    for src in catalogue.sources(role='pointing', freq=freq):
+        if src['status'] == 'done':
+            pointings.setdefault(src['name'], []).append(src['path'])
+
+    return pointings
+
+
+def glob_pointings(freq: str, data: str='..'):
+    """Per-day files of each pointing of an IF, found by globbing the days
+
+    Arguments:
+        freq {str} -- Frequency of the IF
+
+    Keyword Arguments:
+        data {str} -- Folder holding the days (default: {'..'})
+
+    Returns:
+        dict -- Mapping of each pointing to the list of its per-day files
+    """
+    pointings = {}
+    for path in sorted(glob.glob(os.path.join(data, '201*', f"f{freq}_sources", '*'))):
+        pointings.setdefault(os.path.basename(path), []).append(path)
+
+    return pointings
+
+
+def read_pointing_list(path: str):
+    """Names of the pointings in a list such as `pointings_f5500.txt`, one path
+    per line ending with the pointing name
+    """
+    with open(path, 'r') as infile:
+        return set(os.path.basename(l.strip()) for l in infile if l.strip() != '')
+
+
+def uvcat(name: str, files: list, checkpoints: Checkpoints, revision: str):
+    """Merge the per-day files of a pointing, unless they have not changed since
+    the last merge
+
+    Arguments:
+        name {str} -- Pointing, and the name of the merged dataset
+        files {list} -- Per-day files of the pointing
+        checkpoints {Checkpoints} -- Record of earlier merges
+        revision {str} -- Revision of uvcat
+
+    Returns:
+        str -- `skipped`, `merged` or `failed`
+    """
+    stage = f"uvcat_{name}"
+    manifest = {'files': file_manifest(sorted(files)), 'miriad': {'uvcat': revision}}
+    stage_digest = digest(manifest)
+    if checkpoints.is_current(stage, stage_digest) and os.path.exists(name):
+        return 'skipped'
+
+    # uvcat will not overwrite an earlier merge
+    mu.rm_uv(name)
+    checkpoints.start(stage, stage_digest, manifest)
+    with mu.task_tags(stage=stage):
+        proc = mu.mir_run(f"uvcat vis={','.join(sorted(files))} out={name}", check=False)
+
+    if proc.returncode != 0:
+        logger.log(logging.WARNING, f"uvcat of {name} failed, removing the partial output")
+        mu.rm_uv(name)
+        return 'failed'
+
+    checkpoints.done(stage, files=len(files))
+
+    return 'merged'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Merge the per-day files of each pointing with uvcat')
+    parser.add_argument('freq', help='Frequency of the IF, i.e. 5500')
+    parser.add_argument('--io', type=int, default=IO_SLOTS,
+                        help=f'Number of uvcat tasks to run at once (default {IO_SLOTS})')
+    parser.add_argument('--glob', action='store_true',
+                        help='Find the files of each pointing by globbing the days rather than '\
+                             'from the catalogue')
+    parser.add_argument('--data', default='..', help="Folder holding the days when using --glob")
+    parser.add_argument('--pointings', help='Only merge the pointings named in this file, '\
+                                            'i.e. ../pointings_f5500.txt')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        format="%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s",
+        level=logging.INFO,
+        handlers=[
+            logging.FileHandler(f"uvcat_{args.freq}.log", mode='w'),
+            logging.StreamHandler()
+        ])
+    mu.set_task_log(f"uvcat_{args.freq}_tasks.jsonl", freq=args.freq)
+
+    pointings = glob_pointings(args.freq, args.data) if args.glob else catalogue_pointings(args.freq)
+    # Only the pointings themselves, not the calibrators or mosaics
+    pointings = {name: files for name, files in pointings.items() if '_' in name}
+    if args.pointings:
+        wanted = read_pointing_list(args.pointings)
+        pointings = {name: files for name, files in pointings.items() if name in wanted}
+
+    if len(pointings) == 0:
+        print(f"No pointings found at {args.freq}")
+        sys.exit(1)
+
+    checkpoints = Checkpoints()
+    revision = mu.miriad_revision('uvcat')
+
+    # Largest first so that the longest merges are not left until the end
+    order = sorted(pointings, key=lambda n: sum(mu.dataset_size(f) for f in pointings[n]),
+                   reverse=True)
+    logger.log(logging.INFO, f"Merging {len(order)} pointings at {args.freq}, {args.io} at a time")
+
+    start = time.time()
+    counts = {'skipped': 0, 'merged': 0, 'failed': 0}
+    with ThreadPoolExecutor(max_workers=args.io, thread_name_prefix='uvcat') as pool:
+        futures = {pool.submit(uvcat, name, pointings[name], checkpoints, revision): name
+                   for name in order}
+        for future in as_completed(futures):
+            try:
+                status = future.result()
+            except Exception as e:
+                logger.log(logging.WARNING, f"{futures[future]} could not be merged: {e}")
+                status = 'failed'
+            counts[status] += 1
+
+    logger.log(logging.INFO, f"{counts['merged']} merged, {counts['skipped']} unchanged, "\
+                             f"{counts['failed']} failed in {(time.time() - start)/60:.1f} minutes")
+
+    sys.exit(1 if counts['failed'] else 0)
@@ -0,0 +1,374 @@
+"""A catalogue of the GLASS observations across all days, kept in SQLite.
+
+The reduction records each day and IF as its stages finish: the primary and
+secondary calibrators, each mosaic and its pointings, where their files are,
+how large they are and how much of them is flagged. run_uvfmeas.py adds the
+flux density model fitted to the secondary of each day. Batch scripts query
+the catalogue rather than crawling `Data/201*`.
+
+The database is `Data/glass_catalogue.sqlite` next to the shared modules, or
+the file named by GLASS_CATALOGUE. Days reduced before the catalogue existed
+can be added from their checkpoint records:
+
+    python3 catalogue.py --import Data/2016-11-*
+    python3 catalogue.py --freq 5500
+    python3 catalogue.py --uvfmeas 2245-328
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from contextlib import contextmanager
+
+from checkpoint import Checkpoints, CHECKPOINT_DIR, file_manifest
+
+CATALOGUE = os.environ.get('GLASS_CATALOGUE',
+                           os.path.join(os.path.dirname(os.path.realpath(__file__)), 'Data',
+                                        'glass_catalogue.sqlite'))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS days (
+    day TEXT NOT NULL,
+    freq TEXT NOT NULL,
+    path TEXT,
+    primary_src TEXT,
+    secondary_src TEXT,
+    status TEXT,
+    updated REAL,
+    PRIMARY KEY (day, freq)
+);
+CREATE TABLE IF NOT EXISTS sources (
+    day TEXT NOT NULL,
+    freq TEXT NOT NULL,
+    name TEXT NOT NULL,
+    role TEXT,
+    mosaic TEXT,
+    path TEXT,
+    nbytes INTEGER,
+    flagged REAL,
+    status TEXT,
+    updated REAL,
+    PRIMARY KEY (day, freq, name)
+);
+CREATE INDEX IF NOT EXISTS sources_by_role ON sources (freq, role);
+CREATE TABLE IF NOT EXISTS uvfmeas (
+    day TEXT NOT NULL,
+    source TEXT NOT NULL,
+    flux REAL,
+    ref_freq REAL,
+    alpha REAL,
+    coeffs TEXT,
+    fmin REAL,
+    fmax REAL,
+    npoints INTEGER,
+    log TEXT,
+    updated REAL,
+    PRIMARY KEY (day, source)
+);
+"""
+
+# Bits used of each 32 bit integer of a miriad flags item, after its 4 byte header
+_FLAG_BITS = 31
+_ITEM_HDR_SIZE = 4
+
+
+@contextmanager
+def connect(path: str=None):
+    """Open the catalogue, creating it if needed, for the length of a `with`
+    block. Changes are committed when the block ends. Several reductions may
+    write at once, so writers wait for each other rather than failing.
+
+    Keyword Arguments:
+        path {str} -- Database file. `CATALOGUE` if not given (default: {None})
+    """
+    path = CATALOGUE if path is None else path
+    if os.path.dirname(path) != '':
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    db = sqlite3.connect(path, timeout=120)
+    try:
+        db.row_factory = sqlite3.Row
+        db.executescript(SCHEMA)
+        with db:
+            yield db
+    finally:
+        db.close()
+
+
+def flag_fraction(path: str):
+    """Fraction of the data of a miriad dataset that is flagged, counted from its
+    flags item. Padding bits of the final integer count as flagged, which is
+    negligible for any real dataset. None is returned if there is no flags item.
+
+    Arguments:
+        path {str} -- Miriad dataset
+    """
+    flags = os.path.join(path, 'flags')
+    if not os.path.exists(flags):
+        return None
+
+    good, total = 0, 0
+    with open(flags, 'rb') as infile:
+        infile.seek(_ITEM_HDR_SIZE)
+        while True:
+            chunk = infile.read(1 << 22)
+            if not chunk:
+                break
+            good += bin(int.from_bytes(chunk, 'big')).count('1')
+            total += len(chunk) // 4 * _FLAG_BITS
+
+    return 1 - good / total if total > 0 else None
+
+
+def _source(db, day: str, freq: str, name: str, role: str, path: str, mosaic: str=None,
+            status: str='done'):
+    nbytes = file_manifest([path])[0]['size']
+    exists = nbytes is not None
+    db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+               (day, freq, name, role, mosaic, os.path.abspath(path), nbytes,
+                flag_fraction(path) if exists else None, status if exists else 'missing',
+                time.time()))
+
+
+def record_day(day: str, freq: str, status: str, path: str=None, db_path: str=None):
+    """Record the status of a day and IF, i.e. `pending` once its files are in
+    place or `failed`
+
+    Arguments:
+        day {str} -- Name of the day
+        freq {str} -- Frequency of the IF
+        status {str} -- Status of the reduction
+
+    Keyword Arguments:
+        path {str} -- Folder of the day (default: {None})
+        db_path {str} -- Database file (default: {None})
+    """
+    with connect(db_path) as db:
+        db.execute("INSERT INTO days (day, freq, path, status, updated) VALUES (?, ?, ?, ?, ?) "\
+                   "ON CONFLICT (day, freq) DO UPDATE SET status=excluded.status, "\
+                   "path=coalesce(excluded.path, path), updated=excluded.updated",
+                   (day, str(freq), None if path is None else os.path.abspath(path), status,
+                    time.time()))
+
+
+def record_calibrators(day: str, freq: str, primary: str, secondary: str, mosaics: list=(),
+                       folder: str='uv_calibrators', db_path: str=None):
+    """Record the calibration of a day and IF once its calibrators are in place.
+    Paths are taken relative to the current directory, the folder of the day.
+
+    Arguments:
+        day {str} -- Name of the day
+        freq {str} -- Frequency of the IF
+        primary {str} -- Primary calibrator
+        secondary {str} -- Secondary calibrator
+
+    Keyword Arguments:
+        mosaics {list} -- Mosaics observed on the day (default: {()})
+        folder {str} -- Folder of the calibrators in the day (default: {'uv_calibrators'})
+        db_path {str} -- Database file (default: {None})
+    """
+    freq = str(freq)
+    with connect(db_path) as db:
+        db.execute("INSERT OR REPLACE INTO days VALUES (?, ?, ?, ?, ?, ?, ?)",
+                   (day, freq, os.getcwd(), primary, secondary, 'calibrated', time.time()))
+        _source(db, day, freq, primary, 'primary', os.path.join(folder, primary))
+        _source(db, day, freq, secondary, 'secondary', os.path.join(folder, secondary))
+        # A mosaic already recorded by `record_mosaic` is left as it is
+        for mosaic in mosaics:
+            if db.execute("SELECT 1 FROM sources WHERE day = ? AND freq = ? AND name = ?",
+                          (day, freq, mosaic)).fetchone() is None:
+                _source(db, day, freq, mosaic, 'mosaic', os.path.join('uv_mosaic', mosaic),
+                        status='pending')
+
+
+def record_mosaic(day: str, freq: str, mosaic: str, pointings: list, split: bool=True,
+                  db_path: str=None):
+    """Record a mosaic and its pointings once they are in place
+
+    Arguments:
+        day {str} -- Name of the day
+        freq {str} -- Frequency of the IF
+        mosaic {str} -- Mosaic file
+        pointings {list} -- Pointings split from the mosaic
+
+    Keyword Arguments:
+        split {bool} -- Whether the pointings were split from a mosaic file. If
+                        not, only the pointings are recorded (default: {True})
+        db_path {str} -- Database file (default: {None})
+    """
+    freq = str(freq)
+    with connect(db_path) as db:
+        if split:
+            _source(db, day, freq, mosaic, 'mosaic', os.path.join('uv_mosaic', mosaic))
+        for src in pointings:
+            _source(db, day, freq, src, 'pointing', os.path.join(f"f{freq}_sources", src),
+                    mosaic=mosaic)
+
+
+def import_day(day_path: str, db_path: str=None):
+    """Add a day reduced before the catalogue existed, from its checkpoint records
+
+    Arguments:
+        day_path {str} -- Folder of the day
+
+    Keyword Arguments:
+        db_path {str} -- Database file (default: {None})
+
+    Returns:
+        int -- Number of stages found
+    """
+    day = os.path.basename(os.path.normpath(day_path))
+    cwd = os.getcwd()
+    os.chdir(day_path)
+    checkpoints = Checkpoints(CHECKPOINT_DIR)
+    try:
+        stages = checkpoints.stages()
+        for stage in stages:
+            record = checkpoints.load(stage)
+            result = record['result']
+            if stage.startswith('calibrate_') and 'primary' in result:
+                freq = stage.split('_', 1)[1]
+                # Mosaics split by the first uvsplit have no file of their own
+                mosaics = [] if result.get('mosaic_pointings') else result.get('mosaics', [])
+                record_calibrators(day, freq, result['primary'], result['secondary'],
+                                   mosaics=mosaics, db_path=db_path)
+                if record['status'] != 'done':
+                    record_day(day, freq, record['status'], db_path=db_path)
+            elif stage.startswith('mosaic_') and record['status'] == 'done':
+                mosaic = stage.split('_', 1)[1]
+                record_mosaic(day, mosaic.split('.')[-1], mosaic, result.get('pointings', []),
+                              split=result.get('split', True), db_path=db_path)
+    finally:
+        os.chdir(cwd)
+
+    return len(stages)
+
+
+def relocate(old: str, new: str, db_path: str=None):
+    """Update the paths of everything recorded under one folder after it has
+    been copied elsewhere, i.e. from scratch disk back to the day
+
+    Arguments:
+        old {str} -- Folder the files were recorded in
+        new {str} -- Folder the files are now in
+
+    Keyword Arguments:
+        db_path {str} -- Database file (default: {None})
+    """
+    old, new = os.path.abspath(old), os.path.abspath(new)
+    with connect(db_path) as db:
+        for table in ('days', 'sources'):
+            db.execute(f"UPDATE {table} SET path = ? || substr(path, ?) "\
+                       "WHERE path = ? OR substr(path, 1, ?) = ?",
+                       (new, len(old) + 1, old, len(old) + 1, old + os.sep))
+
+
+def record_uvfmeas(day: str, source: str, fit: dict, log: str, db_path: str=None):
+    """Record the flux density model of a secondary calibrator fitted by uvfmeas
+
+    Arguments:
+        day {str} -- Name of the day
+        source {str} -- Secondary calibrator
+        fit {dict} -- Fit from `miriad_parsers.parse_uvfmeas`
+        log {str} -- uvfmeas log the fit was read from
+
+    Keyword Arguments:
+        db_path {str} -- Database file (default: {None})
+    """
+    with connect(db_path) as db:
+        db.execute("INSERT OR REPLACE INTO uvfmeas VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                   (day, source, fit.get('flux'), fit.get('ref_freq'), fit.get('alpha'),
+                    json.dumps(fit.get('coeffs')), fit.get('fmin'), fit.get('fmax'),
+                    fit.get('npoints'), os.path.abspath(log), time.time()))
+
+
+def uvfmeas(source: str=None, day: str=None, db_path: str=None):
+    """uvfmeas fits in the catalogue
+
+    Keyword Arguments:
+        source {str} -- Only fits of this secondary calibrator (default: {None})
+        day {str} -- Only fits of this day (default: {None})
+        db_path {str} -- Database file (default: {None})
+
+    Returns:
+        list -- A row per day and source, with `coeffs` as a list
+    """
+    query = "SELECT * FROM uvfmeas WHERE (? IS NULL OR source = ?) AND (? IS NULL OR day = ?) "\
+            "ORDER BY source, day"
+    with connect(db_path) as db:
+        rows = [dict(r) for r in db.execute(query, (source, source, day, day))]
+    for row in rows:
+        row['coeffs'] = json.loads(row['coeffs']) if row['coeffs'] else None
+
+    return rows
+
+
+def days(freq: str=None, status: str=None, day: str=None, db_path: str=None):
+    """Days in the catalogue
+
+    Keyword Arguments:
+        freq {str} -- Only days with this IF (default: {None})
+        status {str} -- Only days with this status (default: {None})
+        day {str} -- Only this day (default: {None})
+        db_path {str} -- Database file (default: {None})
+
+    Returns:
+        list -- A row per day and IF
+    """
+    query = "SELECT * FROM days WHERE (? IS NULL OR freq = ?) AND (? IS NULL OR status = ?) "\
+            "AND (? IS NULL OR day = ?) ORDER BY day, freq"
+    freq = None if freq is None else str(freq)
+    with connect(db_path) as db:
+        return [dict(r) for r in db.execute(query, (freq, freq, status, status, day, day))]
+
+
+def sources(role: str=None, freq: str=None, day: str=None, db_path: str=None):
+    """Sources in the catalogue
+
+    Keyword Arguments:
+        role {str} -- Only sources of this role, i.e. `secondary` or `pointing` (default: {None})
+        freq {str} -- Only sources of this IF (default: {None})
+        day {str} -- Only sources of this day (default: {None})
+        db_path {str} -- Database file (default: {None})
+
+    Returns:
+        list -- A row per source
+    """
+    query = "SELECT * FROM sources WHERE (? IS NULL OR role = ?) AND (? IS NULL OR freq = ?) "\
+            "AND (? IS NULL OR day = ?) ORDER BY day, freq, name"
+    freq = None if freq is None else str(freq)
+    with connect(db_path) as db:
+        return [dict(r) for r in db.execute(query, (role, role, freq, freq, day, day))]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query or populate the GLASS catalogue')
+    parser.add_argument('--import', dest='import_days', nargs='+', metavar='DAY',
+                        help='Add days to the catalogue from their checkpoint records')
+    parser.add_argument('--freq', help='Only list this IF')
+    parser.add_argument('--role', help='List sources of this role rather than days')
+    parser.add_argument('--uvfmeas', nargs='?', const='', metavar='SOURCE',
+                        help='List the uvfmeas fits of the secondaries, or of one secondary')
+    args = parser.parse_args()
+
+    if args.import_days:
+        for day in args.import_days:
+            print(f"{day}: {import_day(day)} stages")
+        sys.exit()
+
+    if args.uvfmeas is not None:
+        print(f"{'Day':<12} {'Source':<10} {'Flux (Jy)':>9} {'GHz':>6} {'Alpha':>7}")
+        for f in uvfmeas(source=args.uvfmeas or None):
+            values = [f"{f[k]:>{w}.{p}f}" if f[k] is not None else f"{'-':>{w}}"
+                      for k, w, p in (('flux', 9, 3), ('ref_freq', 6, 2), ('alpha', 7, 3))]
+            print(f"{f['day']:<12} {f['source']:<10} {' '.join(values)}")
+    elif args.role:
+        for s in sources(role=args.role, freq=args.freq):
+            flagged = f"{s['flagged']:.1%}" if s['flagged'] is not None else '-'
+            print(f"{s['day']:<12} {s['freq']:<5} {s['name']:<20} {s['status']:<8} {flagged:>6} {s['path']}")
+    else:
+        for d in days(freq=args.freq):
+            print(f"{d['day']:<12} {d['freq']:<5} {d['status']:<11} {d['primary_src'] or '-':<15} "\
+                  f"{d['secondary_src'] or '-':<15}")
@@ -0,0 +1,165 @@
+"""Checkpoints recording the stages of a reduction that have completed.
+
+Each stage describes its inputs as a manifest (input file names, sizes and
+modification times, flag definitions, task parameters and miriad revisions).
+The manifest is hashed, and a rerun may skip any stage whose recorded digest
+matches and which finished successfully. Records are kept as small JSON files
+in the `.checkpoints` folder of each day. Deleting that folder forces a full
+reduction.
+"""
+import os
+import json
+import hashlib
+import time
+import threading
+
+CHECKPOINT_DIR = '.checkpoints'
+
+
+def file_manifest(files: list):
+    """Describe a set of files by name, size and modification time. Directories
+    (i.e. miriad datasets) are described by the sum of their items.
+
+    Arguments:
+        files {list} -- Paths to describe
+
+    Returns:
+        list -- A dict per file. Missing files have a size and mtime of None
+    """
+    manifest = []
+    for f in files:
+        if os.path.isdir(f):
+            items = [os.path.join(root, i) for root, _, names in os.walk(f) for i in names]
+            stats = [os.stat(i) for i in items]
+            size = sum(s.st_size for s in stats)
+            mtime = max([s.st_mtime for s in stats], default=os.stat(f).st_mtime)
+        elif os.path.exists(f):
+            stat = os.stat(f)
+            size, mtime = stat.st_size, stat.st_mtime
+        else:
+            size, mtime = None, None
+
+        manifest.append({'name': f, 'size': size, 'mtime': mtime})
+
+    return manifest
+
+
+def digest(manifest: dict):
+    """Hash a manifest. Keys are sorted so that the digest is stable
+
+    Arguments:
+        manifest {dict} -- JSON serialisable description of the stage inputs
+
+    Returns:
+        str -- Hex digest of the manifest
+    """
+    content = json.dumps(manifest, sort_keys=True, default=str)
+
+    return hashlib.sha256(content.encode()).hexdigest()
+
+
+class Checkpoints:
+    """Read and write the checkpoint records of a day
+    """
+    def __init__(self, path: str=CHECKPOINT_DIR):
+        """Create the manager of a checkpoint folder
+
+        Keyword Arguments:
+            path {str} -- Folder holding the checkpoint records (default: {CHECKPOINT_DIR})
+        """
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _record_path(self, stage: str):
+        return os.path.join(self.path, f"{stage}.json")
+
+    def load(self, stage: str):
+        """Return the record of a stage, or None if it has never been started
+
+        Arguments:
+            stage {str} -- Name of the stage
+        """
+        try:
+            with open(self._record_path(stage), 'r') as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return None
+
+    def stages(self, suffix: str=''):
+        """Return the names of all recorded stages
+
+        Keyword Arguments:
+            suffix {str} -- Only return stages ending with this (default: {''})
+        """
+        if not os.path.exists(self.path):
+            return []
+
+        return sorted(f[:-5] for f in os.listdir(self.path)
+                      if f.endswith(f"{suffix}.json"))
+
+    def is_current(self, stage: str, stage_digest: str):
+        """Whether a stage finished with the same inputs as described by a digest
+
+        Arguments:
+            stage {str} -- Name of the stage
+            stage_digest {str} -- Digest of the current inputs of the stage
+        """
+        record = self.load(stage)
+
+        return record is not None and record['status'] == 'done' and \
+               record['digest'] == stage_digest
+
+    def _write(self, stage: str, record: dict):
+        with self._lock:
+            if not os.path.exists(self.path):
+                os.makedirs(self.path, exist_ok=True)
+
+            tmp = f"{self._record_path(stage)}.tmp"
+            with open(tmp, 'w') as out:
+                json.dump(record, out, indent=1, sort_keys=True, default=str)
+            os.replace(tmp, self._record_path(stage))
+
+    def start(self, stage: str, stage_digest: str, manifest: dict):
+        """Record that a stage is starting. Any previous record is replaced.
+
+        Arguments:
+            stage {str} -- Name of the stage
+            stage_digest {str} -- Digest of the inputs of the stage
+            manifest {dict} -- Description of the inputs of the stage
+        """
+        self._write(stage, {'stage': stage, 'status': 'started', 'digest': stage_digest,
+                            'manifest': manifest, 'started': time.time(), 'result': {}})
+
+    def update(self, stage: str, **result):
+        """Add results to the record of a stage, i.e. the files it created, so that
+        they can be found again on a rerun
+
+        Arguments:
+            stage {str} -- Name of the stage
+        """
+        record = self.load(stage)
+        record['result'].update(result)
+        self._write(stage, record)
+
+    def done(self, stage: str, **result):
+        """Record that a stage has completed
+
+        Arguments:
+            stage {str} -- Name of the stage
+        """
+        record = self.load(stage)
+        record['result'].update(result)
+        record['status'] = 'done'
+        record['finished'] = time.time()
+        self._write(stage, record)
+
+    def discard(self, stage: str):
+        """Remove the record of a stage, i.e. once its products have been removed,
+        so that it is run again
+
+        Arguments:
+            stage {str} -- Name of the stage
+        """
+        with self._lock:
+            if os.path.exists(self._record_path(stage)):
+                os.remove(self._record_path(stage))
@@ -2,23 +2,45 @@
 """
 from glob import glob
 import subprocess as sp
-import pymir as pymir
-from pymir import mirstr as m
-from multiprocessing import Pool
+from concurrent.futures import wait
 import os
 import sys
 import shutil as su
+import re
+import time
+from datetime import datetime
+from contextlib import contextmanager
+import contextvars
+import asyncio
+import threading
+import shlex
+import json
+import math
+import fcntl
+import signal
+import atexit
+from functools import lru_cache
+
+import miriad_parsers
+import task_runner
+# Needs numpy, which only the quality control of visibilities relies on
+try:
+    import miriad_io
+except ImportError:
+    miriad_io = None
 
 # Get default logger set up in the reduction pipeline
 import logging
 logger = logging.getLogger()
 
-# Added the mirstr as a package from github tjgalvin
-# Hack until reduction scripts are updated
-mirstr = pymir.mirstr
-
 primary = '1934-638'
 
+# Sources observed by GLASS, used to work out the role of each source of a day
+primary_srcs = ['1934-638']
+secondary_srcs = ['2245-328', '2312-319', '2255-282','2244-372']
+target_srcs = ['a','b','c','d','e','f']
+ignore_srcs = ['2333-528','0823-500','0537-441','1921-293']
+
 ref_5 = 4476
 flags_5 = {'chan_start':[5622-ref_5, 5930-ref_5, 6440-ref_5],
            'chan_end'  :[5628-ref_5, 5960-ref_5, 6480-ref_5]}
@@ -37,53 +59,865 @@ frequencyFlagging = {
              [ 5930.0, 5960.0 ], [ 6440.0, 6480.0 ], [ 7747.0, 7777.0 ], [ 7866.0, 7896.0 ],
              [ 8058.0, 8088.0 ], [ 8177.0, 8207.0 ] ]
 }
+# -----------------------------------------------------------------------------
+# Task execution and instrumentation
+# -----------------------------------------------------------------------------
+
+# Tags (day, freq, stage, ...) added to the record of every task executed in
+# the current context. Tasks of a `TaskGraph` inherit the tags in place when
+# they were added.
+_task_tags = contextvars.ContextVar('task_tags', default={})
+_task_log = {'path': None, 'lock': threading.Lock()}
+# Processes of the tasks `run_task` is running, mapped to their state, so that
+# they can be stopped when a reduction fails (see `terminate_tasks`)
+_running_tasks = {'tasks': {}, 'lock': threading.Lock()}
+
+# Seconds a miriad task run by `mir_run` may take before it is stopped. Tasks
+# may run for as long as they need if not set.
+TASK_TIMEOUT = float(os.environ['GLASS_TASK_TIMEOUT']) if os.environ.get('GLASS_TASK_TIMEOUT') \
+               else None
+
+
+class MirTaskError(RuntimeError):
+    """A miriad task exited with a nonzero code, or was stopped
+    """
+    def __init__(self, task):
+        """
+        Arguments:
+            task {MirTask} -- The failed task
+        """
+        self.task = task
+        reason = f"was stopped after {task.record.get('timeout')}s" if task.record.get('timed_out') \
+                 else f"exited with code {task.returncode}"
+        super().__init__(f"{task.cmd} {reason}")
+
+
+class MirTask:
+    """The output of an executed miriad task. Like an executed pymir `mirstr`, 
+    its string form is the command followed by the task output and the task 
+    keywords are available as attributes, i.e. `atlod.out`. The output of tasks
+    with a parser in `miriad_parsers.py` is also available as `parsed`.
+    """
+    def __init__(self, cmd: str, output: str, returncode: int, record: dict):
+        """
+        Arguments:
+            cmd {str} -- The executed command
+            output {str} -- Combined stdout and stderr of the task
+            returncode {int} -- Exit code of the task
+            record {dict} -- Timing and resource usage of the task
+        """
+        self.cmd = cmd
+        self.output = output
+        self.returncode = returncode
+        self.record = record
+        self.parsed = record.get('parsed')
+        self.keywords = task_keywords(cmd)
+
+    def __str__(self):
+        return f"{self.cmd}\n\n{self.output}"
+
+    def __getattr__(self, key):
+        if key != 'keywords' and key in self.keywords:
+            return self.keywords[key]
+        raise AttributeError(key)
+
+
+def task_keywords(cmd: str):
+    """Return the keyword=value pairs of a miriad command as a dict
+    
+    Arguments:
+        cmd {str} -- Miriad task and its keywords
+    """
+    return dict(arg.split('=', 1) for arg in shlex.split(cmd)[1:] if '=' in arg)
+
+
+@contextmanager
+def task_tags(**tags):
+    """Add tags to the records of any miriad task executed within the block,
+    i.e. `with task_tags(freq=5500, stage='calibrate_5500'):`
+    """
+    token = _task_tags.set(dict(_task_tags.get(), **tags))
+    try:
+        yield
+    finally:
+        _task_tags.reset(token)
+
+
+def set_task_log(path: str, **tags):
+    """Write a JSON record of each executed miriad task to a file. 
+    
+    Arguments:
+        path {str} -- JSON-lines file to append records to. None to disable.
+    
+    Keyword Arguments:
+        Any further keywords are added as tags to every record, along with
+        the time of this call to identify the run
+    """
+    # Kept absolute, as a reduction may move to another folder (see `staging.py`)
+    _task_log['path'] = None if path is None else os.path.abspath(path)
+    run = datetime.now().isoformat(timespec='seconds')
+    _task_tags.set(dict(_task_tags.get(), run=run, **tags))
+
+
+def dataset_size(path: str):
+    """Size in bytes of a file, or of the items of a miriad dataset
+    
+    Arguments:
+        path {str} -- File or dataset
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f))
+                   for root, _, files in os.walk(path) for f in files)
+    if os.path.exists(path):
+        return os.path.getsize(path)
+    return 0
+
+
+def _proc_io(pid: int):
+    """Read the I/O counters of a process from /proc
+    """
+    try:
+        with open(f"/proc/{pid}/io", 'r') as infile:
+            return {k: int(v) for k, v in (l.split(':') for l in infile if ':' in l)}
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_record(record: dict):
+    """Add the record of an executed task to the task log, if one is set
+    """
+    if _task_log['path'] is not None:
+        with _task_log['lock'], open(_task_log['path'], 'a') as out:
+            out.write(json.dumps(record) + '\n')
+
+
+def _task_name(cmd: str):
+    """Prefix of each logged line of the output of a task: the task and the file
+    it works on, i.e. `uvplt 1934-638.5500_amp.png`
+
+    Arguments:
+        cmd {str} -- Miriad task and its keywords
+    """
+    keywords = task_keywords(cmd)
+    source = keywords.get('vis', keywords.get('out', ''))
+    device = keywords.get('device', '').split('/')[0]
+
+    return f"{shlex.split(cmd)[0]} {os.path.basename(device or source)}".strip()
+
+
+async def run_task_async(runner, cmd: str, tags: dict=None, timeout: float=None):
+    """Execute a miriad task on an asyncio runner (see `task_runner.py`). Its
+    output is logged line by line as it is written, each line prefixed with the
+    task and the file it works on. The task is recorded in the task log as by
+    `run_task`, without the CPU, memory and I/O counts, which are not available
+    for an asyncio subprocess.
+
+    Arguments:
+        runner {AsyncRunner} -- Runner to execute the task on
+        cmd {str} -- Miriad task and its keywords
+
+    Keyword Arguments:
+        tags {dict} -- Tags of the record. Those of the current context are
+                       used if not given (default: {None})
+        timeout {float} -- Seconds the task may run for (default: {None})
+
+    Returns:
+        MirTask -- The output and record of the executed task
+    """
+    keywords = task_keywords(cmd)
+    task = shlex.split(cmd)[0]
+    source = keywords.get('vis', keywords.get('out', ''))
+
+    result = await runner.run(cmd, name=_task_name(cmd), timeout=timeout)
+
+    record = dict(_task_tags.get() if tags is None else tags)
+    record.setdefault('day', os.path.basename(os.getcwd()))
+    record.update({'task': task, 'cmd': cmd, 'thread': threading.current_thread().name,
+                   'source': source,
+                   'vis_bytes': sum(dataset_size(v) for v in source.split(',') if v != ''),
+                   'start': result['start'], 'wall': result['wall'], 'cpu_user': None,
+                   'cpu_sys': None, 'max_rss_kb': None, 'read_bytes': None, 'write_bytes': None,
+                   'rchar': None, 'wchar': None, 'returncode': result['returncode'],
+                   'timeout': timeout, 'timed_out': result['timed_out']})
+    parsed = miriad_parsers.parse(task, result['output'])
+    if parsed is not None:
+        record['parsed'] = parsed
+    _write_record(record)
+
+    return MirTask(cmd, result['output'], result['returncode'], record)
+
+
+def _signal_task(proc, state: dict, sig: int):
+    """Send a signal to the process group of a task started by `run_task`.
+    `state` holds the `done` event set once the task has exited, and the `lock`
+    held while it is set, so that a reaped process is never signalled.
+
+    Returns:
+        bool -- Whether the task was still running
+    """
+    with state['lock']:
+        if state['done'].is_set():
+            return False
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    return True
+
+
+def _stop_after(proc, timeout: float, state: dict):
+    """Stop a task that has not exited within its timeout, killing it if it does
+    not exit within `task_runner.TERMINATE_GRACE` seconds of being terminated.
+    """
+    if state['done'].wait(timeout):
+        return
+
+    logger.log(logging.WARNING, f"{proc.args[0]} did not finish within {timeout}s, stopping it")
+    state['timed_out'] = True
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        if not _signal_task(proc, state, sig):
+            return
+        if state['done'].wait(task_runner.TERMINATE_GRACE):
+            return
+
+
+def terminate_tasks(grace: float=None):
+    """Stop the tasks `run_task` is running in any thread, i.e. the siblings of
+    a failed task of a `TaskGraph`, rather than waiting for them to finish.
+    Their process groups are terminated, then killed if they do not exit in
+    time, and each stopped task fails in the thread that runs it.
+
+    Keyword Arguments:
+        grace {float} -- Seconds the tasks are given to exit before they are
+                         killed (default: {task_runner.TERMINATE_GRACE})
+    """
+    grace = task_runner.TERMINATE_GRACE if grace is None else grace
+    with _running_tasks['lock']:
+        tasks = list(_running_tasks['tasks'].items())
+    if len(tasks) == 0:
+        return
+
+    logger.log(logging.WARNING, f"Stopping {len(tasks)} running tasks")
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        for proc, state in tasks:
+            _signal_task(proc, state, sig)
+        deadline = time.time() + grace
+        if all(state['done'].wait(max(0, deadline - time.time())) for _, state in tasks):
+            return
+
+
+def run_task(cmd: str, timeout: float=None):
+    """Execute a miriad task, recording its wall and CPU time, peak memory,
+    the bytes it read and wrote and the size of the visibilities it worked on.
+    The record, with the output parsed by `miriad_parsers.parse` as `parsed`,
+    is written to the task log if one is set. The output is logged line by
+    line as it is written, each line prefixed with the task and the file it
+    works on. The task runs in a session of its own, so that it can be stopped
+    along with any process it starts (see `terminate_tasks`).
+    
+    Arguments:
+        cmd {str} -- Miriad task and its keywords
+
+    Keyword Arguments:
+        timeout {float} -- Seconds the task may run for before it is terminated,
+                           and then killed if it does not exit (default: {None})
+
+    Returns:
+        MirTask -- The output and record of the executed task
+    """
+    args = shlex.split(cmd)
+    keywords = task_keywords(cmd)
+    # atlod reads `in` rather than `vis`, and its product is `out`
+    vis = [v for v in (keywords.get('vis') or keywords.get('in', '')).split(',') if v != '']
+    vis_bytes = sum(dataset_size(v) for v in vis)
+    source = keywords['vis'] if 'vis' in keywords else keywords.get('out', '')
+
+    name = _task_name(cmd)
+
+    start = time.time()
+    proc = sp.Popen(args, stdin=sp.DEVNULL, stdout=sp.PIPE, stderr=sp.STDOUT,
+                    universal_newlines=True, errors='replace', start_new_session=True)
+    state = {'done': threading.Event(), 'lock': threading.Lock(), 'timed_out': False}
+    with _running_tasks['lock']:
+        _running_tasks['tasks'][proc] = state
+    if timeout is not None:
+        threading.Thread(target=_stop_after, args=(proc, timeout, state), daemon=True,
+                         name=f"{threading.current_thread().name}-timeout").start()
+
+    lines = []
+    try:
+        for line in proc.stdout:
+            lines.append(line)
+            logger.log(logging.INFO, f"[{name}] {line.rstrip()}")
+    except BaseException:
+        # i.e. KeyboardInterrupt, which the task does not see in its own session
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            _signal_task(proc, state, sig)
+            try:
+                proc.wait(task_runner.TERMINATE_GRACE)
+                break
+            except sp.TimeoutExpired:
+                continue
+        with state['lock']:
+            state['done'].set()
+        raise
+    finally:
+        proc.stdout.close()
+        with _running_tasks['lock']:
+            _running_tasks['tasks'].pop(proc, None)
+    output = ''.join(lines)
+
+    # Wait without reaping so the I/O counters of the exited task can be read
+    os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+    with state['lock']:
+        state['done'].set()
+    io_counts = _proc_io(proc.pid)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    record = dict(_task_tags.get())
+    record.setdefault('day', os.path.basename(os.getcwd()))
+    record.update({'task': args[0], 'cmd': cmd, 'thread': threading.current_thread().name,
+                   'source': source,
+                   'vis_bytes': vis_bytes, 'start': start, 'wall': time.time() - start,
+                   'cpu_user': usage.ru_utime, 'cpu_sys': usage.ru_stime,
+                   'max_rss_kb': usage.ru_maxrss, 'read_bytes': io_counts.get('read_bytes'),
+                   'write_bytes': io_counts.get('write_bytes'), 'rchar': io_counts.get('rchar'),
+                   'wchar': io_counts.get('wchar'), 'returncode': proc.returncode,
+                   'timeout': timeout, 'timed_out': state['timed_out']})
+    parsed = miriad_parsers.parse(args[0], output)
+    if parsed is not None:
+        record['parsed'] = parsed
+
+    _write_record(record)
+
+    if proc.returncode != 0:
+        logger.log(logging.WARNING, f"{args[0]} exited with code {proc.returncode}")
+
+    return MirTask(cmd, output, proc.returncode, record)
+
+
+def parsed_output(task: str, proc):
+    """Record of the output of an executed task from `miriad_parsers`
+
+    Arguments:
+        task {str} -- Name of the miriad task
+        proc {MirTask} -- Executed task, or its output as text
+
+    Returns:
+        dict -- The parsed record, empty if the output could not be parsed
+    """
+    parsed = getattr(proc, 'parsed', None)
+    if parsed is None:
+        parsed = miriad_parsers.parse(task, str(proc))
+
+    return parsed or {}
+
+
+def mir_run(cmd: str, check: bool=True, timeout: float=TASK_TIMEOUT):
+    """Execute a miriad task, logging the command and then its output as it is
+    written. A failed task raises, so that a reduction stops at the first failed
+    step rather than carrying on from it.
+    
+    Arguments:
+        cmd {str} -- Miriad task and its keywords
+
+    Keyword Arguments:
+        check {bool} -- Raise if the task exits with a nonzero code (default: {True})
+        timeout {float} -- Seconds the task may run for (default: {TASK_TIMEOUT})
+
+    Raises:
+        MirTaskError -- Raised if `check` is set and the task failed or was stopped
+
+    Returns:
+        MirTask -- The executed task
+    """
+    logger.log(logging.INFO, cmd)
+    proc = run_task(cmd, timeout=timeout)
+    if check and proc.returncode != 0:
+        raise MirTaskError(proc)
+
+    return proc
+
+# -----------------------------------------------------------------------------
+
 # -----------------------------------------------------------------------------
 # Flagging utilities
 # -----------------------------------------------------------------------------
 
-def uvflag_file(vis):
-    """Search for a file containing uvflag defs to execute. File is assumed to be 
-    new line delimited with a valid select statement each line of data to
-    flag
+# Miriad ORs together select subcommands of the same type and ANDs the
+# different types, so single-type select lines can share one uvflag pass.
+# Keep each combined select comfortably inside the miriad keyword buffer.
+MAX_SELECT_CLAUSES = 32
+
+
+def split_select(line: str):
+    """Split a select statement into its top level subcommands, i.e.
+    `ant(2),time(a,b)` becomes `['ant(2)', 'time(a,b)']`
+    
+    Arguments:
+        line {str} -- A miriad select statement
+    """
+    clauses = []
+    depth = 0
+    current = ''
+    for c in line:
+        if c == ',' and depth == 0:
+            clauses.append(current.strip())
+            current = ''
+            continue
+        if c == '(':
+            depth += 1
+        elif c == ')':
+            depth -= 1
+        current += c
+
+    if current.strip() != '':
+        clauses.append(current.strip())
+
+    return clauses
+
+
+def _select_time(stamp: str):
+    """Convert a miriad select time stamp into a comparable key. Times are either
+    `hh:mm:ss` or `yyMMMdd:hh:mm:ss`. Only stamps of the same form can be compared,
+    so the form is returned alongside the key. 
+
+    Arguments:
+        stamp {str} -- Time stamp from a `time()` subcommand
+    """
+    stamp = stamp.strip()
+    if stamp[:1].isdigit() and stamp[2:5].isalpha():
+        day = datetime.strptime(stamp[:7].upper(), '%y%b%d')
+        hms = stamp[8:]
+        form = 'dated'
+    else:
+        day = datetime(1970, 1, 1)
+        hms = stamp
+        form = 'undated'
+
+    fields = [float(f) for f in hms.split(':')] + [0., 0.]
+    seconds = fields[0]*3600 + fields[1]*60 + fields[2]
+
+    return form, (day - datetime(1970, 1, 1)).total_seconds() + seconds
+
+
+def merge_ranges(ranges: list):
+    """Merge overlapping or touching (start, end) pairs. Optional third and fourth
+    items label the start and end, and are carried along with their boundary. 
+    
+    Arguments:
+        ranges {list} -- List of (start, end, ...) tuples
+    """
+    merged = []
+    for r in sorted(ranges, key=lambda r: r[0]):
+        if merged and r[0] <= merged[-1][1]:
+            if r[1] > merged[-1][1]:
+                merged[-1] = (merged[-1][0], r[1]) + merged[-1][2:3] + r[3:]
+        else:
+            merged.append(tuple(r))
+
+    return merged
+
+
+def merge_time_clauses(clauses: list):
+    """Merge overlapping `time(t1,t2)` subcommands. Subcommands whose stamps can
+    not be understood are passed through untouched. 
+    
+    Arguments:
+        clauses {list} -- List of `time()` select subcommands
+    """
+    forms = {}
+    passthrough = []
+    for clause in clauses:
+        try:
+            t1, t2 = clause[clause.index('(')+1:clause.rindex(')')].split(',')
+            f1, k1 = _select_time(t1)
+            f2, k2 = _select_time(t2)
+        except ValueError:
+            passthrough.append(clause)
+            continue
+        if f1 != f2:
+            passthrough.append(clause)
+            continue
+        forms.setdefault(f1, []).append((k1, k2, t1.strip(), t2.strip()))
+
+    merged = []
+    for form in sorted(forms):
+        for _, _, t1, t2 in merge_ranges(forms[form]):
+            merged.append(f"time({t1},{t2})")
+
+    return merged + passthrough
+
+
+def plan_uvflag_selects(lines: list):
+    """Reduce a set of select statements to as few uvflag passes as the miriad
+    select grammar allows. Lines made up of a single subcommand type are ORed 
+    together into a single statement, overlapping time ranges are merged, and 
+    lines mixing subcommand types (which are ANDed) or using negation are kept
+    as their own pass. 
+    
+    Arguments:
+        lines {list} -- Select statements, one per intended uvflag pass
+    """
+    groups = {}
+    standalone = []
+    for line in lines:
+        line = line.strip()
+        if line == '' or line.startswith('#'):
+            continue
+
+        clauses = split_select(line)
+        kinds = set(c.split('(')[0].strip().lower() for c in clauses)
+        if len(kinds) != 1 or any(c.startswith('-') for c in clauses):
+            if line not in standalone:
+                standalone.append(line)
+            continue
+
+        group = groups.setdefault(kinds.pop(), [])
+        group.extend(c for c in clauses if c not in group)
+
+    selects = []
+    for kind, clauses in groups.items():
+        if kind == 'time':
+            clauses = merge_time_clauses(clauses)
+        for i in range(0, len(clauses), MAX_SELECT_CLAUSES):
+            selects.append(','.join(clauses[i:i+MAX_SELECT_CLAUSES]))
+
+    return selects + standalone
+
+
+def plan_uvflag_channels(flag_def: dict):
+    """Merge the channel ranges of a flag definition into the fewest uvflag
+    `line` specifications
     
+    Arguments:
+        flag_def {dict} -- A dict with `chan_start` and `chan_end` channels to flag
+    
+    Raises:
+        ValueError -- Raised if the `chan_start` and `chan_end` do not have same length
+    """
+    if len(flag_def['chan_start']) != len(flag_def['chan_end']):
+        raise ValueError('Channels start and end should have the same length')
+
+    ranges = merge_ranges(zip(flag_def['chan_start'], flag_def['chan_end']))
+
+    return [f"chan,{end-start},{start},1" for start, end in ranges]
+
+
+@contextmanager
+def file_lock(path: str):
+    """Hold an exclusive lock on `<path>.lock` for the length of the block, so
+    that processes sharing a file, i.e. the reductions of both IFs of a day,
+    can read, change and write it in turn
+
+    Arguments:
+        path {str} -- File to lock
+    """
+    with open(f"{path}.lock", 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+# Compiled channel masks of `frequencyFlagging['rfi']`, kept in the day folder.
+# Both IFs of a day may be reduced at once, so it is updated under a file lock.
+RFI_MASK_CACHE = 'rfi_masks.json'
+_rfi_masks = {'lock': threading.Lock()}
+
+_spectral_fields = {'nchan': re.compile(r'number of channels\s*:(.*)', re.IGNORECASE),
+                    'sfreq': re.compile(r'starting frequency\s*:(.*)', re.IGNORECASE),
+                    'sdf': re.compile(r'frequency interval\s*:(.*)', re.IGNORECASE)}
+
+
+def spectral_setup(vis: str):
+    """Frequency axis of a visibility file from `uvlist options=spectral`
+
+    Arguments:
+        vis {str} -- Visibility file. Only the first of a comma separated list
+                     is inspected
+
+    Returns:
+        list -- A dict per spectral window of `sfreq` and `sdf` (GHz) and `nchan`.
+                Empty if the setup could not be read
+    """
+    uvlist = mir_run(f"uvlist vis={vis.split(',')[0]} options=spectral")
+
+    values = {}
+    for line in str(uvlist).splitlines():
+        for key, pattern in _spectral_fields.items():
+            match = pattern.search(line)
+            if match is not None and key not in values:
+                values[key] = match.group(1).split()
+
+    if len(values) != len(_spectral_fields):
+        logger.log(logging.WARNING, f"Could not read the spectral setup of {vis}")
+        return []
+
+    return [{'sfreq': float(sfreq), 'sdf': float(sdf), 'nchan': int(nchan)}
+            for sfreq, sdf, nchan in zip(values['sfreq'], values['sdf'], values['nchan'])]
+
+
+def compile_rfi_mask(sfreq: float, sdf: float, nchan: int, rfi: list=None):
+    """Convert RFI frequency ranges to merged channel ranges of a spectral window.
+    Channel `c` (from 1) is centred on `sfreq + (c - 1) * sdf`, and any channel
+    overlapping a range is flagged.
+
+    Arguments:
+        sfreq {float} -- Frequency of the first channel (GHz)
+        sdf {float} -- Channel width (GHz), possibly negative
+        nchan {int} -- Number of channels
+
+    Keyword Arguments:
+        rfi {list} -- [low, high] ranges in MHz. `frequencyFlagging['rfi']` if
+                      not given (default: {None})
+
+    Returns:
+        dict -- `chan_start` and `chan_end` lists, as `flags_5`, with `chan_end`
+                one past the last channel to flag
+    """
+    rfi = frequencyFlagging['rfi'] if rfi is None else rfi
+
+    ranges = []
+    for low, high in rfi:
+        edges = sorted(((f / 1000 - sfreq) / sdf + 1 for f in (low, high)))
+        start = max(1, int(math.floor(edges[0] + 0.5)))
+        end = min(nchan, int(math.ceil(edges[1] - 0.5)))
+        if start <= end:
+            ranges.append((start, end + 1))
+
+    ranges = merge_ranges(ranges)
+
+    return {'chan_start': [r[0] for r in ranges], 'chan_end': [r[1] for r in ranges]}
+
+
+def rfi_mask(setup: dict):
+    """Compiled RFI channel mask of a spectral window, cached per correlator
+    setup in `RFI_MASK_CACHE`
+
+    Arguments:
+        setup {dict} -- `sfreq`, `sdf` and `nchan` of the spectral window
+    """
+    rfi = frequencyFlagging['rfi']
+    key = f"{setup['sfreq']:.6f},{setup['sdf']:.9f},{setup['nchan']}"
+    with _rfi_masks['lock'], file_lock(RFI_MASK_CACHE):
+        cache = {}
+        if os.path.exists(RFI_MASK_CACHE):
+            with open(RFI_MASK_CACHE, 'r') as infile:
+                cache = json.load(infile)
+
+        entry = cache.get(key)
+        if entry is None or entry['rfi'] != rfi:
+            entry = {'rfi': rfi, 'mask': compile_rfi_mask(setup['sfreq'], setup['sdf'],
+                                                          setup['nchan'], rfi=rfi)}
+            cache[key] = entry
+            tmp = f"{RFI_MASK_CACHE}.{os.getpid()}.tmp"
+            try:
+                with open(tmp, 'w') as out:
+                    json.dump(cache, out, indent=1)
+                os.replace(tmp, RFI_MASK_CACHE)
+            except OSError as e:
+                logger.log(logging.WARNING, f"Could not cache the RFI mask: {e}")
+
+    return entry['mask']
+
+
+def read_flag_file(vis: str, freq: str=None):
+    """Return the select statements in the flag def file appropriate for
+    a visibility file. An empty list is returned if there is no file. 
+
     Arguments:
         vis {str} -- Visibility file to flag
+
+    Keyword Arguments:
+        freq {str} -- Frequency of the IF. Guessed from `vis` if not given (default: {None})
     """
-    flag_file = 'flag_select_5500.dat' if '5500' in vis else 'flag_select_9500.dat'
+    if freq is None:
+        freq = '5500' if '5500' in vis or os.path.basename(vis).startswith('data5') else '9500'
+    flag_file = f'flag_select_{freq}.dat'
 
     if not os.path.exists(flag_file):
         logger.log(logging.INFO, "No flag def file found. ")
-        return
+        return []
 
     with open(flag_file, 'r') as infile:
-        for line in infile.read().splitlines():
-            uvflag = mirstr(f"uvflag vis={vis} select='{line}' flagval=flag").run()
-            logger.log(logging.INFO, uvflag)
+        return [l for l in infile.read().splitlines() if l.strip() != '']
+
+
+def uvflag_file(vis, freq=None):
+    """Search for a file containing uvflag defs to execute. File is assumed to be 
+    new line delimited with a valid select statement each line of data to
+    flag. Compatible statements are combined into as few uvflag passes as possible.
+    
+    Arguments:
+        vis {str} -- Visibility file to flag
+
+    Keyword Arguments:
+        freq {str} -- Frequency of the IF. Guessed from `vis` if not given (default: {None})
+
+    Returns:
+        tuple -- Number of select lines and the number of uvflag passes used
+    """
+    lines = read_flag_file(vis, freq=freq)
+    selects = plan_uvflag_selects(lines)
+
+    for select in selects:
+        mir_run(f"uvflag vis={vis} select='{select}' flagval=flag")
+
+    return len(lines), len(selects)
+
+
+def uvflag_windows(vis, windows: dict):
+    """Apply the flag def files of several IFs to data holding all of them,
+    in a single set of uvflag passes. Lines common to every IF are applied to
+    all the data, and each other line is restricted to the spectral window of
+    its IF with a `win` subcommand, which miriad ANDs with the rest of the line.
+
+    Arguments:
+        vis {str} -- Visibility file(s) to flag
+        windows {dict} -- Spectral window number of each IF frequency
+
+    Returns:
+        tuple -- Number of select lines and the number of uvflag passes used
+    """
+    lines = {freq: read_flag_file(vis, freq=str(freq)) for freq in windows}
+    common = [l for l in next(iter(lines.values())) if all(l in others for others in lines.values())]
+
+    selects = plan_uvflag_selects(common)
+    for freq, window in windows.items():
+        selects += [f"{select},win({window})"
+                    for select in plan_uvflag_selects([l for l in lines[freq] if l not in common])]
+
+    for select in selects:
+        mir_run(f"uvflag vis={vis} select='{select}' flagval=flag")
+
+    return sum(len(l) for l in lines.values()), len(selects)
+
+
+def uvflag_channels(vis, flag_def, rfi: bool=True):
+    """Flag the known bad channels of an IF, together with the channels of the
+    known RFI in `frequencyFlagging['rfi']`, merging overlapping ranges
+
+    Arguments:
+        vis {str} -- Visibility file(s) of a single IF to flag
+        flag_def {dict} -- A dict with `chan_start` and `chan_end` channels to flag
 
+    Keyword Arguments:
+        rfi {bool} -- Include the compiled RFI mask (default: {True})
 
-def uvflag(vis, flag_def):
-    """Flag the known bad channels from a visibility dataset.
+    Returns:
+        tuple -- Number of channel ranges and the number of uvflag passes used
+    """
+    if rfi:
+        setup = spectral_setup(vis)
+        if len(setup) == 1:
+            mask = rfi_mask(setup[0])
+            flag_def = {'chan_start': list(flag_def['chan_start']) + mask['chan_start'],
+                        'chan_end': list(flag_def['chan_end']) + mask['chan_end']}
+        elif len(setup) > 1:
+            logger.log(logging.WARNING, f"No RFI mask applied to {vis}, which has "\
+                                        f"{len(setup)} spectral windows")
+
+    lines = plan_uvflag_channels(flag_def)
+    for line in lines:
+        mir_run(f"uvflag vis={vis} line={line} flagval=flag")
+
+    return len(flag_def['chan_start']), len(lines)
+
+
+def uvflag(vis, flag_def, freq=None):
+    """Flag the known bad channels from a visibility dataset, together with
+    any select statements from the flag def file. Overlapping selections are
+    merged before uvflag is called, and the number of passes saved is logged. 
     
     Arguments:
         vis {str} -- Name of the visibility data to flag
         flag_def {dict} -- A dict with `chan_start` and `chan_end` channels to flag
+
+    Keyword Arguments:
+        freq {str} -- Frequency of the IF. Guessed from `vis` if not given (default: {None})
     
     Raises:
         ValueError -- Raised if the `chan_start` and `chan_end` do not have same length
-    
-    Raises:
-        ValueError -- [description]
     """
     # Perform any flagging in the appropriate def file
-    uvflag_file(vis)
+    requested, passes = uvflag_file(vis, freq=freq)
+
+    chan_requested, chan_passes = uvflag_channels(vis, flag_def)
+
+    requested += chan_requested
+    passes += chan_passes
+    logger.log(logging.INFO, f"uvflag of {vis}: {requested} flag definitions applied in "\
+                             f"{passes} passes, saving {requested - passes} passes")
+
+
+# Flagging plans for each source role, following Do_Flag.csh on the ATCAGAMA
+# wiki. Each pass is (stokes, flagpar, repeats). A pass is run again, up to
+# `repeats` times, only while it is still flagging new data.
+PGFLAG_PLANS = {
+    'primary': [('v', '15,3,3,3,5,3', 1),
+                ('q', '15,3,3,3,5,3', 1),
+                ('u', '15,3,3,3,5,3', 1),
+                ('i', '15,3,3,3,5,3', 1)],
+    'secondary': [('i,q,u,v', '10,1,1,3,5,3', 1),
+                  ('i,u', '10,1,1,3,5,3', 1),
+                  ('i,q', '10,1,1,3,5,3', 1),
+                  ('i', '10,1,1,3,5,3', 1)],
+    'mosaic': [('i,q,u,v', '10,1,0,3,5,3', 2),
+               ('i,q', '10,1,0,3,5,3', 2),
+               ('i,u', '10,1,0,3,5,3', 2),
+               ('i', '10,1,0,3,5,3', 2)]
+}
 
-    if len(flag_def['chan_start']) != len(flag_def['chan_end']):
-        raise ValueError('Channels start and end should have the same length')
-        
-    for start, end in zip(flag_def['chan_start'], flag_def['chan_end']):
-        line = f"chan,{end-start},{start},1"
-        proc = mirstr(f"uvflag vis={vis} line={line} flagval=flag").run()
-        logger.log(logging.INFO, proc)
+def pgflag_flagged(pgflag):
+    """Extract the number of newly flagged points from the flag summary of
+    pgflag. None is returned unless the summary was matched exactly (see
+    `miriad_parsers.parse_pgflag`), in which case the pass should be assumed
+    to have flagged something. 
+    
+    Arguments:
+        pgflag {MirTask} -- Executed pgflag
+    """
+    return parsed_output('pgflag', pgflag).get('flagged')
+
+
+def pgflag_plan(src: str, role: str):
+    """Run the flagging plan for a source role against a visibility file. Repeated
+    passes stop as soon as one is known to have flagged nothing new. A pass
+    whose flag summary could not be read is repeated as planned. 
+    
+    Arguments:
+        src {str} -- The filename of the data to flag
+        role {str} -- Key of the plan to run in `PGFLAG_PLANS`
+
+    Returns:
+        list -- A dict per pgflag call describing the pass, the number of newly 
+                flagged points and the time it took
+    """
+    passes = []
+    for stokes, flagpar, repeats in PGFLAG_PLANS[role]:
+        for iteration in range(repeats):
+            start = time.time()
+            pgflag = mir_run(f"pgflag vis={src} command='<' stokes={stokes} flagpar={flagpar} "\
+                             f"options=nodisp")
+
+            flagged = pgflag_flagged(pgflag)
+            passes.append({'vis': src, 'role': role, 'stokes': stokes, 'flagpar': flagpar,
+                           'iteration': iteration+1, 'flagged': flagged,
+                           'seconds': time.time() - start})
+            logger.log(logging.INFO, f"pgflag pass {stokes} ({iteration+1}/{repeats}) on {src}: "\
+                                     f"{flagged} flagged in {passes[-1]['seconds']:.1f}s")
+            if flagged == 0:
+                break
+
+    skipped = sum(r for _, _, r in PGFLAG_PLANS[role]) - len(passes)
+    logger.log(logging.INFO, f"pgflag {role} plan on {src}: {len(passes)} passes run, "\
+                             f"{skipped} repeats skipped")
+
+    return passes
 
 
 def calibrator_pgflag(src):
@@ -96,33 +930,9 @@ def calibrator_pgflag(src):
     Arguments:
         src {str} -- The filename of the data to flag
     """
-    primary = True if '1934-638' in src else False
+    role = 'primary' if primary in src else 'secondary'
 
-    if primary:
-        pgflag = m(f"pgflag vis={src} stokes=v flagpar=15,3,3,3,5,3 command='<' options=nodisp").run()
-        logger.log(logging.INFO, pgflag)
-        
-        pgflag = m(f"pgflag vis={src} stokes=q flagpar=15,3,3,3,5,3 command='<' options=nodisp").run()
-        logger.log(logging.INFO, pgflag)
-        
-        pgflag = m(f"pgflag vis={src} stokes=u flagpar=15,3,3,3,5,3 command='<' options=nodisp").run()
-        logger.log(logging.INFO, pgflag)
-        
-        pgflag = m(f"pgflag vis={src} stokes=i flagpar=15,3,3,3,5,3 command='<' options=nodisp").run()
-        logger.log(logging.INFO, pgflag)
-    
-    else:
-        pgflag = m(f"pgflag vis={src} stokes=i,q,u,v flagpar=10,1,1,3,5,3 command='<' options=nodisp").run()
-        logger.log(logging.INFO, pgflag)
-        
-        pgflag = m(f"pgflag vis={src} stokes=i,u flagpar=10,1,1,3,5,3 command='<' options=nodisp").run()
-        logger.log(logging.INFO, pgflag)
-        
-        pgflag = m(f"pgflag vis={src} stokes=i,q flagpar=10,1,1,3,5,3 command='<' options=nodisp").run()
-        logger.log(logging.INFO, pgflag)
-        
-        pgflag = m(f"pgflag vis={src} stokes=i flagpar=10,1,1,3,5,3 command='<' options=nodisp").run()
-        logger.log(logging.INFO, pgflag)  
+    return pgflag_plan(src, role)
 
 
 def mosaic_pgflag(src):
@@ -130,80 +940,71 @@ def mosaic_pgflag(src):
     called Do_Flag.csh on the ATCAGAMA wiki. For ease it is applied before uvsplit. 
     
     Arguments:
-        src {[type]} -- [description]
+        src {str} -- The filename of the data to flag
     """
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,q,u,v flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag)
-
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,q,u,v flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag) 
-
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,q flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag)
-
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,q flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag) 
+    return pgflag_plan(src, 'mosaic')
 
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,u flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag)
-
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,u flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag) 
-
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag)
-
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag) 
-    
 
 def mosaic_src_pgflag(src):
     """Thw flagging procedure applied to the source data. THis follows Minh's script
     called Do_Flag.csh on the ATCAGAMA wiki. For ease it is applied before uvsplit. 
-    Time convolution is turned off for the moment. 
+    Time convolution is turned off for the moment. The flagging engine is
+    selected by `RFI_ENGINE`.
     
     Arguments:
-        src {[type]} -- [description]
+        src {str} -- The filename of the data to flag
     """
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,q,u,v flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag)
+    return rfi_flag_plan(src, 'mosaic')
 
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,q,u,v flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag) 
 
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,q flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag)
+# Engine used to flag the pointings of a mosaic:
+# - 'pgflag' runs each pass of the plan as a pgflag call
+# - 'sumthreshold' runs the whole plan in memory with rfi_flagger.py (needs numpy)
+# - 'compare' runs pgflag, and logs how far the flags of rfi_flagger.py differ
+RFI_ENGINE = os.environ.get('GLASS_RFI_ENGINE', 'pgflag')
 
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,q flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag) 
+def rfi_flag_plan(src: str, role: str, engine: str=None):
+    """Run the flagging plan for a source role with the selected engine
 
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,u flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag)
+    Arguments:
+        src {str} -- The filename of the data to flag
+        role {str} -- Key of the plan to run in `PGFLAG_PLANS`
 
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i,u flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag) 
+    Keyword Arguments:
+        engine {str} -- Flagging engine. `RFI_ENGINE` if not given (default: {None})
 
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag)
+    Raises:
+        ValueError -- Raised if the engine is not known
 
-    pgflag = m(f"pgflag vis={src} command='<' stokes=i flagpar=10,1,0,3,5,3  "\
-               f"options=nodisp").run()
-    logger.log(logging.INFO, pgflag) 
+    Returns:
+        list -- A dict per pass, as from `pgflag_plan`
+    """
+    engine = RFI_ENGINE if engine is None else engine
+    if engine == 'pgflag':
+        return pgflag_plan(src, role)
+    if engine not in ('sumthreshold', 'compare'):
+        raise ValueError(f"Unknown RFI engine {engine}")
+
+    import rfi_flagger
+
+    start = time.time()
+    ours, passes = rfi_flagger.flag_plan(src, PGFLAG_PLANS[role], write=engine == 'sumthreshold')
+    logger.log(logging.INFO, f"sumthreshold {role} plan on {src}: {len(passes)} passes, "\
+                             f"{ours.mean():.1%} flagged in {time.time() - start:.1f}s")
+    if engine == 'sumthreshold':
+        return passes
+
+    passes = pgflag_plan(src, role)
+    uv = miriad_io.UVData(src)
+    diff = rfi_flagger.compare_flags(ours, uv.flagged)
+    uv.close()
+    logger.log(logging.INFO, f"Flags of {src}: pgflag {diff['theirs']:.2%}, sumthreshold "\
+                             f"{diff['ours']:.2%}, pgflag only {diff['theirs_only']:.2%}, "\
+                             f"sumthreshold only {diff['ours_only']:.2%}, "\
+                             f"agreement {diff['agreement']:.1%}")
+    passes.append({'vis': src, 'role': role, 'engine': 'compare', **diff})
+
+    return passes
 
 
 # -----------------------------------------------------------------------------
@@ -211,14 +1012,81 @@ def mosaic_src_pgflag(src):
 # -----------------------------------------------------------------------------
 # Common calibration utilities
 # -----------------------------------------------------------------------------
+GPAVER_PARAMS = 'interval=5 options=scalar'
+
+
+@lru_cache(maxsize=None)
+def miriad_revision(task: str):
+    """Return the revision of a miriad task as printed in its banner, i.e.
+    `1.18, 2016/05/09 03:06:18 UTC` for `uvsplit: Revision 1.18, 2016/05/09 03:06:18 UTC`.
+    The task is run without any keywords, so it exits straight after the banner.
+    
+    Arguments:
+        task {str} -- Name of the miriad task
+
+    Returns:
+        str -- The revision, or None if the task could not be run
+    """
+    try:
+        proc = sp.run([task], stdin=sp.DEVNULL, stdout=sp.PIPE, stderr=sp.STDOUT,
+                      universal_newlines=True, timeout=60)
+    except (OSError, sp.TimeoutExpired):
+        return None
+
+    match = re.search(rf"{task}: Revision (.+)", proc.stdout)
+
+    return match.group(1).strip() if match is not None else None
+
+
 def mosaic_src_calibration(src: str):
     """Apply any common calibration steps for each source file
     
     Arguments:
         src {str} -- uv source file of item to process
+
+    Returns:
+        MirTask -- The executed gpaver
+    """
+    return mir_run(f"gpaver vis={src} {GPAVER_PARAMS}")
+
+
+def _gain_stability(src: str):
+    """Stability of the gains of a source from `miriad_io.gain_stability`, or
+    None if numpy is not available or the gains can not be read
+    """
+    if miriad_io is None:
+        return None
+
+    try:
+        return miriad_io.gain_stability(src)
+    except (OSError, ValueError, KeyError) as e:
+        logger.log(logging.DEBUG, f"Could not read the gains of {src}: {e!r}")
+        return None
+
+
+def pointing_gpaver(src: str):
+    """Average the gains of a pointing of a mosaic, and log how stable they are
+    before and after averaging. Each pointing is its own task of the reduction
+    graph, so the gpaver of the pointings run side by side within its workers.
+
+    Arguments:
+        src {str} -- Pointing split from a mosaic
+
+    Returns:
+        dict -- The gain stability of the pointing `before` and `after`, as
+                from `miriad_io.gain_stability`, and the gpaver `returncode`
     """
-    gpaver = m(f"gpaver vis={src} interval=5 options=scalar").run()
-    logger.log(logging.INFO, gpaver)
+    before = _gain_stability(src)
+    returncode = mosaic_src_calibration(src).returncode
+    after = _gain_stability(src)
+
+    if before is not None and after is not None:
+        logger.log(logging.INFO, f"Gains of {src}: {before['nsols']} -> {after['nsols']} solutions, "\
+                                 f"amplitude scatter {before['amp_scatter'] or 0:.1%} -> "\
+                                 f"{after['amp_scatter'] or 0:.1%}, phase rms "\
+                                 f"{before['phase_rms'] or 0:.1f} -> {after['phase_rms'] or 0:.1f} deg")
+
+    return {'before': before, 'after': after, 'returncode': returncode}
 
 # -----------------------------------------------------------------------------
 
@@ -226,40 +1094,184 @@ def mosaic_src_calibration(src: str):
 # -----------------------------------------------------------------------------
 # Common plotting utilities
 # -----------------------------------------------------------------------------
-def run(a):
-    a.run()
+# Plots run in the background on a fixed set of threads for the life of the
+# process. Submitting blocks once PLOT_QUEUE plots are waiting, so a reduction
+# can not run far ahead of its plotting. The plots run as asyncio subprocesses
+# on one event loop (see `task_runner.py`), and their output is logged as it
+# is written.
+PLOT_WORKERS = 4
+PLOT_QUEUE = 32
+# Seconds a single plot may run for
+PLOT_TIMEOUT = 600
+# A reduce script gives one in PLOT_SHARE of its worker slots to the plot
+# service, and the rest to its task graph (see `split_workers`)
+PLOT_SHARE = 4
+
+
+def split_workers(workers: int):
+    """Split the worker slots of a reduce script (GLASS_WORKERS) between its task
+    graph and the plot service, so that the miriad tasks and plots running at
+    once stay within them. Each gets at least one slot.
+
+    Arguments:
+        workers {int} -- Worker slots of the script
+
+    Returns:
+        tuple -- Slots of the task graph and of the plot service
+    """
+    plots = max(1, workers // PLOT_SHARE)
+
+    return max(1, workers - plots), plots
+
+
+class PlotService:
+    """Background plotting shared by every reduction in a process
+    """
+    def __init__(self, workers: int=PLOT_WORKERS, queue_size: int=PLOT_QUEUE,
+                 timeout: float=PLOT_TIMEOUT):
+        """
+        Keyword Arguments:
+            workers {int} -- Number of plots to make at once (default: {PLOT_WORKERS})
+            queue_size {int} -- Number of plots that may wait for a worker (default: {PLOT_QUEUE})
+            timeout {float} -- Seconds a plot may run for (default: {PLOT_TIMEOUT})
+        """
+        self._loop = task_runner.BackgroundLoop(name='plot')
+        self._runner = task_runner.AsyncRunner(limit=max(1, workers), timeout=timeout)
+        self._slots = threading.BoundedSemaphore(max(1, workers) + queue_size)
+        self._lock = threading.Lock()
+        self.plots = []
+        self.failures = []
+        self.cancelled = 0
+
+    def submit(self, cmd: str):
+        """Queue a plotting task without waiting for it to run. The task keeps
+        the task tags of the caller.
+
+        Arguments:
+            cmd {str} -- Miriad plotting task and its keywords
+
+        Returns:
+            Future -- Resolves to the executed MirTask
+        """
+        self._slots.acquire()
+        future = self._loop.submit(self._plot(cmd, dict(_task_tags.get())))
+        future.add_done_callback(lambda f: self._slots.release())
+        with self._lock:
+            self.plots.append((task_keywords(cmd).get('vis'), future))
+
+        return future
+
+    async def _plot(self, cmd: str, tags: dict):
+        try:
+            task = await run_task_async(self._runner, cmd, tags=tags)
+        except asyncio.CancelledError:
+            with self._lock:
+                self.cancelled += 1
+            raise
+        except Exception as e:
+            task = None
+            logger.log(logging.ERROR, f"Plot could not be run: {cmd}: {e!r}")
+        if task is None or task.returncode != 0:
+            with self._lock:
+                self.failures.append(cmd)
+            if task is not None:
+                logger.log(logging.ERROR, f"Plot failed: {cmd}")
+
+        return task
+
+    def wait(self, srcs: list=None):
+        """Wait for the plots of a set of visibility files, or for every plot
+
+        Keyword Arguments:
+            srcs {list} -- Visibility files whose plots to wait for. All plots
+                           are waited for if not given (default: {None})
+        """
+        with self._lock:
+            futures = [f for vis, f in self.plots if srcs is None or vis in srcs]
+        wait(futures)
+
+    def cancel(self):
+        """Cancel every plot still waiting or running, i.e. once the reduction
+        of the day has failed. Running plots are stopped.
+        """
+        self._loop.cancel()
+
+    def close(self):
+        """Wait for every plot to finish and report any that failed
+        """
+        self.wait()
+        self._loop.close()
+        if len(self.plots) > 0:
+            logger.log(logging.INFO, f"{len(self.plots)} plots made, {len(self.failures)} failed"\
+                                     + (f", {self.cancelled} cancelled" if self.cancelled else ''))
+        for cmd in self.failures:
+            logger.log(logging.WARNING, f"Failed plot: {cmd}")
+        self.plots = []
+
+
+_plot_service = {'service': None, 'lock': threading.Lock()}
+
+def plot_service(workers: int=None):
+    """The plot service of this process, started on first use and closed at exit
+
+    Keyword Arguments:
+        workers {int} -- Number of plots to make at once, if the service is
+                         started by this call. PLOT_WORKERS if not given (default: {None})
+    """
+    with _plot_service['lock']:
+        if _plot_service['service'] is None:
+            _plot_service['service'] = PlotService(workers=workers or PLOT_WORKERS)
+            atexit.register(_plot_service['service'].close)
+
+        return _plot_service['service']
+
 
 def calibration_plots(primary: str, secondary: str, freq: str):
     """Common function to create calibration plots of the primary and
-    secondary visibility files
+    secondary visibility files. The plots are queued on the plot service
+    and made in the background.
     
     Arguments:
         primary {str} -- Filename of primary calibrator
         secondary {str} -- Filename of the secondary calibrator
         freq {str} -- Frequency of the IF
-    """
-    plt = [m(f'uvplt vis={primary} axis=time,amp options=nob,nof stokes=i device=primary_timeamp_{freq}.png/PNG'),
-            m(f'uvplt vis={primary} axis=re,im options=nob,nof,eq stokes=i,q,u,v device=primary_reim_{freq}.png/PNG'),
-            m(f'uvplt vis={primary} axis=uc,vc options=nob,nof stokes=i  device=primary_ucvc_{freq}.png/PNG'),
-            m(f'uvplt vis={primary} axis=FREQ,amp options=nob,nof stokes=i  device=primary_freqamp_{freq}.png/PNG'),
-            m(f'uvplt vis={secondary} axis=time,amp options=nob,nof stokes=i device=secondary_timeamp_{freq}.png/PNG'),
-            m(f'uvplt vis={secondary} axis=re,im options=nob,nof,eq stokes=i,q,u,v device=secondary_reim_{freq}.png/PNG'),
-            m(f'uvplt vis={secondary} axis=uc,vc options=nob,nof stokes=i  device=secondary_ucvc_{freq}.png/PNG'),
-            m(f'uvplt vis={secondary} axis=FREQ,amp options=nob,nof stokes=i device=secondary_freqamp_{freq}.png/PNG'),
-            m(f'uvfmeas vis={secondary} stokes=i log=secondary_uvfmeas_{freq}_log.txt device=secondary_uvfmeas_{freq}.png/PNG')]
-    pool = Pool(7)
-    result = pool.map(run, plt)
-    pool.close()
-    pool.join()
 
-
-def mosaic_src_plots(src: str):
-    """Common function to create plots for the sources
+    Returns:
+        list -- Futures of the queued plots
+    """
+    plt = [f'uvplt vis={primary} axis=time,amp options=nob,nof stokes=i device=primary_timeamp_{freq}.png/PNG',
+            f'uvplt vis={primary} axis=re,im options=nob,nof,eq stokes=i,q,u,v device=primary_reim_{freq}.png/PNG',
+            f'uvplt vis={primary} axis=uc,vc options=nob,nof stokes=i  device=primary_ucvc_{freq}.png/PNG',
+            f'uvplt vis={primary} axis=FREQ,amp options=nob,nof stokes=i  device=primary_freqamp_{freq}.png/PNG',
+            f'uvplt vis={secondary} axis=time,amp options=nob,nof stokes=i device=secondary_timeamp_{freq}.png/PNG',
+            f'uvplt vis={secondary} axis=re,im options=nob,nof,eq stokes=i,q,u,v device=secondary_reim_{freq}.png/PNG',
+            f'uvplt vis={secondary} axis=uc,vc options=nob,nof stokes=i  device=secondary_ucvc_{freq}.png/PNG',
+            f'uvplt vis={secondary} axis=FREQ,amp options=nob,nof stokes=i device=secondary_freqamp_{freq}.png/PNG',
+            f'uvfmeas vis={secondary} stokes=i log=secondary_uvfmeas_{freq}_log.txt device=secondary_uvfmeas_{freq}.png/PNG']
+
+    return [plot_service().submit(cmd) for cmd in plt]
+
+
+def mosaic_src_plots(src: str, freq: str):
+    """Common function to create plots for the sources. The source is plotted
+    once it has been moved into its `f{freq}_sources` folder, and the plots
+    are placed in `Src_Plots`. 
     
     Arguments:
         src {str} -- src to plots
+        freq {str} -- Frequency of the source
+
+    Returns:
+        list -- Futures of the queued plots
     """
-    return
+    folder = 'Src_Plots'
+    make_dir(folder)
+
+    vis = os.path.join(f"f{freq}_sources", src)
+    plt = [f'uvplt vis={vis} axis=time,amp options=nob,nof stokes=i device={folder}/{src}_timeamp.png/PNG',
+           f'uvplt vis={vis} axis=FREQ,amp options=nob,nof stokes=i device={folder}/{src}_freqamp.png/PNG']
+
+    return [plot_service().submit(cmd) for cmd in plt]
 
 
 # -----------------------------------------------------------------------------
@@ -275,16 +1287,27 @@ def mosaic_uvsplit(mosaic: str):
     Arguments:
         mosaic {str} -- Name of the mosaic file to split
     """
-    uvsplit = m(f"uvsplit vis={mosaic}").run()
-    logger.log(logging.INFO, uvsplit)
+    uvsplit = mir_run(f"uvsplit vis={mosaic}")
 
-    srcs = []
-    for line in str(uvsplit).splitlines():
-        if 'Creating' not in line:
-            continue
-        srcs.append(line.split()[1])
+    return parsed_output('uvsplit', uvsplit).get('created', [])
+
+def source_role(src: str):
+    """Return the role of a source in a GLASS observation, one of `primary`,
+    `secondary`, `target` or `ignore`. Unknown sources are assumed to be
+    mosaic targets. 
+    
+    Arguments:
+        src {str} -- Name of the source, without any frequency suffix
+    """
+    if src in primary_srcs:
+        return 'primary'
+    elif src in secondary_srcs:
+        return 'secondary'
+    elif src in ignore_srcs:
+        return 'ignore'
+
+    return 'target'
 
-    return srcs
 
 def derive_obs_sources(uvsplit, freq):
     """Return the objects that were observed in an observation, including
@@ -292,35 +1315,26 @@ def derive_obs_sources(uvsplit, freq):
     and the target sources.  
     
     Arguments:
-        uvsplit {mirstr} -- Executed mirstr with the uvsplit output
+        uvsplit {MirTask} -- Executed uvsplit
         freq {str} -- The frequency of the observing data. Used as hook
                       to get out a source from
     """
-    primary_srcs = ['1934-638']
-    secondary_srcs = ['2245-328', '2312-319', '2255-282','2244-372']
-    target_srcs = ['a','b','c','d','e','f']
-    ignore_srcs = ['2333-528','0823-500','0537-441','1921-293']
-
     freq = f"{freq}"
 
     primary = None
     secondary = None
     targets = []
 
-    for l in str(uvsplit).split():
-        if freq in l:
-            src = l.split('.')[0]
+    for created in parsed_output('uvsplit', uvsplit).get('created', []):
+        src, suffix = created.rsplit('.', 1) if '.' in created else (created, None)
+        if suffix == freq:
+            role = source_role(src)
             # 1934-628 should always be there
-            if src in primary_srcs:
+            if role == 'primary':
                 primary = f"{src}.{freq}"
-            elif src in secondary_srcs:
+            elif role == 'secondary':
                 secondary = f"{src}.{freq}"
-            elif src in target_srcs:
-                targets.append(f"{src}.{freq}")
-            elif src in ignore_srcs:
-                pass
-            else:
-                # Assume it is a mosaic source target
+            elif role == 'target':
                 targets.append(f"{src}.{freq}")
 
     if primary is None:
@@ -336,6 +1350,26 @@ def derive_obs_sources(uvsplit, freq):
         sys.exit(0)
 
     return primary, secondary, targets
+
+
+def group_pointings(srcs: list):
+    """Group pointings split straight out of the atlod output into their
+    mosaics. A pointing is named after its mosaic and its number in the mosaic,
+    i.e. `a_1.5500` is the first pointing of `a.5500`. A source without a
+    number is a mosaic of one pointing.
+
+    Arguments:
+        srcs {list} -- Pointings, with their frequency suffix
+
+    Returns:
+        dict -- Mapping of each mosaic to the list of its pointings
+    """
+    mosaics = {}
+    for src in srcs:
+        name, freq = src.rsplit('.', 1)
+        mosaics.setdefault(f"{name.rsplit('_', 1)[0]}.{freq}", []).append(src)
+
+    return mosaics
 # -----------------------------------------------------------------------------
 
 # -----------------------------------------------------------------------------
@@ -356,6 +1390,53 @@ def make_dir(directory: str):
             pass
 
 
+def move(src: str, folder: str):
+    """Move a file or miriad dataset into a folder. Safe to call again on a
+    rerun: a source that has already been moved is left alone, and an older 
+    copy in the folder is replaced. 
+    
+    Arguments:
+        src {str} -- File or dataset to move
+        folder {str} -- Folder to move it into
+    """
+    dest = os.path.join(folder, os.path.basename(src))
+    if not os.path.exists(src):
+        if os.path.exists(dest):
+            logger.log(logging.INFO, f"{src} already moved to {folder}")
+            return
+        raise FileNotFoundError(f"{src} does not exist")
+
+    make_dir(folder)
+    rm_uv(dest)
+    su.move(src, folder)
+
+
+def restore(src: str, folder: str):
+    """Move a file or dataset back out of a folder it was moved into, so that
+    a stage can be run against it again
+    
+    Arguments:
+        src {str} -- File or dataset to restore
+        folder {str} -- Folder the file was moved into
+    """
+    moved = os.path.join(folder, os.path.basename(src))
+    if not os.path.exists(src) and os.path.exists(moved):
+        logger.log(logging.INFO, f"Restoring {src} from {folder}")
+        su.move(moved, src)
+
+
+def rm_uv(path: str):
+    """Remove a file or miriad dataset if it exists
+    
+    Arguments:
+        path {str} -- File or dataset to remove
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        su.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
 def mv_srcs(srcs: list, freq: str):
     """Move sources into a consistent directory structure
 
@@ -371,7 +1452,7 @@ def mv_srcs(srcs: list, freq: str):
     
     make_dir(folder)
     for src in srcs:
-        su.move(src, folder)
+        move(src, folder)
 
 
 def mv_mosaic(mosaic: str):
@@ -384,19 +1465,20 @@ def mv_mosaic(mosaic: str):
     folder = f"uv_mosaic"
 
     make_dir(folder)
-    su.move(mosaic, folder)
+    move(mosaic, folder)
 
 
-def mv_data(data: str):
-    """Move the data uv file from atlod into place
+def mv_data(data):
+    """Move the data uv file(s) from atlod into place
     
     Arguments:
-        data {str} -- The data file from atlod
+        data {str,list} -- The data file, or list of files, from atlod
     """
     folder = f"uv_data"
 
     make_dir(folder)
-    su.move(data, folder)
+    for d in ([data] if isinstance(data, str) else data):
+        move(d, folder)
 
 
 def mv_calibrators(primary: str, secondary: str):
@@ -408,9 +1490,12 @@ def mv_calibrators(primary: str, secondary: str):
     """
     folder = "uv_calibrators"
 
+    # Plots of the calibrators read them in place
+    plot_service().wait([primary, secondary])
+
     make_dir(folder)
-    su.move(primary, folder)
-    su.move(secondary, folder)
+    move(primary, folder)
+    move(secondary, folder)
 
 
 def mv_plots(freq: str):
@@ -423,7 +1508,7 @@ def mv_plots(freq: str):
     make_dir(folder)
 
     for f in glob(f'*{freq}.png') + glob(f'*{freq}_log.txt'):
-        su.move(f, folder)
+        move(f, folder)
 
 
 def mv_uv(freq:str, old=False):
@@ -0,0 +1,472 @@
+"""Read-only access to the visibilities of a miriad uv dataset as numpy arrays.
+
+A miriad uv dataset is a folder of items. This reads three of them:
+- `vartable` names each uv variable and its type, one `<type> <name>` per line.
+  A variable's number is its line number.
+- `visdata` is a stream of variable updates. Each entry starts with a 4 byte
+  header (variable number, unused, entry type, unused). A VAR_SIZE entry gives
+  the length in bytes of the following values of a variable, a VAR_DATA entry
+  holds the values, aligned to the size of their type, and a VAR_EOR entry ends
+  a record, i.e. one spectrum of one baseline and polarisation. Every entry is
+  padded to an 8 byte boundary. Only variables that change are written, so the value of a
+  variable in a record is its most recent update.
+- `flags` holds a flag per channel per record, 31 to each big-endian 32 bit
+  integer after a 4 byte item header. A set bit marks good data.
+
+The antenna gains written by gpcal, gpcopy and gpaver are read too:
+- `header` holds the small items of a dataset, such as `ngains` and `nsols`.
+  Each is a 16 byte record of its name (15 bytes) and the length of its value,
+  followed by the value padded to 16 bytes. A value starts with a 4 byte type
+  header and is aligned to the size of its type.
+- `gains` holds `nsols` solutions after an 8 byte header, each the time of the
+  solution (a double) followed by `ngains` complex gains, `nfeeds + ntau` per
+  antenna. A gain of zero is flagged.
+
+The files are memory mapped, and only `write_flags` changes a dataset. When the spacing between the records is constant,
+as it is for data written in a single pass by atlod or uvsplit, the arrays are
+strided views of the mapping and nothing is copied. Otherwise the values are
+gathered into new arrays.
+
+    uv = UVData('uv_calibrators/2245-328.5500')
+    amp = np.ma.masked_array(np.abs(uv.data), uv.flagged)
+"""
+import os
+import mmap
+
+import numpy as np
+
+# Entry types of the visdata stream
+VAR_SIZE = 0
+VAR_DATA = 1
+VAR_EOR = 2
+
+UV_HDR_SIZE = 4
+UV_ALIGN = 8
+
+ITEM_HDR_SIZE = 4
+BITS_PER_INT = 31
+
+HEADER_ALIGN = 16
+GAINS_HDR_SIZE = 8
+
+# numpy type of each type code of an item
+ITEM_TYPES = {1: np.dtype('S1'), 2: np.dtype('>i4'), 3: np.dtype('>i2'), 4: np.dtype('>f4'),
+              5: np.dtype('>f8'), 7: np.dtype('>c8'), 8: np.dtype('>i8')}
+
+# numpy type of each miriad variable type
+VAR_TYPES = {'a': np.dtype('S1'), 'j': np.dtype('>i2'), 'i': np.dtype('>i4'),
+             'r': np.dtype('>f4'), 'd': np.dtype('>f8'), 'c': np.dtype('>c8')}
+
+# Variables whose location in each record is kept while scanning
+TRACKED = ['corr', 'wcorr', 'coord', 'time', 'baseline', 'pol', 'tscale', 'nschan', 'nspect',
+           'sfreq', 'sdf', 'ischan']
+
+
+def _roundup(offset: int, size: int):
+    return (offset + size - 1) // size * size
+
+
+def read_vartable(path: str):
+    """Names and types of the uv variables of a dataset
+
+    Arguments:
+        path {str} -- Miriad uv dataset
+
+    Returns:
+        list -- (name, type) of each variable, indexed by variable number
+    """
+    with open(os.path.join(path, 'vartable'), 'r') as infile:
+        return [tuple(reversed(l.split())) for l in infile if l.strip() != '']
+
+
+def _map(path: str):
+    """Memory map a file read-only. Empty files can not be mapped.
+    """
+    with open(path, 'rb') as infile:
+        if os.fstat(infile.fileno()).st_size == 0:
+            return b''
+        return mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+class UVData:
+    """The visibilities, flags and variables of a miriad uv dataset
+    """
+    def __init__(self, path: str, track: list=()):
+        """Map a dataset and locate the variables of each record
+
+        Arguments:
+            path {str} -- Miriad uv dataset
+
+        Keyword Arguments:
+            track {list} -- Further variables to locate in each record, so that
+                            they can be read with `variable` (default: {()})
+        """
+        self.path = path
+        self.vartable = read_vartable(path)
+        self.types = dict(self.vartable)
+        self._visdata = _map(os.path.join(path, 'visdata'))
+        self._tracked = [n for n in TRACKED + list(track) if n in self.types]
+        self._offsets, self._sizes = self._scan()
+
+    def __len__(self):
+        return len(self._offsets['eor'])
+
+    def _scan(self):
+        """Walk the visdata stream, recording the offset and size of the current
+        value of each tracked variable at the end of every record
+        """
+        buf = self._visdata
+        names = [name for name, _ in self.vartable]
+        index = {names.index(n): n for n in self._tracked}
+        current = {n: -1 for n in self._tracked}
+        size = {}
+        offsets = {n: [] for n in self._tracked + ['eor']}
+        sizes = {n: set() for n in self._tracked}
+
+        offset = 0
+        end = len(buf)
+        while offset + UV_HDR_SIZE <= end:
+            varnum, kind = buf[offset], buf[offset+2]
+            if kind == VAR_SIZE:
+                offset = _roundup(offset + UV_HDR_SIZE, 4)
+                size[varnum] = int.from_bytes(buf[offset:offset+4], 'big')
+                offset += 4
+            elif kind == VAR_DATA:
+                dtype = VAR_TYPES[self.vartable[varnum][1]]
+                offset = _roundup(offset + UV_HDR_SIZE, dtype.itemsize)
+                if varnum in index:
+                    current[index[varnum]] = offset
+                    sizes[index[varnum]].add(size[varnum])
+                offset += size[varnum]
+            elif kind == VAR_EOR:
+                offsets['eor'].append(offset)
+                for n in self._tracked:
+                    offsets[n].append(current[n])
+            else:
+                raise ValueError(f"Unknown entry type {kind} at offset {offset} of {self.path}/visdata")
+            # uvio pads every entry to UV_ALIGN
+            offset = _roundup(offset + (UV_HDR_SIZE if kind == VAR_EOR else 0), UV_ALIGN)
+
+        return {n: np.array(o, dtype=np.int64) for n, o in offsets.items()}, sizes
+
+    def _array(self, offsets: np.ndarray, count: int, dtype: np.dtype):
+        """Values of `count` elements at each offset. A strided view of the
+        mapping is returned if the offsets are evenly spaced, otherwise a copy.
+        """
+        if len(offsets) == 0:
+            return np.zeros((0, count), dtype=dtype)
+
+        steps = np.diff(offsets)
+        if len(steps) == 0 or np.all(steps == steps[0]) and steps[0] > 0:
+            stride = int(steps[0]) if len(steps) > 0 else count * dtype.itemsize
+            return np.ndarray(shape=(len(offsets), count), dtype=dtype, buffer=self._visdata,
+                              offset=int(offsets[0]), strides=(stride, dtype.itemsize))
+
+        raw = np.frombuffer(self._visdata, dtype=np.uint8)
+        gather = offsets[:, None] + np.arange(count * dtype.itemsize)
+
+        return raw[gather].view(dtype).reshape(len(offsets), count)
+
+    def variable(self, name: str):
+        """Value of a variable in every record
+
+        Arguments:
+            name {str} -- Name of a tracked variable
+
+        Raises:
+            ValueError -- Raised if the variable is missing from some records or
+                          changes length during the dataset
+
+        Returns:
+            np.ndarray -- Array of shape (records, elements)
+        """
+        if name not in self._offsets:
+            raise ValueError(f"{name} is not a tracked variable of {self.path}")
+        offsets = self._offsets[name]
+        if np.any(offsets < 0):
+            raise ValueError(f"{name} is not set in every record of {self.path}")
+        if len(self._sizes[name]) > 1:
+            raise ValueError(f"{name} changes length within {self.path}")
+
+        dtype = VAR_TYPES[self.types[name]]
+        count = next(iter(self._sizes[name]), 0) // dtype.itemsize
+
+        return self._array(offsets, count, dtype)
+
+    @property
+    def data(self):
+        """Complex visibilities, of shape (records, channels). Data stored as
+        scaled integers are converted, which makes a copy.
+        """
+        corr = self.variable('corr')
+        if self.types['corr'] == 'j':
+            scaled = corr.astype(np.float32) * self.variable('tscale')[:, :1]
+            return scaled[:, 0::2] + 1j * scaled[:, 1::2]
+        if self.types['corr'] == 'r':
+            return corr.view(VAR_TYPES['c'])
+
+        return corr
+
+    @property
+    def nchan(self):
+        itemsize = VAR_TYPES[self.types['corr']].itemsize
+        return next(iter(self._sizes['corr']), 0) // itemsize // (1 if self.types['corr'] == 'c' else 2)
+
+    @property
+    def time(self):
+        """Julian date of each record
+        """
+        return self.variable('time')[:, 0]
+
+    @property
+    def baseline(self):
+        """Miriad baseline number of each record, 256 * ant1 + ant2
+        """
+        return self.variable('baseline')[:, 0].astype(np.int32)
+
+    @property
+    def antennas(self):
+        """The two antennas of each record as a (records, 2) array
+        """
+        baseline = self.baseline
+        return np.stack([baseline // 256, baseline % 256], axis=1)
+
+    @property
+    def uvw(self):
+        """u, v and w (nanoseconds) of each record
+        """
+        return self.variable('coord')
+
+    @property
+    def pol(self):
+        """Polarisation code of each record
+        """
+        return self.variable('pol')[:, 0]
+
+    @property
+    def flagged(self):
+        """True where a channel of a record is flagged, of shape (records, channels)
+        """
+        return ~read_flags(self.path, len(self), self.nchan)
+
+    def frequencies(self):
+        """Sky frequency (GHz) of each channel of the first record, assuming a
+        single spectral window
+        """
+        sfreq = self.variable('sfreq')[0, 0]
+        sdf = self.variable('sdf')[0, 0]
+
+        return sfreq + sdf * np.arange(self.nchan)
+
+    def close(self):
+        """Unmap the visibilities. Arrays still viewing them keep the mapping
+        open until they are released.
+        """
+        if isinstance(self._visdata, mmap.mmap):
+            try:
+                self._visdata.close()
+            except BufferError:
+                pass
+
+
+def read_flags(path: str, nrec: int, nchan: int):
+    """The flags of a dataset, True for good data
+
+    Arguments:
+        path {str} -- Miriad uv dataset
+        nrec {int} -- Number of records
+        nchan {int} -- Number of channels in each record
+
+    Returns:
+        np.ndarray -- Boolean array of shape (records, channels). All data is
+                      good if the dataset has no flags item
+    """
+    flags_path = os.path.join(path, 'flags')
+    if not os.path.exists(flags_path) or nrec * nchan == 0:
+        return np.ones((nrec, nchan), dtype=bool)
+
+    ints = np.frombuffer(_map(flags_path), dtype='>i4', offset=ITEM_HDR_SIZE)
+    bits = (ints[:, None] >> np.arange(BITS_PER_INT)) & 1
+    bits = bits.ravel()[:nrec * nchan]
+    if len(bits) < nrec * nchan:
+        bits = np.concatenate([bits, np.ones(nrec * nchan - len(bits), dtype=bits.dtype)])
+
+    return bits.astype(bool).reshape(nrec, nchan)
+
+
+def write_flags(path: str, good: np.ndarray):
+    """Replace the flags item of a dataset. This is the only item this module
+    writes. The new item is written alongside and renamed into place.
+
+    Arguments:
+        path {str} -- Miriad uv dataset
+        good {np.ndarray} -- Boolean array of shape (records, channels), True
+                             for good data
+    """
+    flags_path = os.path.join(path, 'flags')
+    header = b'\0' * ITEM_HDR_SIZE
+    if os.path.exists(flags_path):
+        with open(flags_path, 'rb') as infile:
+            header = infile.read(ITEM_HDR_SIZE)
+
+    bits = good.ravel().astype(np.int64)
+    bits = np.concatenate([bits, np.zeros(-len(bits) % BITS_PER_INT, dtype=np.int64)])
+    ints = (bits.reshape(-1, BITS_PER_INT) << np.arange(BITS_PER_INT)).sum(axis=1)
+
+    tmp = f"{flags_path}.tmp"
+    with open(tmp, 'wb') as out:
+        out.write(header)
+        out.write(ints.astype('>i4').tobytes())
+    os.replace(tmp, flags_path)
+
+
+def read_header(path: str):
+    """The small items of a dataset kept in its `header` item
+
+    Arguments:
+        path {str} -- Miriad dataset
+
+    Raises:
+        ValueError -- The header item is not laid out as expected
+
+    Returns:
+        dict -- Value of each item. Numeric items holding one value are returned
+                as scalars and text items as strings
+    """
+    with open(os.path.join(path, 'header'), 'rb') as infile:
+        buf = infile.read()
+
+    items = {}
+    offset = 0
+    while offset + HEADER_ALIGN <= len(buf):
+        name = buf[offset:offset+HEADER_ALIGN-1].split(b'\0')[0].decode('ascii')
+        size = buf[offset+HEADER_ALIGN-1]
+        value = buf[offset+HEADER_ALIGN:offset+HEADER_ALIGN+size]
+        offset += HEADER_ALIGN + _roundup(size, HEADER_ALIGN)
+        if name == '':
+            continue
+
+        code = int.from_bytes(value[:ITEM_HDR_SIZE], 'big')
+        if code not in ITEM_TYPES or len(value) < ITEM_HDR_SIZE:
+            raise ValueError(f"Item {name} of {path}/header has unknown type {code}")
+        dtype = ITEM_TYPES[code]
+        data = value[_roundup(ITEM_HDR_SIZE, dtype.itemsize):]
+        if dtype.kind == 'S':
+            items[name] = data.decode('ascii', errors='replace')
+        else:
+            values = np.frombuffer(data[:len(data) // dtype.itemsize * dtype.itemsize], dtype=dtype)
+            items[name] = values[0].item() if len(values) == 1 else values
+
+    return items
+
+
+def read_gains(path: str):
+    """The antenna gain solutions of a dataset
+
+    Arguments:
+        path {str} -- Miriad uv dataset with a `gains` item
+
+    Raises:
+        ValueError -- The gains item does not match the size given in the header
+
+    Returns:
+        dict -- `time` of each solution (Julian day), `gains`, complex of shape
+                (solutions, antennas, nfeeds + ntau) with flagged gains masked,
+                `nfeeds` and the `interval` of the solutions (days)
+    """
+    header = read_header(path)
+    ngains, nsols = int(header['ngains']), int(header['nsols'])
+    per_antenna = int(header.get('nfeeds', 1)) + int(header.get('ntau', 0))
+
+    record = np.dtype([('time', '>f8'), ('gains', '>c8', (ngains,))])
+    buf = _map(os.path.join(path, 'gains'))
+    if len(buf) < GAINS_HDR_SIZE + nsols * record.itemsize:
+        raise ValueError(f"{path}/gains is too short for {nsols} solutions of {ngains} gains")
+
+    solutions = np.frombuffer(buf, dtype=record, count=nsols, offset=GAINS_HDR_SIZE)
+    gains = solutions['gains'].astype(np.complex64).reshape(nsols, -1, per_antenna)
+
+    return {'time': solutions['time'].astype(float),
+            'gains': np.ma.masked_equal(gains, 0),
+            'nfeeds': int(header.get('nfeeds', 1)),
+            'interval': header.get('interval')}
+
+
+def gain_stability(path: str):
+    """How stable the gains of a dataset are over its solutions. The scatter of
+    the amplitudes and phases of each antenna and feed is taken about their mean,
+    and the median over the antennas and feeds is reported.
+
+    Arguments:
+        path {str} -- Miriad uv dataset with a `gains` item
+
+    Returns:
+        dict -- Number of solutions `nsols`, the median fractional scatter of
+                the amplitudes `amp_scatter` and the median rms of the phases
+                `phase_rms` in degrees
+    """
+    solutions = read_gains(path)
+    # Delay terms, if any, follow the gains of the feeds
+    gains = solutions['gains'][..., :solutions['nfeeds']]
+    amp = np.abs(gains)
+    amp_scatter = amp.std(axis=0) / amp.mean(axis=0)
+
+    # Phases are taken about the direction of the mean gain to avoid wrapping
+    mean = gains.mean(axis=0)
+    phase = np.angle(gains.filled(1) * np.conj(mean.filled(1))[None])
+    phase = np.ma.masked_array(np.degrees(phase), gains.mask)
+    phase_rms = np.sqrt((phase ** 2).mean(axis=0))
+
+    def median(values):
+        values = np.ma.filled(values, np.nan)
+        values = values[np.isfinite(values)]
+        return float(np.median(values)) if values.size else None
+
+    return {'nsols': gains.shape[0], 'amp_scatter': median(amp_scatter),
+            'phase_rms': median(phase_rms)}
+
+
+def summary(path: str):
+    """Flag occupancy and amplitudes of a dataset by baseline and channel
+
+    Arguments:
+        path {str} -- Miriad uv dataset
+
+    Returns:
+        dict -- `flagged`, the overall flagged fraction, `channel_flagged`, the
+                flagged fraction of each channel, and for each baseline its
+                flagged fraction and the median amplitude of its good data
+    """
+    uv = UVData(path)
+    flagged = uv.flagged
+    amp = np.ma.masked_array(np.abs(uv.data), flagged)
+
+    baselines = {}
+    for baseline in np.unique(uv.baseline):
+        rows = uv.baseline == baseline
+        baselines[f"{baseline // 256}-{baseline % 256}"] = {
+            'flagged': float(flagged[rows].mean()),
+            'median_amp': float(np.ma.median(amp[rows])) if not amp[rows].mask.all() else None}
+
+    result = {'records': len(uv), 'nchan': uv.nchan,
+              'flagged': float(flagged.mean()) if flagged.size else 0.,
+              'channel_flagged': flagged.mean(axis=0).tolist() if flagged.size else [],
+              'baselines': baselines}
+    uv.close()
+
+    return result
+
+
+if __name__ == '__main__':
+    import sys
+
+    if len(sys.argv) == 1:
+        print(f'USAGE: {sys.argv[0]} vis [vis ...]')
+        sys.exit()
+
+    for vis in sys.argv[1:]:
+        s = summary(vis)
+        print(f"{vis}: {s['records']} records of {s['nchan']} channels, {s['flagged']:.1%} flagged")
+        for baseline, b in s['baselines'].items():
+            amp = f"{b['median_amp']:.3f}" if b['median_amp'] is not None else '-'
+            print(f"\t{baseline:<6} {b['flagged']:>7.1%} flagged, median amplitude {amp}")
@@ -0,0 +1,350 @@
+"""Parsers that turn the output of the miriad tasks used by the reduction into
+records, so that reports and schedulers can ask what a task did without
+searching the logs.
+
+`mir_utils.run_task` parses the output of every task with a parser here and
+adds the record as `parsed` to the task record written to
+`calibration_if*_tasks.jsonl` in the day folder. An executed `MirTask` has it
+as `parsed` too. Each record is a dict of plain values. A field that could
+not be found in the output is None (or empty for lists), so a change in the
+wording of a task degrades a record rather than failing the reduction.
+
+    python3 miriad_parsers.py Data/2016-11-08 --task gpcal
+
+prints the parsed records of the tasks of a day.
+"""
+import re
+import sys
+import glob
+import json
+import logging
+import argparse
+
+logger = logging.getLogger()
+
+# Parser of each miriad task, see `parser`
+PARSERS = {}
+
+_float = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[EeDd][-+]?\d+)?"
+
+
+def _floats(text: str):
+    """All numbers in a piece of text, including Fortran style exponents
+    """
+    return [float(v.replace('D', 'E').replace('d', 'e')) for v in re.findall(_float, text)]
+
+
+def parser(task: str):
+    """Register a function as the parser of the output of a miriad task
+
+    Arguments:
+        task {str} -- Name of the miriad task
+    """
+    def register(func):
+        PARSERS[task] = func
+        return func
+
+    return register
+
+
+def parse(task: str, output: str):
+    """Parse the output of a miriad task
+
+    Arguments:
+        task {str} -- Name of the miriad task
+        output {str} -- Output of the task
+
+    Returns:
+        dict -- The record of the task, or None if the task has no parser or
+                its output could not be parsed
+    """
+    if task not in PARSERS:
+        return None
+
+    try:
+        return PARSERS[task](output)
+    # A record is only ever extra information, so no parser may fail the task
+    except Exception as e:
+        logger.log(logging.DEBUG, f"Could not parse the output of {task}: {e!r}")
+        return None
+
+
+def _warnings(output: str):
+    return [l.strip() for l in output.splitlines() if re.match(r'\s*###', l)]
+
+
+# -----------------------------------------------------------------------------
+# Loading and splitting
+# -----------------------------------------------------------------------------
+
+_atlod_counts = re.compile(r'(number of [\w\s]+?)\s*[:=]\s*(\d+)\s*$', re.IGNORECASE)
+_atlod_source = re.compile(r'\bsource(?:\s+name)?\s*[:=]\s*(\S+)', re.IGNORECASE)
+
+
+@parser('atlod')
+def parse_atlod(output: str):
+    """Record of atlod
+
+    Returns:
+        dict -- `sources` named in the output, in order of appearance, and
+                `counts`, a mapping of each `Number of ...` line, i.e.
+                `number of records written`, to its value
+    """
+    sources, counts = [], {}
+    for line in output.splitlines():
+        match = _atlod_counts.search(line)
+        if match is not None:
+            counts[' '.join(match.group(1).lower().split())] = int(match.group(2))
+        match = _atlod_source.search(line)
+        if match is not None and match.group(1) not in sources:
+            sources.append(match.group(1))
+
+    return {'sources': sources, 'counts': counts, 'warnings': _warnings(output)}
+
+
+@parser('uvsplit')
+def parse_uvsplit(output: str):
+    """Record of uvsplit
+
+    Returns:
+        dict -- `created`, the files created, each once and in order
+    """
+    created = []
+    for line in output.splitlines():
+        tokens = line.split()
+        if len(tokens) >= 2 and tokens[0] == 'Creating' and tokens[1] not in created:
+            created.append(tokens[1])
+
+    return {'created': created, 'warnings': _warnings(output)}
+
+
+# -----------------------------------------------------------------------------
+# Flagging
+# -----------------------------------------------------------------------------
+
+# The flag summary miriad prints once the flags of a dataset are written:
+#
+#   Counts of correlations within selected channels
+#   channel     Originally  Currently
+#   Good:          4194304    4128768    Changed to bad:      65536
+#   Bad:                 0      65536
+#
+# Only this block is trusted for the number of newly flagged points. Other
+# lines that mention flagging may hold totals or thresholds.
+_pgflag_heading = re.compile(r'^\s*Counts of correlations within selected channels\s*$')
+_pgflag_good = re.compile(r'^\s*Good:\s+(\d+)\s+(\d+)\s+Changed to bad:\s+(\d+)\s*$')
+
+
+@parser('pgflag')
+def parse_pgflag(output: str):
+    """Record of pgflag, from its flag summary block. A block is only used if its
+    heading is followed by a `Good:` line of the exact layout, and the counts
+    of every block are summed.
+
+    Returns:
+        dict -- `flagged`, the number of newly flagged points, and `percent`,
+                the percentage of the good points that were newly flagged.
+                Both are None unless a summary was matched exactly
+    """
+    flagged, good = None, 0
+    lines = output.splitlines()
+    for i, line in enumerate(lines):
+        if _pgflag_heading.match(line) is None:
+            continue
+        # The Good: line follows the column headings
+        for following in lines[i+1:i+4]:
+            match = _pgflag_good.match(following)
+            if match is not None:
+                original, current, changed = (int(v) for v in match.groups())
+                if original - current != changed:
+                    raise ValueError(f"Inconsistent pgflag summary: {following.strip()}")
+                flagged = (flagged or 0) + changed
+                good += original
+                break
+
+    percent = 100. * flagged / good if flagged is not None and good > 0 else None
+
+    return {'flagged': flagged, 'percent': percent, 'warnings': _warnings(output)}
+
+
+# -----------------------------------------------------------------------------
+# Calibration
+# -----------------------------------------------------------------------------
+
+_intervals = re.compile(r'number of solution intervals\s*[:=]\s*(\d+)', re.IGNORECASE)
+_iteration = re.compile(r'\biter\s*=\s*(\d+)', re.IGNORECASE)
+_xyphase = re.compile(r'xy\s*-?\s*phase[^:=]*[:=](.*)', re.IGNORECASE)
+
+
+def _solver(output: str):
+    """Fields shared by the output of mfcal and gpcal
+    """
+    record = {'intervals': None, 'iterations': 0, 'converged': 0, 'failed': 0,
+              'warnings': _warnings(output)}
+    for line in output.splitlines():
+        lower = line.lower()
+        match = _intervals.search(line)
+        if match is not None:
+            record['intervals'] = int(match.group(1))
+        if _iteration.search(line) is not None:
+            record['iterations'] += 1
+        if 'failed to converge' in lower or 'not converge' in lower:
+            record['failed'] += 1
+        elif 'converged' in lower:
+            record['converged'] += 1
+
+    return record
+
+
+@parser('mfcal')
+def parse_mfcal(output: str):
+    """Record of mfcal
+
+    Returns:
+        dict -- The number of solution `intervals`, of `iterations`, and of
+                solutions that `converged` and `failed` to converge
+    """
+    return _solver(output)
+
+
+@parser('gpcal')
+def parse_gpcal(output: str):
+    """Record of gpcal
+
+    Returns:
+        dict -- As `parse_mfcal`, and the `xyphase` offset of each antenna in
+                degrees when solved for (options=xyvary)
+    """
+    record = _solver(output)
+    xyphase = []
+    lines = output.splitlines()
+    for i, line in enumerate(lines):
+        match = _xyphase.search(line)
+        if match is None:
+            continue
+        values = _floats(match.group(1))
+        # The offsets may start on the line after the heading
+        if len(values) == 0 and i + 1 < len(lines):
+            values = _floats(lines[i + 1])
+        xyphase += values
+    record['xyphase'] = xyphase
+
+    return record
+
+
+# The factor follows `by`, `factor` or a colon, so that i.e. `scale factor
+# to the gains of 1934-638` is not read as a factor of 1934
+_scale = re.compile(rf"scal(?:ed|ing|e)\b[^:=\d]*?(?:\b(?:by|factor)\b\s*[:=]?|[:=])"
+                    rf"\s*({_float})", re.IGNORECASE)
+
+
+@parser('gpboot')
+def parse_gpboot(output: str):
+    """Record of gpboot
+
+    Returns:
+        dict -- `scale`, the factor the gains of the secondary were scaled by
+    """
+    scales = [_floats(m.group(1))[0] for m in _scale.finditer(output)]
+
+    return {'scale': scales[-1] if scales else None, 'warnings': _warnings(output)}
+
+
+@parser('mfboot')
+def parse_mfboot(output: str):
+    """Record of mfboot
+
+    Returns:
+        dict -- `scale`, the factor the gains were scaled by
+    """
+    return parse_gpboot(output)
+
+
+# -----------------------------------------------------------------------------
+# Flux density
+# -----------------------------------------------------------------------------
+
+@parser('uvfmeas')
+def parse_uvfmeas(text: str, log: str=None):
+    """Read the fit from the output of uvfmeas, and its spectrum from its log.
+    Recognised on the output are the `Coeff:` line with the coefficients of the
+    polynomial fit, the `MFCAL` line with the model in the order of the mfcal
+    flux keyword (flux density, reference frequency, spectral index) and an
+    `Alpha` line. The spectrum is only read from the table of frequency and
+    amplitude (and error) rows of the log, as the output may repeat it.
+
+    Arguments:
+        text {str} -- uvfmeas output
+
+    Keyword Arguments:
+        log {str} -- uvfmeas log. Without it there is no spectrum (default: {None})
+
+    Returns:
+        dict -- `flux` (Jy), `ref_freq` (GHz), `alpha`, `coeffs` and the
+                `fmin`, `fmax` and `npoints` of the spectrum. Anything not found
+                is None
+    """
+    fit = {'flux': None, 'ref_freq': None, 'alpha': None, 'coeffs': None,
+           'fmin': None, 'fmax': None, 'npoints': 0}
+    for line in text.splitlines():
+        key = line.strip().lower()
+        if key.startswith('coeff'):
+            fit['coeffs'] = _floats(line.split(':', 1)[-1])
+        elif key.startswith('mfcal'):
+            values = _floats(line.split(':', 1)[-1])
+            if len(values) >= 3:
+                fit['flux'], fit['ref_freq'], fit['alpha'] = values[:3]
+        elif key.startswith('alpha') and fit['alpha'] is None:
+            values = _floats(line.split(':', 1)[-1].split('=', 1)[-1])
+            fit['alpha'] = values[0] if values else None
+
+    freqs = []
+    for line in (log or '').splitlines():
+        tokens = line.split()
+        if len(tokens) in (2, 3) and all(re.fullmatch(_float, t) for t in tokens):
+            freqs.append(_floats(tokens[0])[0])
+
+    if freqs:
+        fit.update(fmin=min(freqs), fmax=max(freqs), npoints=len(freqs))
+
+    return fit
+
+# -----------------------------------------------------------------------------
+
+
+def read_records(day: str, task: str=None):
+    """Parsed records of the tasks of a day, from its task logs
+
+    Arguments:
+        day {str} -- Folder of the day
+
+    Keyword Arguments:
+        task {str} -- Only return the records of this task (default: {None})
+
+    Returns:
+        list -- Task records with a `parsed` record
+    """
+    records = []
+    for path in sorted(glob.glob(f"{day}/calibration_if*_tasks.jsonl")):
+        with open(path, 'r') as infile:
+            for line in infile:
+                if line.strip() == '':
+                    continue
+                record = json.loads(line)
+                if record.get('parsed') is not None and task in (None, record['task']):
+                    records.append(record)
+
+    return records
+
+
+if __name__ == '__main__':
+    arg_parser = argparse.ArgumentParser(description='Print the parsed records of the tasks of a day')
+    arg_parser.add_argument('day', help='Folder of the day')
+    arg_parser.add_argument('--task', help='Only print the records of this task, i.e. gpcal')
+    args = arg_parser.parse_args()
+
+    records = read_records(args.day, task=args.task)
+    for record in records:
+        print(f"{record['task']:<8} {record.get('source', ''):<24} {json.dumps(record['parsed'])}")
+
+    sys.exit(0 if records else 1)
@@ -1,81 +1,270 @@
-"""Helper script to create a new day of ATCA observing data given a 
-set of rpfits files. It will attempt to create the appropriate 
-directory structure, move files into place and copy a set of 
-reduction scripts specific to that day. Logic is also implemented to
-rename the junk files often create when a user sets up the telescope
-"""
+"""Helper script to create new days of ATCA observing data given a
+set of rpfits files. The files are grouped into days by the start time of
+their first scan, and each day gets the appropriate directory structure,
+its files moved (or copied) into place and a set of reduction scripts
+specific to that day. Logic is also implemented to rename the junk files
+often created when a user sets up the telescope.
+
+    python3 new_day.py /transfer/2016-11-*.C3132 /transfer/2016-11-08_0325.C3132_setup
 
+Files are moved side by side. A move within a filesystem is a rename; across
+filesystems each file is copied, checksummed and only then removed. Each new
+day is registered in the catalogue (see `catalogue.py`) as pending, for
+`run_calibrations.py --pending` to pick up.
+"""
 import os
+import re
 import sys
+import argparse
 import shutil as su
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+
+import catalogue
+import rpfits
+import staging
+from run_calibrations import positive_int
+
+REPO = os.path.dirname(os.path.realpath(__file__))
+DATA = os.path.join(REPO, 'Data')
+
+# Shared modules each day links to rather than copies
+REFERENCE_MODULES = ['mir_utils.py', 'task_graph.py', 'reduction.py', 'checkpoint.py', 'rpfits.py',
+                     'miriad_io.py', 'rfi_flagger.py', 'catalogue.py', 'staging.py',
+                     'miriad_parsers.py', 'task_runner.py']
+# Scripts each day gets its own copy of, to hold any day specific steps
+REFERENCE_SCRIPTS = ['reduce_5.py', 'reduce_9.py', 'reduce_both.py']
+
+FREQS = ['5500', '9500']
+# Files starting more than this many hours after the previous one start a new day
+GAP_HOURS = 6
+WORKERS = 8
+
+RPFITS_NAME = re.compile(r"\d{4}-\d{2}-\d{2}_\d{4}\.C\d{4}")
+
 
 def add_reference_scripts(dest: str):
-    """Add required reference scripts to the `dest` path
-    
+    """Add required reference scripts to the `dest` path. Scripts already in
+    place are left alone, as they may have been edited for the day.
+
     Arguments:
         dest {str} -- Path to a day of data
     """
     print(f'Copying reference scripts to {dest}')
-    print('\treduce_5.py')
-    su.copyfile('../../reduce_5.py', f'{dest}/reduce_5.py')
-    
-    print('\treduce_9.py')
-    su.copyfile('../../reduce_9.py', f'{dest}/reduce_9.py')
-    
-    print('Linking to mir_utils.py')
-    os.symlink('../../mir_utils.py', f'{dest}/mir_utils.py')
-
-
-def process_files(files: list):
-    """Create a new day of ATCA data given a set of files
-    
+    for script in REFERENCE_SCRIPTS:
+        if not os.path.exists(f'{dest}/{script}'):
+            print(f'\t{script}')
+            su.copyfile(os.path.join(REPO, script), f'{dest}/{script}')
+
+    for module in REFERENCE_MODULES:
+        if not os.path.lexists(f'{dest}/{module}'):
+            print(f'Linking to {module}')
+            os.symlink(os.path.relpath(os.path.join(REPO, module), dest), f'{dest}/{module}')
+
+
+def resolve(arg: str):
+    """Find the file to move for a command line argument. An argument that does
+    not exist but starts with the name of an RPFITS file that does, i.e.
+    `2016-11-08_0325.C3132_setup`, moves that file under the new name. This is
+    useful to nicely set aside ATCA data with set up data.
+
     Arguments:
-        files {list} -- RPFITS files to manage
+        arg {str} -- Path given on the command line
+
+    Raises:
+        FileNotFoundError -- Neither the file nor the file it renames exists
+
+    Returns:
+        tuple -- Path of the file to move and its name in the day
     """
-    sorted(files)
-    print(files)
-    
-    # Get folder name
-    date = files[0].split('_')[0]
-    date_path = f'../{date}'
-    path = f'{date_path}/raw'
-
-    if not os.path.exists(path):
-        os.makedirs(path)
-    else:
-        print(f'{date} folder exists at {path}. Exiting...')
-        sys.exit(0)
-    
-    for f in files:
-        dest = f"{path}/{f}"
-
-        # User added new junk name.
-        if len(f) > 21:
-            f = f[:21]
-
-        # Move into place
-        print(f"Moving {f} to {dest}")
-        su.move(f, dest)
-
-    # Copy across required daily scripts
-    add_reference_scripts(date_path)
+    name = os.path.basename(arg)
+    if os.path.exists(arg):
+        return arg, name
+
+    match = RPFITS_NAME.match(name)
+    if match is not None:
+        src = os.path.join(os.path.dirname(arg), match.group(0))
+        if os.path.exists(src):
+            return src, name
+
+    raise FileNotFoundError(f"{arg} does not exist")
+
+
+def start_time(path: str, name: str=None):
+    """Start of the first scan of an RPFITS file, falling back to the time in
+    its name if the header can not be read
+
+    Arguments:
+        path {str} -- RPFITS file
+
+    Keyword Arguments:
+        name {str} -- Name of the file, if not that of `path` (default: {None})
+
+    Returns:
+        datetime -- Start of the file in UT
+    """
+    scans = rpfits.scan_file(path, max_scans=1)
+    if len(scans) > 0 and scans[0]['date'] and scans[0]['ut'] is not None:
+        try:
+            day = datetime.strptime(scans[0]['date'][:10], '%Y-%m-%d')
+            return day + timedelta(seconds=scans[0]['ut'])
+        except ValueError:
+            pass
+
+    match = RPFITS_NAME.match(name or os.path.basename(path))
+    if match is None:
+        raise ValueError(f"Can not find the start time of {path}")
+
+    return datetime.strptime(match.group(0)[:15], '%Y-%m-%d_%H%M')
+
+
+def group_days(files: list, gap: float=GAP_HOURS):
+    """Group files into days of observing. Files are ordered by their start
+    time and a new day starts after a gap of more than `gap` hours, so a day
+    that runs past midnight UT stays together. Each day is named after the
+    date its first file starts on.
+
+    Arguments:
+        files {list} -- Tuples of the path of each file and its name in the day
+
+    Keyword Arguments:
+        gap {float} -- Gap in hours that separates days (default: {GAP_HOURS})
+
+    Returns:
+        dict -- Mapping of the name of each day to its list of files
+    """
+    starts = sorted((start_time(src, name), src, name) for src, name in files)
+
+    days = {}
+    previous = None
+    for start, src, name in starts:
+        if previous is None or start - previous > timedelta(hours=gap):
+            day = days.setdefault(start.strftime('%Y-%m-%d'), [])
+        day.append((src, name))
+        previous = start
+
+    return days
+
+
+def transfer(src: str, dest: str, copy: bool=False):
+    """Move or copy a file into a day. A file already in place with the same
+    size and checksum is skipped.
+
+    Arguments:
+        src {str} -- File to move
+        dest {str} -- Path in the day
+
+    Keyword Arguments:
+        copy {bool} -- Leave the original in place (default: {False})
+
+    Raises:
+        FileExistsError -- A different file is already at `dest`
+        OSError -- The copy does not match the original
+
+    Returns:
+        str -- `exists`, `moved` or `copied`
+    """
+    size = os.path.getsize(src)
+    if os.path.exists(dest):
+        if os.path.getsize(dest) != size or staging.checksum(dest) != staging.checksum(src):
+            raise FileExistsError(f"{dest} exists and differs from {src}")
+        return 'exists'
+
+    if not copy and os.stat(src).st_dev == os.stat(os.path.dirname(dest)).st_dev:
+        os.rename(src, dest)
+        return 'moved'
+
+    # Checksummed on both ends
+    staging.copy_file(src, dest)
+    if os.path.getsize(dest) != size:
+        raise OSError(f"{dest} is not the same size as {src}")
+    if not copy:
+        os.remove(src)
+        return 'moved'
+
+    return 'copied'
+
+
+def register_day(path: str):
+    """Register the IFs of a day as pending in the catalogue. IFs already in the
+    catalogue keep their status, so adding files to a day that has been
+    reduced does not queue it again.
+
+    Arguments:
+        path {str} -- Folder of the day
+    """
+    day = os.path.basename(path)
+    known = {d['freq']: d['status'] for d in catalogue.days(day=day)}
+    for freq in FREQS:
+        if freq in known:
+            print(f"{day} {freq} is already in the catalogue as {known[freq]}, leaving it")
+        else:
+            catalogue.record_day(day, freq, 'pending', path=path)
+
+
+def ingest(files: list, data: str=DATA, copy: bool=False, workers: int=WORKERS,
+           gap: float=GAP_HOURS, register: bool=True):
+    """Create days of data from a set of RPFITS files
+
+    Arguments:
+        files {list} -- Tuples of the path of each file and its name in the day
+
+    Keyword Arguments:
+        data {str} -- Folder holding the days (default: {DATA})
+        copy {bool} -- Copy rather than move the files (default: {False})
+        workers {int} -- Number of files moved at once (default: {WORKERS})
+        gap {float} -- Gap in hours that separates days (default: {GAP_HOURS})
+        register {bool} -- Register each day that is not yet in the catalogue as
+                           pending (default: {True})
+
+    Returns:
+        dict -- Mapping of the path of each day to its list of files
+    """
+    days = {os.path.join(data, day): day_files for day, day_files in group_days(files, gap).items()}
+
+    moves = []
+    for path, day_files in days.items():
+        os.makedirs(f'{path}/raw', exist_ok=True)
+        moves += [(src, f'{path}/raw/{name}') for src, name in day_files]
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for (src, dest), status in zip(moves, pool.map(lambda m: transfer(*m, copy=copy), moves)):
+            print(f"{status.capitalize():<7} {src} to {dest}")
+
+    for path in days:
+        # Copy across required daily scripts
+        add_reference_scripts(path)
+        if register:
+            register_day(path)
+
+    return days
 
 
 if __name__ == '__main__':
-    if len(sys.argv) == 1:
-        print(f'USAGE: {sys.argv[0]} rpfits [rpfits ...]')
-        sys.exit()
+    parser = argparse.ArgumentParser(description='Create days of data from RPFITS files',
+                                     epilog='A file given with a suffix after its name, i.e. '\
+                                            '2016-11-08_0325.C3132_setup, is moved under that name')
+    parser.add_argument('files', nargs='+', help='RPFITS files, from one or more days')
+    parser.add_argument('--data', default=DATA, help=f'Folder holding the days (default {DATA})')
+    parser.add_argument('--copy', action='store_true', help='Copy rather than move the files')
+    parser.add_argument('--workers', type=positive_int, default=WORKERS,
+                        help=f'Number of files moved at once (default {WORKERS})')
+    parser.add_argument('--gap', type=float, default=GAP_HOURS,
+                        help=f'Hours between files that start a new day (default {GAP_HOURS})')
+    parser.add_argument('--no-register', action='store_true',
+                        help='Do not register the days in the catalogue for reduction')
+    parser.add_argument('--dry-run', action='store_true',
+                        help='Only print how the files would be grouped into days')
+    args = parser.parse_args()
+
+    files = [resolve(f) for f in args.files]
 
-    elif sys.argv[1] in ['-h', '--help']:
-        print(f'Call the {sys.argv[0]} script and pass in the rpfits files'\
-            f' that would form a day. The date of the folder to create is'\
-            f' is derived from the date of the first rpfits after being sorted.'\
-            f' If you specify some suffix after an underscore (_) the script'\
-            f' will move the correct rpfits file to that file name. This is useful'
-            f' to nicely set aside ATCA data with set up data. \n\nNo options are required '\
-            f' or implemented other then this help message.')
+    if args.dry_run:
+        for day, day_files in group_days(files, args.gap).items():
+            print(day)
+            for src, name in day_files:
+                print(f"\t{src}" + (f" as {name}" if name != os.path.basename(src) else ''))
         sys.exit()
 
-    else:
-        files = sys.argv[1:]
-        process_files(files)
\ No newline at end of file
+    ingest(files, data=args.data, copy=args.copy, workers=args.workers, gap=args.gap,
+           register=not args.no_register)
@@ -1,12 +1,12 @@
 """Script to reduce 5.5GHz data from GLASS
 """
 import mir_utils as mu
-from pymir import mirstr as m
-from multiprocessing import Pool
+import reduction
+import staging
+from task_graph import TaskGraph
 from glob import glob
 import logging
 import os
-import shutil as su
 
 logging.basicConfig(
     format="%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s",
@@ -18,92 +18,46 @@ logging.basicConfig(
 
 logger = logging.getLogger()
 
-def run(a):
-    a.run()
-    # logger.log(logging.INFO, a)
+# Timing and resource usage of every miriad task
+mu.set_task_log("calibration_if1_5500_tasks.jsonl")
 
 NFBIN = 4
+# Choose the solution interval, and nfbin up to NFBIN, from the calibrator
+# scans and flags. run_calibrations.py --autotune sets GLASS_AUTOTUNE
+AUTOTUNE = os.environ.get('GLASS_AUTOTUNE', '0') == '1'
+# run_calibrations.py sets GLASS_WORKERS to share the node between days
+WORKERS = int(os.environ.get('GLASS_WORKERS', 8))
+# The plots made in the background take a share of the workers
+GRAPH_WORKERS, PLOT_WORKERS = mu.split_workers(WORKERS)
 FREQ = 5500
+IFSEL = 1
 
-# Load in files assuming the setup file/s have been renamed or deleted
-files = glob('raw/*C3132')
+# Run in a copy of the day on local scratch disk if GLASS_SCRATCH is set
+with staging.staged(freqs=[FREQ]) as checkpoints:
+    # Load in files assuming the setup file/s have been renamed or deleted
+    files = glob('raw/*C3132')
 
-# Example loading in files assuming first is setup
-# files = glob('raw/*C3132').pop(0)
+    # Example loading in files assuming first is setup
+    # files = glob('raw/*C3132').pop(0)
 
-# Glob order is not the same as sort order
-# Can lead to problems with 0 and 9s. 
-files = sorted(files)
+    # Glob order is not the same as sort order
+    # Can lead to problems with 0 and 9s. 
+    files = sorted(files)
 
-# Load in data. Remember to set ifsel appropriately
-atlod = m(f"atlod in={','.join(files)} out=data5.uv ifsel=1 options=birdie,rfiflag,noauto,xycorr").run()
-logger.log(logging.INFO, atlod)
+    mu.plot_service(workers=PLOT_WORKERS)
+    # Stop the miriad tasks still running once a task has failed
+    graph = TaskGraph(workers=GRAPH_WORKERS, on_failure=mu.terminate_tasks)
 
-# Flag out known bad channels
-mu.uvflag(atlod.out, mu.flags_5)
+    # Any day specific tasks can be added to the graph before it is run
+    reduction.add_if_reduction(graph, FREQ, IFSEL, files, mu.flags_5,
+                               nfbin=NFBIN, autotune=AUTOTUNE, checkpoints=checkpoints)
 
-uvsplit = m(f"uvsplit vis={atlod.out} options=mosaic").run()
-logger.log(logging.INFO, uvsplit)
+    try:
+        graph.run()
+    except BaseException:
+        # Stop the plots still waiting or running rather than wait for them
+        mu.plot_service().cancel()
+        raise
 
-# Deduce the objects in the observing run
-srcs = mu.derive_obs_sources(uvsplit, FREQ)
-primary, secondary, mosaic_targets = srcs
-
-mu.calibrator_pgflag(primary)
-
-mfcal = m(f"mfcal vis={primary} refant=4 interval=0.1").run()
-logger.log(logging.INFO, mfcal)
-
-gpcal = m(f"gpcal vis={primary} refant=4 interval=0.1 nfbin={NFBIN} options=xyvary").run()
-logger.log(logging.INFO, gpcal)
-
-mu.calibrator_pgflag(primary)
-
-mfcal = m(f"mfcal vis={primary} refant=4 interval=0.1").run()
-logger.log(logging.INFO, mfcal)
-
-gpcal = m(f"gpcal vis={primary} refant=4 interval=0.1 nfbin={NFBIN} options=xyvary").run()
-logger.log(logging.INFO, gpcal)
-
-gpcopy = m(f"gpcopy vis={primary} out={secondary}").run()
-logger.log(logging.INFO, gpcopy)
-
-mu.calibrator_pgflag(secondary)
-
-gpcal = m(f"gpcal vis={secondary} refant=4 interval=0.1 nfbin={NFBIN} options=xyvary,qusolve").run()
-logger.log(logging.INFO, gpcal)
-
-mu.calibrator_pgflag(secondary)
-
-gpcal = m(f"gpcal vis={secondary} refant=4 interval=0.1 nfbin={NFBIN} options=xyvary,qusolve").run()
-logger.log(logging.INFO, gpcal)
-
-gpboot = m(f"gpboot vis={secondary} cal={primary}").run()
-logger.log(logging.INFO, gpboot)
-
-mfboot = m(f"mfboot vis={primary},{secondary} select=source(1934-638) device=mfboot_{FREQ}.png/png").run()
-logger.log(logging.INFO, mfboot)
-
-mu.calibration_plots(primary, secondary, FREQ)
-
-for mosaic in mosaic_targets:
-
-    gpcopy = m(f"gpcopy vis={secondary} out={mosaic}").run()
-    logger.log(logging.INFO, gpcopy)
-
-    srcs = mu.mosaic_uvsplit(mosaic)
-
-    for src in srcs:
-        mu.mosaic_src_calibration(src)
-
-        mu.mosaic_src_pgflag(src)
-
-        mu.mosaic_src_plots(src)
-
-    mu.mv_srcs(srcs, FREQ)
-    mu.mv_mosaic(mosaic)
-
-
-mu.mv_calibrators(primary, secondary)
-mu.mv_data(atlod.out)
-mu.mv_plots(FREQ)
+    # Wait for the plots still being made in the background
+    mu.plot_service().close()
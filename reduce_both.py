@@ -0,0 +1,62 @@
+"""Script to reduce both the 5.5GHz and 9.5GHz data from GLASS, reading
+the RPFITS files only once
+"""
+import mir_utils as mu
+import reduction
+import staging
+from task_graph import TaskGraph
+from glob import glob
+import logging
+import os
+
+logging.basicConfig(
+    format="%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s",
+    level=logging.INFO,
+    handlers=[
+        logging.FileHandler("calibration_if12_both.log", mode='w'),
+        logging.StreamHandler()
+    ])
+
+logger = logging.getLogger()
+
+# Timing and resource usage of every miriad task
+mu.set_task_log("calibration_if12_both_tasks.jsonl")
+
+NFBIN = 4
+# Choose the solution interval, and nfbin up to NFBIN, from the calibrator
+# scans and flags. run_calibrations.py --autotune sets GLASS_AUTOTUNE
+AUTOTUNE = os.environ.get('GLASS_AUTOTUNE', '0') == '1'
+# run_calibrations.py sets GLASS_WORKERS to share the node between days
+WORKERS = int(os.environ.get('GLASS_WORKERS', 8))
+# The plots made in the background take a share of the workers
+GRAPH_WORKERS, PLOT_WORKERS = mu.split_workers(WORKERS)
+# The spectral window of each IF and its known bad channels
+IFS = {5500: {'ifsel': 1, 'flags': mu.flags_5},
+       9500: {'ifsel': 2, 'flags': mu.flags_9}}
+
+# Run in a copy of the day on local scratch disk if GLASS_SCRATCH is set
+with staging.staged(freqs=list(IFS)) as checkpoints:
+    # Load in files assuming the setup file/s have been renamed or deleted
+    files = glob('raw/*C3132')
+
+    # Glob order is not the same as sort order
+    # Can lead to problems with 0 and 9s.
+    files = sorted(files)
+
+    mu.plot_service(workers=PLOT_WORKERS)
+    # Stop the miriad tasks still running once a task has failed
+    graph = TaskGraph(workers=GRAPH_WORKERS, on_failure=mu.terminate_tasks)
+
+    # Any day specific tasks can be added to the graph before it is run
+    reduction.add_dual_if_reduction(graph, IFS, files, nfbin=NFBIN, autotune=AUTOTUNE,
+                                   checkpoints=checkpoints)
+
+    try:
+        graph.run()
+    except BaseException:
+        # Stop the plots still waiting or running rather than wait for them
+        mu.plot_service().cancel()
+        raise
+
+    # Wait for the plots still being made in the background
+    mu.plot_service().close()
@@ -0,0 +1,720 @@
+"""The calibration of an ATCA CABB IF of GLASS data, expressed as tasks of a
+`task_graph.TaskGraph`.
+
+reduce_5.py and reduce_9.py configure and run this for their IF. Both IFs may
+be added to the same graph, in which case they share the one pool of workers.
+reduce_both.py instead uses `add_dual_if_reduction`, which reads the RPFITS
+files once for both IFs and then calibrates each IF from the same graph.
+Day specific steps can be added to the graph by the scripts before it is run.
+
+The reduction is split into checkpointed stages (see `checkpoint.py`):
+- `calibrate_<freq>` loads, flags and splits the data and calibrates the primary
+  and secondary. Only the RPFITS files holding wanted sources in the IF are
+  loaded (see `rpfits.py`), each by its own atlod, and the parts are flagged and
+  split together. It modifies its outputs in place, so it is only ever run as a
+  whole from atlod.
+- `mosaic_<mosaic>` copies the solutions to a mosaic, splits it into pointings
+  and calibrates and flags each pointing. With GLASS_DIRECT_SPLIT=1 the
+  initial uvsplit writes the pointings themselves, and the solutions are
+  copied to each pointing instead (see `DIRECT_SPLIT`). A mosaic stage that
+  is out of date then runs the `calibrate_<freq>` stage again too.
+The solution interval and nfbin of the calibrators are fixed, or chosen for
+the day with `autotune` (see `tune_solutions`).
+A rerun skips any stage whose inputs have not changed since it last finished.
+The calibrators and pointings are recorded in the catalogue (see
+`catalogue.py`) once they are in place.
+"""
+from functools import partial
+from glob import glob
+import statistics
+import logging
+import sqlite3
+import json
+import os
+
+import catalogue
+import mir_utils as mu
+import rpfits
+from checkpoint import Checkpoints, digest, file_manifest
+
+logger = logging.getLogger()
+
+ATLOD_OPTIONS = 'birdie,rfiflag,noauto,xycorr'
+REFANT = 4
+INTERVAL = 0.1
+
+# Split the pointings straight out of the atlod output, rather than splitting
+# out each mosaic, copying the solutions to it and splitting it again. This
+# saves a full read and write of every mosaic, but the pointings are then
+# calibrated and flagged in place, so a mosaic stage can not be run again on
+# its own. Any mosaic stage that is out of date runs the calibration stage of
+# its IF again too, which gives it a fresh split.
+DIRECT_SPLIT = os.environ.get('GLASS_DIRECT_SPLIT', '0') == '1'
+
+
+# Limits of the automatic choice of the solution interval (minutes) and nfbin of
+# mfcal and gpcal, see `tune_solutions`
+TUNING = {'intervals': [0.1, 0.2, 0.5, 1.0, 2.0, 5.0],
+          # Solutions wanted within a typical scan of a calibrator
+          'solutions_per_scan': 3,
+          # Minutes of unflagged data wanted in each frequency bin of a
+          # solution, as given by INTERVAL and an nfbin of 4 on clean data
+          'min_data': INTERVAL / 4}
+# The choice for an IF of the day, kept with the inputs it was made from. Each
+# IF has its own file, as the IFs may be reduced by separate processes.
+TUNING_CACHE = 'calibration_tuning_{freq}.json'
+
+
+def _split_options():
+    """Options of the initial uvsplit, see `DIRECT_SPLIT`
+    """
+    return '' if DIRECT_SPLIT else ' options=mosaic'
+
+
+def _record(record, *args, **kwargs):
+    """Add to the catalogue. The catalogue is shared by every day, so a problem
+    with it is logged rather than failing the reduction.
+    """
+    try:
+        record(os.path.basename(os.getcwd()), *args, **kwargs)
+    except (sqlite3.Error, OSError) as e:
+        logger.log(logging.WARNING, f"Could not update the catalogue: {e}")
+
+
+def _revisions(tasks: list):
+    """Miriad revisions of a set of tasks, for inclusion in a stage manifest
+    """
+    return {task: mu.miriad_revision(task) for task in tasks}
+
+
+def _calibrate_manifest(files: list, flag_select, flags, ifsel, nfbin: int, autotune: bool):
+    """Manifest of the inputs of a `calibrate_<freq>` stage. The flag files,
+    known bad channels and ifsel are those of the IF, or mappings of each IF to
+    them when both IFs are loaded together.
+
+    Arguments:
+        files {list} -- RPFITS files loaded
+        flag_select {list,dict} -- Parsed lines of the flag def file(s)
+        flags {dict} -- Known bad channels
+        ifsel {int,dict} -- IF number(s) selected
+        nfbin {int} -- Number of frequency bins for gpcal
+        autotune {bool} -- Whether the solutions are tuned
+
+    Returns:
+        dict -- Manifest to digest and record with the stage
+    """
+    return {'files': file_manifest(files),
+            'flag_select': flag_select,
+            'flags': flags,
+            'rfi': mu.frequencyFlagging['rfi'],
+            'params': {'ifsel': ifsel, 'atlod': ATLOD_OPTIONS, 'refant': REFANT,
+                       'interval': INTERVAL, 'nfbin': nfbin, 'direct_split': DIRECT_SPLIT,
+                       'autotune': TUNING if autotune else None,
+                       'pgflag': {r: mu.PGFLAG_PLANS[r] for r in ('primary', 'secondary')}},
+            'miriad': _revisions(['atlod', 'uvflag', 'uvsplit', 'pgflag', 'mfcal', 'gpcal',
+                                  'gpcopy', 'gpboot', 'mfboot'])}
+
+
+def _mosaic_manifest(upstream: str):
+    """Manifest of the inputs of a `mosaic_<mosaic>` stage
+
+    Arguments:
+        upstream {str} -- Digest of the calibration stage
+
+    Returns:
+        dict -- Manifest to digest and record with the stage
+    """
+    return {'upstream': upstream,
+            'params': {'gpaver': mu.GPAVER_PARAMS, 'pgflag': mu.PGFLAG_PLANS['mosaic'],
+                       'rfi_engine': mu.RFI_ENGINE},
+            'miriad': _revisions(['gpcopy', 'uvsplit', 'gpaver', 'pgflag'])}
+
+
+def _calibration_current(checkpoints: Checkpoints, stage: str, stage_digest: str):
+    """Whether a `calibrate_<freq>` stage may be skipped. Pointings split
+    directly by the initial uvsplit (see `DIRECT_SPLIT`) are calibrated and
+    flagged in place, so if any of their mosaic stages is out of date the
+    calibration stage is run again to split them afresh.
+
+    Arguments:
+        checkpoints {Checkpoints} -- Record of completed stages
+        stage {str} -- Name of the calibration stage
+        stage_digest {str} -- Digest of the current inputs of the stage
+
+    Returns:
+        bool -- True if the stage is up to date
+    """
+    if not checkpoints.is_current(stage, stage_digest):
+        return False
+
+    result = checkpoints.load(stage)['result']
+    if result.get('mosaic_pointings') is None:
+        return True
+
+    mosaic_digest = digest(_mosaic_manifest(stage_digest))
+    stale = [m for m in result['mosaics']
+             if not checkpoints.is_current(f"mosaic_{m}", mosaic_digest)]
+    if stale:
+        logger.log(logging.INFO, f"Stages of {', '.join(stale)} are out of date and their "\
+                                 f"pointings were processed in place, running {stage} again")
+        return False
+
+    return True
+
+
+def add_if_reduction(graph, freq: int, ifsel: int, files: list, flags: dict, nfbin: int=4,
+                     autotune: bool=False, checkpoints: Checkpoints=None):
+    """Add the reduction of a single IF to a task graph. Only the loading and
+    initial uvsplit are known up front. Files whose scans are all of ignored
+    sources, or of other IFs, are not loaded. The calibration and mosaic tasks are
+    added once uvsplit has shown what sources were observed.
+
+    Arguments:
+        graph {TaskGraph} -- Graph to add tasks to
+        freq {int} -- Frequency of the IF
+        ifsel {int} -- IF number for atlod to select
+        files {list} -- RPFITS files of the day
+        flags {dict} -- Known bad channels with `chan_start` and `chan_end`
+
+    Keyword Arguments:
+        nfbin {int} -- Number of frequency bins for gpcal (default: {4})
+        autotune {bool} -- Choose the solution interval, and nfbin up to `nfbin`,
+                           from the calibrator scans and flags (see
+                           `tune_solutions`) (default: {False})
+        checkpoints {Checkpoints} -- Record of completed stages. The default
+                                     checkpoint folder of the day is used if
+                                     not given (default: {None})
+    """
+    freq = str(freq)
+    checkpoints = Checkpoints() if checkpoints is None else checkpoints
+
+    index = rpfits.day_index(files)
+    loaded = rpfits.wanted_files(index, freq=int(freq))
+    for f in sorted(set(files) - set(loaded)):
+        logger.log(logging.WARNING, f"Not loading {f}, its headers show no wanted sources in the "\
+                                    f"{freq} IF")
+    if len(loaded) == 0:
+        logger.log(logging.ERROR, f"No files to load for the {freq} IF")
+        return
+    parts = {f: f"data{freq[0]}_{os.path.splitext(os.path.basename(f))[0]}.uv" for f in loaded}
+    vis = list(parts.values())
+
+    stage = f"calibrate_{freq}"
+    manifest = _calibrate_manifest(loaded, mu.read_flag_file(vis[0], freq=freq), flags, ifsel,
+                                   nfbin, autotune)
+    stage_digest = digest(manifest)
+
+    # Records of the tasks added here are tagged with the IF and stage
+    with mu.task_tags(freq=freq, stage=stage):
+        if _calibration_current(checkpoints, stage, stage_digest):
+            logger.log(logging.INFO, f"Stage {stage} is up to date, skipping to the mosaics")
+            result = checkpoints.load(stage)['result']
+            graph.add(f"restore_calibrators_{freq}", _restore_calibrators, result['primary'],
+                      result['secondary'], writes=[result['primary'], result['secondary']])
+            # Only atlod output left behind by an interrupted run still needs moving.
+            # A staged run (see `staging.py`) does not bring it to scratch at all.
+            _add_mosaics(graph, result['primary'], result['secondary'], result['mosaics'], freq,
+                         [v for v in vis if os.path.exists(v)], checkpoints, stage_digest,
+                         mosaic_pointings=result.get('mosaic_pointings'))
+            return
+
+        graph.add(f"clean_{freq}", _clean_previous, freq, checkpoints.load(stage), checkpoints,
+                  writes=vis)
+        checkpoints.start(stage, stage_digest, manifest)
+
+        # Files are converted side by side, then flagged and split as one
+        for f, part in parts.items():
+            graph.add(f"atlod_{part}", mu.mir_run,
+                      f"atlod in={f} out={part} ifsel={ifsel} options={ATLOD_OPTIONS}",
+                      reads=[f], writes=[part])
+
+        graph.add(f"uvflag_{freq}", mu.uvflag, ','.join(vis), flags, freq=freq,
+                  reads=[f"flag_select_{freq}.dat"], writes=vis)
+
+        graph.add(f"uvsplit_{freq}", mu.mir_run, f"uvsplit vis={','.join(vis)}{_split_options()}",
+                  reads=vis,
+                  expand=partial(_add_calibration, freq=freq, vis=vis, nfbin=nfbin,
+                                 checkpoints=checkpoints, stage=stage,
+                                 scans=rpfits.calibrator_scans({f: index[f] for f in loaded}),
+                                 autotune=autotune))
+
+
+def add_dual_if_reduction(graph, ifs: dict, files: list, nfbin: int=4, autotune: bool=False,
+                          checkpoints: Checkpoints=None):
+    """Add the reduction of both IFs to a task graph, reading the RPFITS files
+    only once. Each file is loaded with all of its IFs, the flag def files of
+    both IFs are applied in one set of uvflag passes (see `mu.uvflag_windows`),
+    and a single uvsplit writes the sources of each IF. The known bad channels
+    are then flagged in the split files of each IF, and each IF is calibrated
+    as in `add_if_reduction`.
+
+    The `calibrate_<freq>` stages of both IFs share the loading, so unless
+    both are up to date both are run again.
+
+    Arguments:
+        graph {TaskGraph} -- Graph to add tasks to
+        ifs {dict} -- For each IF frequency, its `ifsel` (spectral window number)
+                      and `flags`, the known bad channels
+        files {list} -- RPFITS files of the day
+
+    Keyword Arguments:
+        nfbin {int} -- Number of frequency bins for gpcal (default: {4})
+        autotune {bool} -- Choose the solution interval, and nfbin up to `nfbin`,
+                           from the calibrator scans and flags (default: {False})
+        checkpoints {Checkpoints} -- Record of completed stages. The default
+                                     checkpoint folder of the day is used if
+                                     not given (default: {None})
+    """
+    ifs = {str(freq): config for freq, config in ifs.items()}
+    checkpoints = Checkpoints() if checkpoints is None else checkpoints
+
+    index = rpfits.day_index(files)
+    wanted = set().union(*(rpfits.wanted_files(index, freq=int(freq)) for freq in ifs))
+    loaded = [f for f in files if f in wanted]
+    for f in sorted(set(files) - set(loaded)):
+        logger.log(logging.WARNING, f"Not loading {f}, its headers show no wanted sources")
+    if len(loaded) == 0:
+        logger.log(logging.ERROR, "No files to load")
+        return
+    parts = {f: f"data_{os.path.splitext(os.path.basename(f))[0]}.uv" for f in loaded}
+    vis = list(parts.values())
+
+    manifest = _calibrate_manifest(loaded,
+                                   {freq: mu.read_flag_file(vis[0], freq=freq) for freq in ifs},
+                                   {freq: config['flags'] for freq, config in ifs.items()},
+                                   {freq: config['ifsel'] for freq, config in ifs.items()},
+                                   nfbin, autotune)
+    stage_digest = digest(manifest)
+    stages = {freq: f"calibrate_{freq}" for freq in ifs}
+
+    if all(_calibration_current(checkpoints, stage, stage_digest) for stage in stages.values()):
+        for freq, stage in stages.items():
+            with mu.task_tags(freq=freq, stage=stage):
+                logger.log(logging.INFO, f"Stage {stage} is up to date, skipping to the mosaics")
+                result = checkpoints.load(stage)['result']
+                graph.add(f"restore_calibrators_{freq}", _restore_calibrators, result['primary'],
+                          result['secondary'], writes=[result['primary'], result['secondary']])
+                # Only atlod output left behind by an interrupted run still needs moving.
+                # A staged run (see `staging.py`) does not bring it to scratch at all.
+                _add_mosaics(graph, result['primary'], result['secondary'], result['mosaics'], freq,
+                             [v for v in vis if os.path.exists(v)], checkpoints, stage_digest,
+                             mosaic_pointings=result.get('mosaic_pointings'))
+        return
+
+    with mu.task_tags(freq='both', stage='ingest'):
+        for freq, stage in stages.items():
+            graph.add(f"clean_{freq}", _clean_previous, freq, checkpoints.load(stage), checkpoints,
+                      prefix='data_', writes=vis)
+            checkpoints.start(stage, stage_digest, manifest)
+
+        # Files are converted side by side with all of their IFs
+        for f, part in parts.items():
+            graph.add(f"atlod_{part}", mu.mir_run, f"atlod in={f} out={part} options={ATLOD_OPTIONS}",
+                      reads=[f], writes=[part])
+
+        graph.add("uvflag_both", mu.uvflag_windows, ','.join(vis),
+                  {freq: config['ifsel'] for freq, config in ifs.items()},
+                  reads=[f"flag_select_{freq}.dat" for freq in ifs], writes=vis)
+
+        graph.add("uvsplit_both", mu.mir_run, f"uvsplit vis={','.join(vis)}{_split_options()}",
+                  reads=vis,
+                  expand=partial(_add_split_ifs, ifs=ifs, vis=vis, nfbin=nfbin,
+                                 checkpoints=checkpoints, stages=stages,
+                                 scans=rpfits.calibrator_scans({f: index[f] for f in loaded}),
+                                 autotune=autotune))
+
+
+def _add_split_ifs(graph, uvsplit, ifs: dict, vis: list, nfbin: int, checkpoints: Checkpoints,
+                   stages: dict, scans: dict=None, autotune: bool=False):
+    """Flag the known bad channels in the sources split out of each IF and add
+    their calibration, once the uvsplit of both IFs has finished
+
+    Arguments:
+        graph {TaskGraph} -- Graph to add tasks to
+        uvsplit {MirTask} -- Executed uvsplit
+        ifs {dict} -- For each IF frequency, its `ifsel` and `flags`
+        vis {list} -- Visibility files loaded by atlod
+        nfbin {int} -- Number of frequency bins for gpcal
+        checkpoints {Checkpoints} -- Record of completed stages
+        stages {dict} -- Name of the calibration stage of each IF
+
+    Keyword Arguments:
+        scans {dict} -- Scan lengths of each calibrator (default: {None})
+        autotune {bool} -- Choose the solution interval and nfbin (default: {False})
+    """
+    for freq, config in ifs.items():
+        with mu.task_tags(freq=freq, stage=stages[freq]):
+            primary, secondary, mosaic_targets = mu.derive_obs_sources(uvsplit, freq)
+            srcs = [primary, secondary] + mosaic_targets
+            graph.add(f"uvflag_{freq}", mu.uvflag_channels, ','.join(srcs), config['flags'],
+                      writes=srcs)
+
+            _add_calibration(graph, uvsplit, freq, vis, nfbin, checkpoints, stages[freq],
+                             scans=scans, autotune=autotune)
+
+
+def _clean_previous(freq: str, record: dict, checkpoints: Checkpoints, prefix: str=None):
+    """Remove the products of an earlier, possibly partial, reduction of an IF
+    so that it can be run again from atlod. The records of its mosaic stages
+    are removed with their pointings.
+
+    Arguments:
+        freq {str} -- Frequency of the IF
+        record {dict} -- Checkpoint of the earlier calibration stage, if any
+        checkpoints {Checkpoints} -- Record of earlier stages
+
+    Keyword Arguments:
+        prefix {str} -- Prefix of the files loaded by atlod. Those of the IF
+                        alone are assumed if not given (default: {None})
+    """
+    loaded = f"{prefix or 'data' + freq[0]}*.uv"
+    stale = glob(loaded) + glob(os.path.join('uv_data', loaded)) + glob(f"*.{freq}")
+
+    if record is not None:
+        result = record['result']
+        stale += [os.path.join('uv_calibrators', result[k]) for k in ('primary', 'secondary')
+                  if k in result]
+        stale += [os.path.join('uv_mosaic', m) for m in result.get('mosaics', [])]
+
+    # The mosaic stages are run again from the fresh split
+    for stage in checkpoints.stages(suffix=f".{freq}"):
+        stale += [os.path.join(f"f{freq}_sources", s)
+                  for s in checkpoints.load(stage)['result'].get('pointings', [])]
+        checkpoints.discard(stage)
+
+    for path in stale:
+        if os.path.exists(path):
+            logger.log(logging.INFO, f"Removing {path} from an earlier reduction")
+            mu.rm_uv(path)
+
+
+def _restore_calibrators(primary: str, secondary: str):
+    """Bring the calibrators back from `uv_calibrators` if an earlier run moved them
+    """
+    mu.restore(primary, 'uv_calibrators')
+    mu.restore(secondary, 'uv_calibrators')
+
+
+def _add_calibration(graph, uvsplit, freq: str, vis: list, nfbin: int, checkpoints: Checkpoints,
+                     stage: str, scans: dict=None, autotune: bool=False):
+    """Add the calibration of the primary and secondary, and the processing of
+    each mosaic, once the initial uvsplit has finished
+
+    Arguments:
+        graph {TaskGraph} -- Graph to add tasks to
+        uvsplit {MirTask} -- Executed uvsplit
+        freq {str} -- Frequency of the IF
+        vis {list} -- Visibility files loaded by atlod
+        nfbin {int} -- Number of frequency bins for gpcal
+        checkpoints {Checkpoints} -- Record of completed stages
+        stage {str} -- Name of the calibration stage
+
+    Keyword Arguments:
+        scans {dict} -- Scan lengths in seconds of each calibrator, from
+                        `rpfits.calibrator_scans` (default: {None})
+        autotune {bool} -- Choose the solution interval and nfbin once the
+                           calibrators are split (default: {False})
+    """
+    primary, secondary, mosaic_targets = mu.derive_obs_sources(uvsplit, freq)
+    pointings = None
+    if DIRECT_SPLIT:
+        # The targets are the pointings themselves
+        pointings = mu.group_pointings(mosaic_targets)
+        mosaic_targets = list(pointings)
+    checkpoints.update(stage, primary=primary, secondary=secondary, mosaics=mosaic_targets,
+                       mosaic_pointings=pointings)
+
+    # Filled in by the tuning task before the first solution if autotuning
+    tuning = {'nfbin': nfbin, 'interval': {primary: INTERVAL, secondary: INTERVAL}}
+    tuned = [f"tuning_{freq}"]
+    if autotune:
+        graph.add(f"tune_{freq}", _tune_calibration, freq, primary, secondary, scans or {}, nfbin,
+                  tuning, checkpoints, stage, reads=[primary, secondary], writes=tuned)
+
+    cal = f"refant={REFANT} interval={{interval}} nfbin={{nfbin}}"
+
+    for n in (1, 2):
+        graph.add(f"pgflag_primary{n}_{freq}", mu.calibrator_pgflag, primary, writes=[primary])
+        graph.add(f"mfcal_primary{n}_{freq}", _solve,
+                  f"mfcal vis={primary} refant={REFANT} interval={{interval}}", primary, tuning,
+                  reads=tuned, writes=[primary])
+        graph.add(f"gpcal_primary{n}_{freq}", _solve,
+                  f"gpcal vis={primary} {cal} options=xyvary", primary, tuning,
+                  reads=tuned, writes=[primary])
+
+    graph.add(f"gpcopy_secondary_{freq}", mu.mir_run, f"gpcopy vis={primary} out={secondary}",
+              reads=[primary], writes=[secondary])
+
+    for n in (1, 2):
+        graph.add(f"pgflag_secondary{n}_{freq}", mu.calibrator_pgflag, secondary, writes=[secondary])
+        graph.add(f"gpcal_secondary{n}_{freq}", _solve,
+                  f"gpcal vis={secondary} {cal} options=xyvary,qusolve", secondary, tuning,
+                  reads=tuned, writes=[secondary])
+
+    graph.add(f"gpboot_{freq}", mu.mir_run, f"gpboot vis={secondary} cal={primary}",
+              reads=[primary], writes=[secondary])
+
+    # mfboot rescales the gains of both files, so everything that uses the
+    # secondary's solutions has to wait for it
+    graph.add(f"mfboot_{freq}", mu.mir_run,
+              f"mfboot vis={primary},{secondary} select=source({mu.primary}) device=mfboot_{freq}.png/png",
+              writes=[primary, secondary, f"mfboot_{freq}.png"])
+
+    # Plots are only queued here, and made in the background while the mosaics
+    # are processed. Moving the calibrators waits for them.
+    graph.add(f"calibration_plots_{freq}", mu.calibration_plots, primary, secondary, freq,
+              reads=[primary, secondary], writes=[f"calibration_plots_{freq}"])
+
+    graph.add(f"checkpoint_{stage}", _done_when_plotted, checkpoints, stage, [primary, secondary],
+              reads=[primary, secondary, f"mfboot_{freq}.png", f"calibration_plots_{freq}"])
+
+    _add_mosaics(graph, primary, secondary, mosaic_targets, freq, vis, checkpoints,
+                 checkpoints.load(stage)['digest'], mosaic_pointings=pointings)
+
+
+def _done_when_plotted(checkpoints: Checkpoints, stage: str, plotted: list):
+    """Mark a stage as done once the plots queued by it have been made. The
+    plots are made in the background, so without waiting a run that dies
+    after the checkpoint would leave a stage that is skipped without its plots.
+
+    Arguments:
+        checkpoints {Checkpoints} -- Record of completed stages
+        stage {str} -- Name of the stage
+        plotted {list} -- Visibility files plotted by the stage
+    """
+    mu.plot_service().wait(plotted)
+    checkpoints.done(stage)
+
+
+def _solve(template: str, calibrator: str, tuning: dict):
+    """Run mfcal or gpcal on a calibrator with its solution interval and nfbin
+
+    Arguments:
+        template {str} -- Task and keywords, with `{interval}` and `{nfbin}` to fill in
+        calibrator {str} -- Calibrator being solved for
+        tuning {dict} -- `nfbin` and the `interval` of each calibrator
+
+    Returns:
+        MirTask -- The executed task
+    """
+    return mu.mir_run(template.format(interval=tuning['interval'][calibrator],
+                                      nfbin=tuning['nfbin']))
+
+
+def tune_solutions(durations: dict, unflagged: dict, nfbin: int, limits: dict=TUNING):
+    """Choose nfbin and the solution interval of each calibrator from its scans
+    and flags. nfbin is the largest of `nfbin`, `nfbin // 2`, ... for which
+    every calibrator has an interval in `limits['intervals']` that both holds
+    `limits['min_data']` minutes of unflagged data in each frequency bin and
+    fits `limits['solutions_per_scan']` times into its median scan. Each
+    calibrator then gets the shortest such interval. If none fits, a single
+    bin is solved for over the shortest interval with enough data.
+
+    Arguments:
+        durations {dict} -- Scan lengths in seconds of each calibrator
+        unflagged {dict} -- Unflagged fraction of the data of each calibrator
+        nfbin {int} -- Largest number of frequency bins to solve for
+
+    Keyword Arguments:
+        limits {dict} -- Candidate intervals and limits (default: {TUNING})
+
+    Returns:
+        dict -- `nfbin` and the `interval` (minutes) of each calibrator
+    """
+    intervals = sorted(limits['intervals'])
+
+    def needed(cal, bins):
+        return limits['min_data'] * bins / max(unflagged[cal], 0.01)
+
+    def longest(cal):
+        if len(durations.get(cal, [])) == 0:
+            return intervals[-1]
+        return statistics.median(durations[cal]) / 60 / limits['solutions_per_scan']
+
+    bins = max(nfbin, 1)
+    while bins >= 1:
+        choice = {cal: next((i for i in intervals if needed(cal, bins) <= i <= longest(cal)), None)
+                  for cal in unflagged}
+        if None not in choice.values():
+            return {'nfbin': bins, 'interval': choice}
+        bins //= 2
+
+    return {'nfbin': 1, 'interval': {cal: next((i for i in intervals if i >= needed(cal, 1)),
+                                               intervals[-1]) for cal in unflagged}}
+
+
+def _tune_calibration(freq: str, primary: str, secondary: str, scans: dict, nfbin: int,
+                      tuning: dict, checkpoints: Checkpoints, stage: str):
+    """Choose the solution interval and nfbin of the calibrators of an IF with
+    `tune_solutions`, reusing the choice kept in the TUNING_CACHE of the IF if
+    it was made from the same scans and flags
+
+    Arguments:
+        freq {str} -- Frequency of the IF
+        primary {str} -- Primary calibrator
+        secondary {str} -- Secondary calibrator
+        scans {dict} -- Scan lengths in seconds of each calibrator, by source name
+        nfbin {int} -- Largest number of frequency bins to solve for
+        tuning {dict} -- Updated in place with the choice, for the solving tasks
+        checkpoints {Checkpoints} -- Record of completed stages
+        stage {str} -- Name of the calibration stage
+
+    Returns:
+        dict -- The choice
+    """
+    durations, unflagged = {}, {}
+    for cal in (primary, secondary):
+        durations[cal] = scans.get(cal.split('.')[0], [])
+        flagged = catalogue.flag_fraction(cal)
+        unflagged[cal] = 1. if flagged is None else round(1 - flagged, 3)
+    inputs = digest({'durations': durations, 'unflagged': unflagged, 'nfbin': nfbin,
+                     'limits': TUNING})
+
+    cache = TUNING_CACHE.format(freq=freq)
+    entry = None
+    if os.path.exists(cache):
+        with open(cache, 'r') as infile:
+            entry = json.load(infile)
+
+    if entry is not None and entry['inputs'] == inputs:
+        choice = entry['choice']
+        logger.log(logging.INFO, f"Reusing the solution intervals chosen for {freq}")
+    else:
+        choice = tune_solutions(durations, unflagged, nfbin)
+        tmp = f"{cache}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as out:
+            json.dump({'inputs': inputs, 'choice': choice, 'unflagged': unflagged}, out,
+                      indent=1, sort_keys=True)
+        os.replace(tmp, cache)
+
+    tuning.update(choice)
+    checkpoints.update(stage, tuning=choice)
+    for cal in (primary, secondary):
+        logger.log(logging.INFO, f"Solving {cal} ({unflagged[cal]:.0%} unflagged, "\
+                                 f"{len(durations[cal])} scans) with nfbin={choice['nfbin']} "\
+                                 f"interval={choice['interval'][cal]}")
+
+    return choice
+
+
+def _add_mosaics(graph, primary: str, secondary: str, mosaic_targets: list, freq: str, vis: list,
+                 checkpoints: Checkpoints, upstream: str, mosaic_pointings: dict=None):
+    """Add the processing of each mosaic whose stage is out of date, followed by
+    moving the products of the IF into place. Mosaics whose pointings were split
+    by the initial uvsplit (see `DIRECT_SPLIT`) have the solutions copied to
+    each of their pointings, and are not split again. Those pointings come
+    straight from the uvsplit of this run, see `_calibration_current`.
+
+    Arguments:
+        graph {TaskGraph} -- Graph to add tasks to
+        primary {str} -- Primary calibrator
+        secondary {str} -- Secondary calibrator with the solutions to copy
+        mosaic_targets {list} -- Mosaic files created by the initial uvsplit
+        freq {str} -- Frequency of the IF
+        vis {list} -- Visibility files loaded by atlod
+        checkpoints {Checkpoints} -- Record of completed stages
+        upstream {str} -- Digest of the calibration stage
+
+    Keyword Arguments:
+        mosaic_pointings {dict} -- Pointings of each mosaic, if they were split
+                                   by the initial uvsplit (default: {None})
+    """
+    manifest = _mosaic_manifest(upstream)
+    stage_digest = digest(manifest)
+
+    for mosaic in mosaic_targets:
+        stage = f"mosaic_{mosaic}"
+        if checkpoints.is_current(stage, stage_digest):
+            logger.log(logging.INFO, f"Stage {stage} is up to date, skipping")
+            continue
+
+        previous = checkpoints.load(stage)
+        pointings = [] if previous is None else previous['result'].get('pointings', [])
+        checkpoints.start(stage, stage_digest, manifest)
+
+        with mu.task_tags(stage=stage):
+            if mosaic_pointings is not None:
+                srcs = mosaic_pointings[mosaic]
+                for src in srcs:
+                    graph.add(f"gpcopy_{src}", mu.mir_run, f"gpcopy vis={secondary} out={src}",
+                              reads=[secondary], writes=[src])
+                _add_pointings(graph, srcs, mosaic, freq, checkpoints, stage, split=False)
+                continue
+
+            graph.add(f"restore_{mosaic}", _restore_mosaic, mosaic, pointings, freq,
+                      writes=[mosaic])
+            graph.add(f"gpcopy_{mosaic}", mu.mir_run, f"gpcopy vis={secondary} out={mosaic}",
+                      reads=[secondary], writes=[mosaic])
+            graph.add(f"uvsplit_{mosaic}", mu.mosaic_uvsplit, mosaic, reads=[mosaic],
+                      expand=partial(_add_pointings, mosaic=mosaic, freq=freq,
+                                     checkpoints=checkpoints, stage=stage))
+
+    graph.add(f"mv_calibrators_{freq}", mu.mv_calibrators, primary, secondary,
+              writes=[primary, secondary])
+    # Mosaics split by the initial uvsplit have no file of their own to record
+    graph.add(f"catalogue_{freq}", _record, catalogue.record_calibrators, freq, primary,
+              secondary, mosaics=mosaic_targets if mosaic_pointings is None else [],
+              reads=[primary, secondary])
+    graph.add(f"mv_data_{freq}", mu.mv_data, vis, writes=vis)
+    # Reading the calibrators orders this after mv_calibrators, and so after
+    # the calibration plots have been made
+    graph.add(f"mv_plots_{freq}", mu.mv_plots, freq, reads=[primary, secondary],
+              writes=[f"mfboot_{freq}.png", f"calibration_plots_{freq}"])
+
+
+def _restore_mosaic(mosaic: str, pointings: list, freq: str):
+    """Prepare a mosaic to be processed again. The mosaic is brought back from
+    `uv_mosaic` and pointings left by an earlier attempt are removed, as uvsplit
+    will not overwrite them. An attempt stopped before its pointings were
+    recorded may still have split them, so pointings named after the mosaic
+    (see `mu.group_pointings`) are removed as well.
+
+    Arguments:
+        mosaic {str} -- Mosaic file
+        pointings {list} -- Pointings an earlier attempt split from the mosaic
+        freq {str} -- Frequency of the IF
+    """
+    mu.restore(mosaic, 'uv_mosaic')
+    split = glob(f"{mosaic.rsplit('.', 1)[0]}_[0-9]*.{freq}")
+    for src in sorted(set(pointings) | set(split)):
+        mu.rm_uv(src)
+        mu.rm_uv(os.path.join(f"f{freq}_sources", src))
+
+
+def _add_pointings(graph, srcs: list, mosaic: str, freq: str, checkpoints: Checkpoints, stage: str,
+                   split: bool=True):
+    """Add the calibration and flagging of each pointing of a mosaic. Pointings
+    are independent of each other, so these run side by side.
+
+    Arguments:
+        graph {TaskGraph} -- Graph to add tasks to
+        srcs {list} -- Pointings created by uvsplit
+        mosaic {str} -- Mosaic the pointings were split from
+        freq {str} -- Frequency of the IF
+        checkpoints {Checkpoints} -- Record of completed stages
+        stage {str} -- Name of the mosaic stage
+
+    Keyword Arguments:
+        split {bool} -- Whether the pointings were split from a mosaic file, which
+                        is then moved into place too (default: {True})
+    """
+    checkpoints.update(stage, pointings=srcs, split=split)
+    mosaic_files = [mosaic] if split else []
+
+    # Each pointing is its own task, so the number of miriad tasks running at
+    # once is bound by the workers of the graph
+    for src in srcs:
+        graph.add(f"gpaver_{src}", mu.pointing_gpaver, src, writes=[src])
+        graph.add(f"pgflag_{src}", mu.mosaic_src_pgflag, src, writes=[src])
+
+    graph.add(f"mv_srcs_{mosaic}", mu.mv_srcs, srcs, freq, writes=srcs)
+    for src in srcs:
+        graph.add(f"plots_{src}", mu.mosaic_src_plots, src, freq, reads=[src],
+                  writes=[f"plots_{src}"])
+    if split:
+        graph.add(f"mv_mosaic_{mosaic}", mu.mv_mosaic, mosaic, writes=[mosaic])
+    graph.add(f"checkpoint_{stage}", _done_when_plotted, checkpoints, stage,
+              [os.path.join(f"f{freq}_sources", src) for src in srcs],
+              reads=srcs + mosaic_files + [f"plots_{src}" for src in srcs])
+    graph.add(f"catalogue_{mosaic}", _record, catalogue.record_mosaic, freq, mosaic, srcs,
+              split=split, reads=srcs + mosaic_files)
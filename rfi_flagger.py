@@ -0,0 +1,273 @@
+"""An in-process SumThreshold RFI flagger, as an alternative to a series of
+pgflag passes.
+
+pgflag reads and writes the whole dataset for every pass of a flagging plan
+(see `mir_utils.PGFLAG_PLANS`). This reads the visibilities once with
+`miriad_io`, runs every pass of the plan against the time-frequency planes of
+each baseline in memory, and writes the `flags` item once.
+
+Each pass forms the amplitude of the requested stokes parameters from the
+linear polarisations, subtracts a smoothed background and clips with
+SumThreshold (Offringa et al. 2010): runs of 1, 2, 4, ... samples are flagged
+when their sum exceeds a threshold that falls with the length of the run. A
+flag in any stokes parameter flags every polarisation of that sample, as
+pgflag does.
+
+The pgflag `flagpar` of a pass is read with pgflag's meaning of its fields:
+  1. threshold in units of sigma
+  2. whether to smooth along the channels (1) or not (0)
+  3. whether to smooth along time (1) or not (0)
+  4. number of iterations
+  5. width of the smoothing along the channels
+  6. width of the smoothing along time
+Any further fields are not used. pgflag does not expose the SumThreshold
+window sizes, which are 1, 2, 4, ... up to 2**(WINDOWS-1) samples here. The
+same parameters do not make this an exact copy of pgflag, so run the
+`compare` engine (see `mir_utils.RFI_ENGINE`) before relying on it.
+"""
+import logging
+import time
+
+import numpy as np
+
+import miriad_io as mio
+
+logger = logging.getLogger()
+
+# miriad codes of the linear polarisations
+XX, YY, XY, YX = -5, -6, -7, -8
+
+# Fall in the SumThreshold threshold with each doubling of the window
+RHO = 1.5
+# Number of SumThreshold window sizes, doubling from a single sample
+WINDOWS = 5
+
+
+def parse_flagpar(flagpar: str):
+    """Split a pgflag flagpar into the parameters used here. The smoothing
+    widths become kernels of that many samples either side of the centre, i.e.
+    a width of 5 is 2 either side, and are 0 where smoothing is switched off.
+
+    Arguments:
+        flagpar {str} -- pgflag flagpar, e.g. '10,1,0,3,5,3'
+
+    Raises:
+        ValueError -- The flagpar has fewer than the six fields used here
+
+    Returns:
+        dict -- `threshold`, `chan_kernel`, `time_kernel`, `iterations` and
+                the number of SumThreshold `windows`
+    """
+    values = [float(v) for v in flagpar.split(',')]
+    if len(values) < 6:
+        raise ValueError(f"Expected at least six values in flagpar {flagpar}")
+
+    return {'threshold': values[0],
+            'chan_kernel': int(values[4]) // 2 if values[1] else 0,
+            'time_kernel': int(values[5]) // 2 if values[2] else 0,
+            'iterations': max(1, int(values[3])),
+            'windows': WINDOWS}
+
+
+def stokes_amplitude(cube: dict, stokes: str):
+    """Amplitude of a stokes parameter from the linear polarisations
+
+    Arguments:
+        cube {dict} -- Complex planes of each polarisation code
+        stokes {str} -- One of i, q, u or v
+    """
+    if stokes == 'i':
+        return np.abs(cube[XX] + cube[YY]) / 2
+    if stokes == 'q':
+        return np.abs(cube[XX] - cube[YY]) / 2
+    if stokes == 'u':
+        return np.abs(cube[XY] + cube[YX]) / 2
+    if stokes == 'v':
+        return np.abs(cube[XY] - cube[YX]) / 2
+
+    raise ValueError(f"Unknown stokes parameter {stokes}")
+
+
+def _smooth(values: np.ndarray, mask: np.ndarray, kernel: int, axis: int):
+    """Boxcar mean of the unmasked values along an axis, `kernel` samples either side
+    """
+    if kernel <= 0:
+        return values
+
+    good = np.where(mask, 0., values)
+    weight = (~mask).astype(float)
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (kernel + 1, kernel)
+    sums = np.cumsum(np.pad(good, pad), axis=axis)
+    counts = np.cumsum(np.pad(weight, pad), axis=axis)
+
+    width = 2 * kernel + 1
+    hi = [slice(None)] * values.ndim
+    lo = [slice(None)] * values.ndim
+    hi[axis] = slice(width, None)
+    lo[axis] = slice(None, -width)
+    total = sums[tuple(hi)] - sums[tuple(lo)]
+    count = counts[tuple(hi)] - counts[tuple(lo)]
+
+    return np.where(count > 0, total / np.maximum(count, 1), values)
+
+
+def _window_hits(values: np.ndarray, window: int, limit, axis: int):
+    """Flag every run of `window` samples along an axis whose sum exceeds
+    `window * limit`
+    """
+    n = values.shape[axis]
+    if window > n:
+        return np.zeros(values.shape, dtype=bool)
+
+    pad = [(0, 0)] * values.ndim
+    pad[axis] = (1, 0)
+    sums = np.cumsum(np.pad(values, pad), axis=axis)
+    m = n - window + 1
+    starts = (np.take(sums, np.arange(window, n + 1), axis=axis) -
+              np.take(sums, np.arange(m), axis=axis)) > window * limit
+
+    # A sample is flagged if any run covering it was
+    runs = np.cumsum(np.pad(starts.astype(np.int32), pad), axis=axis)
+    j = np.arange(n)
+    covered = np.take(runs, np.minimum(j + 1, m), axis=axis) - \
+              np.take(runs, np.maximum(j - window + 1, 0), axis=axis)
+
+    return covered > 0
+
+
+def sumthreshold(amp: np.ndarray, flagged: np.ndarray, params: dict):
+    """Flags of a set of time-frequency planes, shape (..., times, channels)
+
+    Arguments:
+        amp {np.ndarray} -- Amplitudes to clip
+        flagged {np.ndarray} -- Existing flags, True where flagged
+        params {dict} -- Parameters from `parse_flagpar`
+
+    Returns:
+        np.ndarray -- The existing flags together with the new ones
+    """
+    flagged = flagged.copy()
+    for _ in range(params['iterations']):
+        background = _smooth(_smooth(amp, flagged, params['time_kernel'], axis=-2),
+                             flagged, params['chan_kernel'], axis=-1)
+        # Only excess power is RFI
+        residual = amp - background
+
+        # Robust noise of each plane from the median absolute deviation
+        shape = residual.shape[:-2] + (-1,)
+        masked = np.ma.masked_array(residual, flagged).reshape(shape)
+        deviation = np.abs(masked - np.ma.median(masked, axis=-1)[..., None])
+        sigma = np.ma.filled(1.4826 * np.ma.median(deviation, axis=-1), np.inf)[..., None, None]
+
+        new = flagged.copy()
+        for i in range(params['windows']):
+            window = 2 ** i
+            limit = params['threshold'] * sigma / RHO ** i
+            clipped = np.where(new, limit, residual)
+            new |= _window_hits(clipped, window, limit, axis=-1)
+            new |= _window_hits(clipped, window, limit, axis=-2)
+
+        if np.array_equal(new, flagged):
+            break
+        flagged = new
+
+    return flagged
+
+
+class Planes:
+    """The records of a dataset arranged as time-frequency planes of each
+    baseline and polarisation
+    """
+    def __init__(self, uv: mio.UVData):
+        baseline, pol, times = uv.baseline, uv.pol, uv.time
+        self.baselines, b = np.unique(baseline, return_inverse=True)
+        self.pols, p = np.unique(pol, return_inverse=True)
+        self.times, t = np.unique(times, return_inverse=True)
+        self.index = (b, p, t)
+
+        shape = (len(self.baselines), len(self.pols), len(self.times), uv.nchan)
+        self.vis = np.zeros(shape, dtype=np.complex64)
+        self.flagged = np.ones(shape, dtype=bool)
+        self.vis[self.index] = uv.data
+        self.flagged[self.index] = uv.flagged
+
+    def cube(self):
+        """Planes of each polarisation code, shape (baselines, times, channels)
+        """
+        return {code: self.vis[:, i] for i, code in enumerate(self.pols)}
+
+    def record_flags(self, flagged: np.ndarray):
+        """Flags of each record, from flags of shape (baselines, times, channels)
+        shared by every polarisation
+        """
+        b, _, t = self.index
+        return flagged[b, t]
+
+
+def flag_plan(src: str, plan: list, write: bool=True):
+    """Run a pgflag plan against a dataset in memory
+
+    Arguments:
+        src {str} -- Miriad uv dataset to flag
+        plan {list} -- Passes of (stokes, flagpar, repeats), see `mir_utils.PGFLAG_PLANS`
+
+    Keyword Arguments:
+        write {bool} -- Write the flags to the dataset (default: {True})
+
+    Returns:
+        tuple -- Flags of each record and channel, True where flagged, and a dict
+                 per pass describing it as `mir_utils.pgflag_plan` does
+    """
+    uv = mio.UVData(src)
+    planes = Planes(uv)
+    cube = planes.cube()
+    missing = [code for code in (XX, YY, XY, YX) if code not in cube]
+    if missing:
+        raise ValueError(f"{src} is missing polarisations {missing}")
+
+    initial = planes.flagged.any(axis=1)
+    flagged = initial
+    passes = []
+    for stokes, flagpar, repeats in plan:
+        params = parse_flagpar(flagpar)
+        for iteration in range(repeats):
+            start = time.time()
+            new = flagged
+            for s in stokes.split(','):
+                new = sumthreshold(stokes_amplitude(cube, s), new, params)
+
+            count = int((new & ~flagged).sum()) * len(planes.pols)
+            flagged = new
+            passes.append({'vis': src, 'engine': 'sumthreshold', 'stokes': stokes,
+                           'flagpar': flagpar, 'iteration': iteration+1, 'flagged': count,
+                           'seconds': time.time() - start})
+            if count == 0:
+                break
+
+    # Only flags added here are spread across the polarisations
+    record_flags = planes.record_flags(flagged & ~initial) | uv.flagged
+    uv.close()
+    if write:
+        mio.write_flags(src, ~record_flags)
+
+    return record_flags, passes
+
+
+def compare_flags(ours: np.ndarray, theirs: np.ndarray):
+    """How far two sets of flags of the same dataset differ
+
+    Arguments:
+        ours {np.ndarray} -- Flags from `flag_plan`, True where flagged
+        theirs {np.ndarray} -- Flags to compare against, i.e. from pgflag
+
+    Returns:
+        dict -- Flagged fractions of each, of both and of either alone, and the
+                agreement (intersection over union) of the flagged data
+    """
+    either = (ours | theirs).sum()
+    return {'ours': float(ours.mean()), 'theirs': float(theirs.mean()),
+            'both': float((ours & theirs).mean()),
+            'ours_only': float((ours & ~theirs).mean()),
+            'theirs_only': float((~ours & theirs).mean()),
+            'agreement': float((ours & theirs).sum() / either) if either else 1.}
@@ -0,0 +1,368 @@
+"""A streaming scanner of the headers of ATCA RPFITS files.
+
+An RPFITS file is a sequence of scans. Each scan starts with a FITS-like
+header of 80 character cards, padded to a 2880 byte block, followed by the
+random-group visibility data of the scan. The header holds keywords such as
+OBJECT and DATE-OBS, and tables (TABLE IF ... ENDTABLE, TABLE SU ... ENDTABLE)
+describing the IFs and sources of the scan.
+
+This module only inspects the first bytes of each block to find the headers,
+and the random parameters of the first group of each scan to get its start
+time, so a day can be summarised in the time it takes to stream the files
+rather than after a full atlod.
+
+    python3 rpfits.py [raw/*C3132]
+"""
+import os
+import re
+import sys
+import json
+import struct
+import logging
+from glob import glob
+
+import mir_utils as mu
+
+logger = logging.getLogger()
+
+INDEX = 'rpfits_index.json'
+
+BLOCK = 2880
+CARD = 80
+HEADER_START = b'SIMPLE  ='
+
+# Order of the random parameters of each visibility group
+GROUP_PARAMS = ['u', 'v', 'w', 'baseline', 'ut']
+
+# A quoted string, in which '' is an escaped quote, or a run of other characters
+_TOKEN = re.compile(r"'(?:[^']|'')*'|[^\s']+")
+
+
+def _tokens(text: str):
+    """Split a table card into its entries. Quoted strings are kept whole, as
+    they are padded with spaces, i.e. '1934-638        '
+    """
+    return _TOKEN.findall(text)
+
+
+def _value(text: str):
+    """Convert the value of a header card into a python type
+    """
+    text = text.strip()
+    if text.startswith("'"):
+        # The comment follows the closing quote, and may itself hold quotes
+        match = _TOKEN.match(text)
+        if match is None:
+            return text.strip("'").strip()
+        return match.group(0)[1:-1].replace("''", "'").strip()
+    text = text.split('/')[0].strip()
+    if text in ('T', 'F'):
+        return text == 'T'
+    for kind in (int, float):
+        try:
+            return kind(text.replace('D', 'E') if kind is float else text)
+        except ValueError:
+            pass
+
+    return text
+
+
+def _column(text: str):
+    """Convert a table entry into a python type
+    """
+    if text.startswith("'"):
+        return text[1:-1].replace("''", "'").strip()
+    for kind in (int, float):
+        try:
+            return kind(text.replace('D', 'E') if kind is float else text)
+        except ValueError:
+            pass
+
+    return text
+
+
+def parse_header(cards: list):
+    """Parse the cards of a scan header into its keywords and tables. Tables
+    have a card naming their columns followed by a card per row. Quoted
+    entries of a row are kept whole, spaces and all.
+
+    Arguments:
+        cards {list} -- 80 character header cards, up to and including END
+
+    Returns:
+        dict -- Keywords of the header, with each table as a list of row dicts
+                under a `tables` key
+    """
+    header = {'tables': {}}
+    table = None
+    columns = None
+    for card in cards:
+        if card.startswith('TABLE '):
+            table = card[6:].strip()
+            header['tables'][table] = []
+            columns = None
+        elif card.startswith('ENDTABLE'):
+            table = None
+        elif table is not None:
+            if columns is None:
+                columns = card.split()
+            else:
+                header['tables'][table].append(dict(zip(columns, (_column(v) for v in _tokens(card)))))
+        elif card[8:10] == '= ':
+            header[card[:8].strip()] = _value(card[10:])
+
+    return header
+
+
+def _read_cards(infile, first: bytes):
+    """Read the cards of a header whose first block has already been read.
+    The file is left positioned at the start of the scan data.
+    """
+    cards = []
+    block = first
+    while True:
+        for i in range(0, BLOCK, CARD):
+            card = block[i:i+CARD].decode('ascii', errors='replace')
+            cards.append(card)
+            if card.startswith('END') and card[3:].strip() == '':
+                return cards
+        block = infile.read(BLOCK)
+        if len(block) < BLOCK:
+            return cards
+
+
+def scan_file(path: str, max_scans: int=None):
+    """Describe every scan of an RPFITS file
+
+    Arguments:
+        path {str} -- RPFITS file to scan
+
+    Keyword Arguments:
+        max_scans {int} -- Stop after this many scans, i.e. 1 for the start of
+                           the file only (default: {None})
+
+    Returns:
+        list -- A dict per scan with the file, byte offset and size of the scan,
+                its source(s), date, start time (UT seconds), IFs and header
+    """
+    scans = []
+    size = os.path.getsize(path)
+    with open(path, 'rb') as infile:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(infile.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+
+        offset = 0
+        while offset < size:
+            infile.seek(offset)
+            block = infile.read(BLOCK)
+            if len(block) < BLOCK:
+                break
+            if not block.startswith(HEADER_START):
+                offset += BLOCK
+                continue
+
+            header = parse_header(_read_cards(infile, block))
+            data_start = infile.tell()
+            params = infile.read(4*len(GROUP_PARAMS))
+            ut = None
+            if len(params) == 4*len(GROUP_PARAMS):
+                group = dict(zip(GROUP_PARAMS, struct.unpack(f">{len(GROUP_PARAMS)}f", params)))
+                ut = group['ut'] if 0 <= group['ut'] < 2*86400 else None
+
+            sources = [r['SU_NAME'] for r in header['tables'].get('SU', []) if 'SU_NAME' in r]
+            if len(sources) == 0 and header.get('OBJECT'):
+                sources = [header['OBJECT']]
+
+            ifs = [{'if_no': r.get('IF_NO'), 'freq': r.get('IF_FREQ'), 'bw': r.get('IF_BW'),
+                    'nfreq': r.get('IF_NFREQ')} for r in header['tables'].get('IF', [])]
+
+            scans.append({'file': path, 'offset': offset, 'data_start': data_start,
+                          'sources': sources, 'date': header.get('DATE-OBS'), 'ut': ut,
+                          'ifs': ifs, 'header': header})
+            if max_scans is not None and len(scans) >= max_scans:
+                break
+            offset = data_start - data_start % BLOCK + (BLOCK if data_start % BLOCK else 0)
+
+            # Skip the data of the scan a block at a time, looking only at the
+            # first bytes of each block for the start of the next header
+            while offset < size:
+                infile.seek(offset)
+                if infile.read(len(HEADER_START)) == HEADER_START:
+                    break
+                offset += BLOCK
+
+    for this, following in zip(scans, scans[1:] + [None]):
+        end = following['offset'] if following is not None else size
+        this['nbytes'] = end - this['offset']
+        this['duration'] = None
+        if following is not None and None not in (this['ut'], following['ut']) and \
+           this['date'] == following['date']:
+            this['duration'] = following['ut'] - this['ut']
+
+    return scans
+
+
+def scan_day(files: list):
+    """Summarise the scans of a set of RPFITS files, i.e. a day of observing
+
+    Arguments:
+        files {list} -- RPFITS files to scan
+
+    Returns:
+        dict -- `scans`, the list of all scans, `sources`, the number of scans,
+                bytes and seconds of each source, `files` mapping each file to the
+                sources it contains, and the set of IF frequencies seen
+    """
+    summary = {'scans': [], 'sources': {}, 'files': {}, 'ifs': set()}
+    for f in sorted(files):
+        scans = scan_file(f)
+        summary['scans'].extend(scans)
+        summary['files'][f] = sorted(set(s for scan in scans for s in scan['sources']))
+        for scan in scans:
+            summary['ifs'].update(i['freq'] for i in scan['ifs'] if i['freq'] is not None)
+            for src in scan['sources']:
+                info = summary['sources'].setdefault(src, {'scans': 0, 'nbytes': 0, 'seconds': 0.,
+                                                          'role': mu.source_role(src)})
+                info['scans'] += 1
+                info['nbytes'] += scan['nbytes'] // len(scan['sources'])
+                info['seconds'] += scan['duration'] or 0.
+
+    return summary
+
+
+def day_index(files: list, path: str=INDEX):
+    """Index of the scans of each RPFITS file of a day, kept in a JSON file in
+    the day folder. Only files that are new or have changed size or modification
+    time since they were last indexed are scanned.
+
+    Arguments:
+        files {list} -- RPFITS files of the day
+
+    Keyword Arguments:
+        path {str} -- JSON file the index is kept in (default: {INDEX})
+
+    Returns:
+        dict -- Mapping of each file to its `size`, `mtime` and list of `scans`
+    """
+    index = {}
+    if os.path.exists(path):
+        with open(path, 'r') as infile:
+            index = json.load(infile)
+
+    changed = False
+    for f in files:
+        stat = os.stat(f)
+        entry = index.get(f)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime:
+            continue
+
+        try:
+            scans = [{k: v for k, v in scan.items() if k != 'header'} for scan in scan_file(f)]
+            index[f] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'scans': scans}
+        except Exception as e:
+            # Left for atlod to make sense of, see `wanted_files`
+            logger.log(logging.WARNING, f"Could not scan the headers of {f}: {e}")
+            index[f] = {'size': stat.st_size, 'mtime': stat.st_mtime, 'scans': [], 'error': str(e)}
+        changed = True
+
+    if changed:
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w') as out:
+            json.dump(index, out, indent=1)
+        os.replace(tmp, path)
+
+    return {f: index[f] for f in files}
+
+
+def wanted_files(index: dict, freq: int=None):
+    """Files of a day index that may hold a source that is not ignored in an
+    IF covering `freq`. A file is only left out when that is certain, i.e.
+    every scan of the file names its sources and each scan either holds only
+    ignored sources or, if `freq` is given, has IFs that are all known and none
+    of which covers `freq`. A file whose scans could not be read is kept,
+    leaving atlod to make sense of it.
+
+    Arguments:
+        index {dict} -- Index from `day_index`
+
+    Keyword Arguments:
+        freq {int} -- Frequency of the IF in MHz (default: {None})
+
+    Returns:
+        list -- Files to load, in the order of the index
+    """
+    def excluded(scan):
+        if len(scan['sources']) == 0:
+            return False
+        if all(mu.source_role(src) == 'ignore' for src in scan['sources']):
+            return True
+        ifs = scan['ifs']
+        if freq is None or len(ifs) == 0 or \
+           any(i['freq'] is None or not i['bw'] for i in ifs):
+            return False
+        return not any(abs(i['freq'] - freq*1e6) <= i['bw'] / 2 for i in ifs)
+
+    wanted = []
+    for f, entry in index.items():
+        scans = entry['scans']
+        if entry.get('error') is not None or len(scans) == 0 or \
+           not all(excluded(scan) for scan in scans):
+            wanted.append(f)
+
+    return wanted
+
+
+def calibrator_scans(index: dict):
+    """Lengths of the scans of the primary and secondary calibrators of a day
+
+    Arguments:
+        index {dict} -- Index from `day_index`, of the files to be loaded
+
+    Returns:
+        dict -- Mapping of each calibrator to the list of its scan lengths in
+                seconds. Scans of unknown length, i.e. the last of a file, are left out
+    """
+    durations = {}
+    for entry in index.values():
+        for scan in entry['scans']:
+            if scan.get('duration') is None:
+                continue
+            for src in scan['sources']:
+                if mu.source_role(src) in ('primary', 'secondary'):
+                    durations.setdefault(src, []).append(scan['duration'])
+
+    return durations
+
+
+def check_day(summary: dict):
+    """Return a list of problems with a day that would stop it from being
+    reduced, i.e. a missing primary or secondary calibrator
+
+    Arguments:
+        summary {dict} -- Summary from `scan_day`
+    """
+    roles = [s['role'] for s in summary['sources'].values()]
+    problems = []
+    for role in ('primary', 'secondary', 'target'):
+        if role not in roles:
+            problems.append(f"No {role} source observed")
+
+    return problems
+
+
+if __name__ == '__main__':
+    files = sys.argv[1:] if len(sys.argv) > 1 else glob('raw/*C3132')
+    if len(files) == 0:
+        print(f'USAGE: {sys.argv[0]} [rpfits ...]   (defaults to raw/*C3132 of the current day)')
+        sys.exit(1)
+
+    summary = scan_day(files)
+
+    print(f"{'Source':<16} {'Role':<10} {'Scans':>6} {'MB':>10} {'Minutes':>8}")
+    for src, info in sorted(summary['sources'].items()):
+        print(f"{src:<16} {info['role']:<10} {info['scans']:>6} {info['nbytes']/1e6:>10.1f} "\
+              f"{info['seconds']/60:>8.1f}")
+    print(f"IF frequencies (MHz): {', '.join(f'{f/1e6:.0f}' for f in sorted(summary['ifs']))}")
+
+    for problem in check_day(summary):
+        print(f"WARNING: {problem}")
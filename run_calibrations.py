@@ -1,45 +1,261 @@
-"""Script to batch run calibration scripts across all days. 
+"""Script to batch run calibration scripts across all days.
 
-At this point requires some manual tweaking to run on a specific script type
+The days are taken from the catalogue (see `catalogue.py`), or found by
+globbing `Data/201*` with `--glob`.
+Days are started longest first, with the total size of the RPFITS files in
+`raw/` as the estimate of how long a day takes. Each reduce script is given a
+number of CPU slots (passed to it as GLASS_WORKERS) and one I/O slot, and the
+number of slots in use never exceeds the limits given on the command line.
 
-Need to add option to handle this. 
+The scripts run as asyncio subprocesses of this one process (see
+`task_runner.py`). The output of every script of a day is written as it
+arrives to `run_calibrations.log` in the day folder, each line prefixed with
+the name of the script. A script that runs past `--timeout`, or every running
+script on Ctrl-C, is stopped along with the miriad tasks it started.
 """
 import os
-import sys
 import glob
-import pymir as mu
-from multiprocessing import Pool
-import subprocess as sp
+import time
+import asyncio
+import argparse
+
+import catalogue
+from task_runner import AsyncRunner
+
+# IFs reduced by each calibration script, for the status of a day in the catalogue
+SCRIPT_FREQS = {'reduce_5.py': ['5500'], 'reduce_9.py': ['9500'], 'reduce_both.py': ['5500', '9500']}
+
+
+class Job:
+    """A calibration script to run for a day
+    """
+    def __init__(self, script: str, day: str, cpus: int):
+        """
+        Arguments:
+            script {str} -- Calibration script to execute
+            day {str} -- Folder of the day to execute it in
+            cpus {int} -- Number of CPU slots to give to the script
+        """
+        self.script = script
+        self.day = day
+        self.cpus = cpus
+        self.cost = day_cost(day)
+        self.returncode = None
+        self.seconds = None
+
+    async def run(self, runner: AsyncRunner, out):
+        """Execute the script in its day folder, streaming its output to the log
+        of the day
+
+        Arguments:
+            runner {AsyncRunner} -- Runner to execute the script on
+            out {file} -- Open log of the day
+        """
+        env = dict(os.environ, GLASS_WORKERS=str(self.cpus))
+
+        start = time.time()
+        try:
+            result = await runner.run(['python3', self.script], name=self.script, cwd=self.day,
+                                      env=env, out=out)
+            self.returncode = result['returncode']
+            if result['timed_out']:
+                print(f"{self.script} in {self.day} timed out and was stopped")
+        finally:
+            self.seconds = time.time() - start
+
+
+def positive_int(value: str):
+    """Argument type of a count that must be at least 1
+    """
+    count = int(value)
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, not {count}")
+    return count
+
+
+def positive_float(value: str):
+    """Argument type of a duration that must be more than 0
+    """
+    number = float(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be more than 0, not {number}")
+    return number
+
+
+def day_cost(day: str):
+    """Estimated cost of reducing a day, taken as the total size of its RPFITS files
 
-def run(s):
-    """Function to call python calibration script
-    
     Arguments:
-        s {tuple} -- Element one is the calibration script
-                     the second is the working directory to execute in
+        day {str} -- Folder of the day
     """
-    p = sp.run(s[0].split(), cwd=s[1])
+    return sum(os.path.getsize(f) for f in glob.glob(f"{day}/raw/*C3132*"))
+
+
+def find_days(days: list=None, pending: bool=False, use_glob: bool=False):
+    """Return the day folders to process. Every day in the catalogue is
+    processed unless the days are given or globbed.
+
+    Keyword Arguments:
+        days {list} -- Days given by the user, used as is (default: {None})
+        pending {bool} -- Only the days waiting to be reduced according to the
+                          catalogue, i.e. those added by new_day.py (default: {False})
+        use_glob {bool} -- Find the days by globbing `Data/201*` rather than
+                           from the catalogue (default: {False})
+    """
+    if days:
+        # Assume user knows what they are doing
+        return days
+
+    if use_glob:
+        # Should be OK for the moment. No data in 2020's yet
+        return sorted(glob.glob('Data/201*'))
+
+    return sorted(set(d['path'] for d in catalogue.days(status='pending' if pending else None)
+                      if d['path'] is not None and os.path.exists(d['path'])))
+
 
-# Should be OK for the moment. No data in 2020's yet
-if len(sys.argv) > 1:
-    # Assume user knows what they are doing
-    days = sys.argv[1:]
-else:
-    days = glob.glob('Data/201*')
+def schedule(jobs: list, cpus: int, io_slots: int, timeout: float=None):
+    """Run jobs longest first, starting each as soon as enough CPU and I/O slots
+    are free. If the next longest job does not fit, a smaller one that does is
+    started instead.
+
+    Arguments:
+        jobs {list} -- Jobs to run
+        cpus {int} -- Number of CPU slots available
+        io_slots {int} -- Number of jobs that may read and write data at once
+
+    Keyword Arguments:
+        timeout {float} -- Seconds a job may run for before it is stopped (default: {None})
+
+    Raises:
+        ValueError -- There are no CPU or I/O slots, or a job needs more CPU
+                      slots than there are, so it could never be started
+    """
+    if cpus < 1 or io_slots < 1:
+        raise ValueError(f"At least one CPU and I/O slot are needed, not {cpus} and {io_slots}")
+    if any(j.cpus > cpus for j in jobs):
+        raise ValueError(f"A job needs more than the {cpus} CPU slots available")
+
+    try:
+        asyncio.run(_schedule(jobs, cpus, io_slots, AsyncRunner(limit=io_slots, timeout=timeout)))
+    except KeyboardInterrupt:
+        print("Interrupted, the running scripts have been stopped")
+
+
+async def _schedule(jobs: list, cpus: int, io_slots: int, runner: AsyncRunner):
+    free = {'cpus': cpus, 'io': io_slots}
+    pending = sorted(jobs, key=lambda j: j.cost, reverse=True)
+    running = {}
+    # The log of each day is shared by its jobs, and open while any of them runs
+    logs = {}
+    cond = asyncio.Condition()
+
+    async def work(job):
+        day = logs.setdefault(job.day, {'jobs': 0, 'out': None})
+        if day['out'] is None:
+            day['out'] = open(os.path.join(job.day, 'run_calibrations.log'), 'a')
+        day['jobs'] += 1
+        try:
+            await job.run(runner, day['out'])
+        except Exception as e:
+            print(f"{job.script} in {job.day} could not be run: {e}")
+            job.returncode, job.seconds = -1, 0.
+        finally:
+            day['jobs'] -= 1
+            if day['jobs'] == 0:
+                day['out'].close()
+                day['out'] = None
+            async with cond:
+                free['cpus'] += job.cpus
+                free['io'] += 1
+                del running[job]
+                cond.notify()
+
+    try:
+        async with cond:
+            while pending or running:
+                fits = [j for j in pending if j.cpus <= free['cpus'] and free['io'] > 0]
+                if len(fits) == 0:
+                    await cond.wait()
+                    continue
+
+                job = fits[0]
+                pending.remove(job)
+                free['cpus'] -= job.cpus
+                free['io'] -= 1
+                print(f"Starting {job.script} in {job.day} ({job.cost/1e9:.1f} GB)")
+                running[job] = asyncio.ensure_future(work(job))
+    finally:
+        # On an interrupt, stop every running script before returning
+        tasks = list(running.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def summary(jobs: list):
+    """Print the wall time and exit code of each job. Jobs that were not run
+    to the end, i.e. after an interrupt, have no exit code.
+
+    Arguments:
+        jobs {list} -- Jobs that have been run
+    """
+    print(f"{'Day':<20} {'Script':<14} {'GB':>6} {'Wall (min)':>11} {'Exit':>5}")
+    for job in sorted(jobs, key=lambda j: (j.day, j.script)):
+        returncode = '-' if job.returncode is None else job.returncode
+        print(f"{os.path.basename(job.day):<20} {job.script:<14} {job.cost/1e9:>6.1f} "\
+              f"{(job.seconds or 0)/60:>11.1f} {returncode:>5}")
+
+    succeeded = [j for j in jobs if j.returncode == 0]
+    print(f"{len(succeeded)} of {len(jobs)} jobs succeeded")
+
+
+def record_failures(jobs: list):
+    """Mark the IFs of each failed job as failed in the catalogue, so they are
+    no longer picked up as pending. Successful reductions record themselves.
+
+    Arguments:
+        jobs {list} -- Jobs that have been run
+    """
+    for job in jobs:
+        if job.returncode not in (0, None):
+            for freq in SCRIPT_FREQS.get(job.script, []):
+                catalogue.record_day(os.path.basename(os.path.normpath(job.day)), freq, 'failed')
 
-# Tuple of mirstr task to execute and the cwd to pass
-# to subprocess.run()
-jobs = []
 
-for day in days:
-    a =[("python3 reduce_5.py", day),
-        ("python3 reduce_9.py", day)
-        ]
-    jobs.extend(a)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the calibration scripts across days of data')
+    parser.add_argument('days', nargs='*', help='Day folders to process. Defaults to the days '\
+                                                'in the catalogue')
+    parser.add_argument('--scripts', nargs='+', default=['reduce_5.py', 'reduce_9.py'],
+                        help='Calibration scripts to run for each day. reduce_both.py '\
+                             'reduces both IFs while reading the raw data once')
+    parser.add_argument('--cpus', type=positive_int, default=os.cpu_count(),
+                        help='Total number of CPU slots to use')
+    parser.add_argument('--job-cpus', type=positive_int, default=4,
+                        help='CPU slots given to each calibration script')
+    parser.add_argument('--io-slots', type=positive_int, default=4,
+                        help='Number of calibration scripts reading and writing data at once')
+    parser.add_argument('--pending', action='store_true',
+                        help='Process the days registered as pending in the catalogue by new_day.py')
+    parser.add_argument('--glob', action='store_true',
+                        help='Find the days by globbing Data/201* rather than from the catalogue')
+    parser.add_argument('--timeout', type=positive_float,
+                        help='Hours a calibration script may run for before it is stopped')
+    parser.add_argument('--autotune', action='store_true',
+                        help='Choose the solution interval and nfbin of each day from its '\
+                             'calibrator scans and flags')
+    args = parser.parse_args()
 
+    # Passed on to the calibration scripts with the rest of the environment
+    if args.autotune:
+        os.environ['GLASS_AUTOTUNE'] = '1'
 
+    job_cpus = min(args.job_cpus, args.cpus)
+    jobs = [Job(script, day, job_cpus) for day in find_days(args.days, args.pending, args.glob)
+            for script in args.scripts]
 
-pool = Pool(10)
-result = pool.map(run, jobs)
-pool.close()
-pool.join()
\ No newline at end of file
+    schedule(jobs, args.cpus, args.io_slots,
+             timeout=args.timeout * 3600 if args.timeout else None)
+    summary(jobs)
+    record_failures(jobs)
@@ -1,53 +1,186 @@
 """Script to batch run the uvfmeas task using the secondary visibility data
 
-Need to add option to handle this. 
+uvfmeas fits a flux density model to both IFs of the secondary of each day.
+A day is skipped if its `Cal_Plots/secondary_both.txt` is newer than the
+calibrated secondaries, so only days that have been reduced since the last
+run are measured. The days and their secondaries are taken from the catalogue
+(see `catalogue.py`), or found by globbing `Data/201*` with `--glob`. The fit
+of each day is read from the uvfmeas output and kept
+in the `uvfmeas` table of the catalogue (see `catalogue.py`), so the flux of a
+secondary over the semester is available without running anything:
+
+    python3 run_uvfmeas.py [Data/2016-11-08 ...] [--glob]
+    python3 catalogue.py --uvfmeas 2245-328
 """
 import os
 import sys
 import glob
-import pymir as mu
-from multiprocessing import Pool
-import subprocess as sp
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import catalogue
+import mir_utils as mu
+from checkpoint import file_manifest
+from miriad_parsers import parse_uvfmeas
+
+logger = logging.getLogger()
+
+WORKERS = 4
+FREQS = ['5500', '9500']
+
+
+def catalogue_secondaries(days: list=None):
+    """Secondary of each day recorded in the catalogue with both IFs of
+    `FREQS`
+
+    Keyword Arguments:
+        days {list} -- Only these days, by folder or name (default: {None})
+
+    Returns:
+        dict -- Name of the secondary of each day folder
+    """
+    names = None if days is None else {os.path.basename(os.path.normpath(d)) for d in days}
+    freqs = {}
+    for src in catalogue.sources(role='secondary'):
+        if src['path'] is None or (names is not None and src['day'] not in names):
+            continue
+        # Recorded as <day>/uv_calibrators/<secondary>.<freq>
+        folder = os.path.dirname(os.path.dirname(src['path']))
+        freqs.setdefault((folder, src['name'].split('.')[0]), set()).add(src['freq'])
+
+    return {folder: name for (folder, name), found in sorted(freqs.items())
+            if found >= set(FREQS)}
+
+
+def find_secondary(day: str):
+    """Name of the secondary calibrator of a day, from its `uv_calibrators`.
+    Used for days found with `--glob`
+    """
+    folder = os.path.join(day, 'uv_calibrators')
+    if not os.path.exists(folder):
+        return None
+
+    for src in sorted(os.listdir(folder)):
+        name = src.split('.')[0]
+        if name in mu.secondary_srcs:
+            return name
+
+    return None
+
+
+def is_current(log: str, inputs: list):
+    """Whether a uvfmeas log is newer than all of the items of its inputs
+    """
+    if not os.path.exists(log):
+        return False
+
+    return os.path.getmtime(log) > max(m['mtime'] for m in file_manifest(inputs))
+
+
+def _read(path: str):
+    """Text of a file, empty if it does not exist
+    """
+    if not os.path.exists(path):
+        return ''
+    with open(path, 'r') as infile:
+        return infile.read()
+
+
+def run(day: str, secondary: str=None, force: bool=False):
+    """Measure the secondary of a day with uvfmeas, unless its measurement is
+    up to date, and record the fit in the catalogue
 
-def run(s):
-    """Function to call uvfmeas
-    
     Arguments:
-        s {tuple} -- Element one is the calibration working directory to execute in
+        day {str} -- Folder of the day
+
+    Keyword Arguments:
+        secondary {str} -- Secondary of the day. It is looked for in the
+                           `uv_calibrators` of the day if not given (default: {None})
+        force {bool} -- Run uvfmeas even if its log is up to date (default: {False})
+
+    Returns:
+        str -- `measured`, `cached`, `failed` or `skipped` for a day without both
+               IFs of a secondary
     """
-    secondary_srcs = ['2245-328', '2312-319', '2255-282']
-    secondary = None
-
-    if not os.path.exists(f"{s}/uv_calibrators/"):
-        return
-
-    srcs = os.listdir(f"{s}/uv_calibrators/")
-    for src in srcs:
-        src = src.replace('.5500','')
-        if src in secondary_srcs:
-            secondary = src
-
-    secondary_5 = f"{s}/uv_calibrators/{secondary}.5500"
-    secondary_9 = f"{s}/uv_calibrators/{secondary}.9500"
-
-    if os.path.exists(secondary_5) and os.path.exists(secondary_9):
-        uvfmeas = f"uvfmeas vis={secondary_5},{secondary_9} stokes=i "\
-                  f"device={s}/Cal_Plots/secondary_both.png/PNG "\
-                  f"log={s}/Cal_Plots/secondary_both.txt"
-        print(uvfmeas)
-
-        uvfmeas = mu.mirstr(uvfmeas).run()
-        print(uvfmeas)
-
-
-# Should be OK for the moment. No data in 2020's yet
-if len(sys.argv) > 1:
-    # Assume user knows what they are doing
-    days = sys.argv[1:]
-else:
-    days = glob.glob('Data/201*')
-
-pool = Pool(4)
-result = pool.map(run, days)
-pool.close()
-pool.join()
+    name = os.path.basename(os.path.normpath(day))
+    secondary = find_secondary(day) if secondary is None else secondary
+    if secondary is None:
+        return 'skipped'
+
+    inputs = [os.path.join(day, 'uv_calibrators', f"{secondary}.{freq}") for freq in FREQS]
+    if not all(os.path.exists(i) for i in inputs):
+        return 'skipped'
+
+    plots = os.path.join(day, 'Cal_Plots')
+    log = os.path.join(plots, 'secondary_both.txt')
+    # uvfmeas reports the fit on its output rather than in the log
+    output = os.path.join(plots, 'secondary_both_uvfmeas.txt')
+
+    if not force and is_current(log, inputs):
+        if len(catalogue.uvfmeas(source=secondary, day=name)) == 0:
+            text, table = (_read(f) for f in (output, log))
+            catalogue.record_uvfmeas(name, secondary, parse_uvfmeas(text, log=table), log)
+        return 'cached'
+
+    mu.make_dir(plots)
+    mu.rm_uv(log)
+    with mu.task_tags(day=name, stage='uvfmeas'):
+        proc = mu.run_task(f"uvfmeas vis={','.join(inputs)} stokes=i "\
+                           f"device={plots}/secondary_both.png/PNG log={log}")
+    with open(output, 'w') as out:
+        out.write(str(proc))
+
+    if proc.returncode != 0 or not os.path.exists(log):
+        logger.log(logging.WARNING, f"uvfmeas of {secondary} in {day} failed")
+        return 'failed'
+
+    fit = parse_uvfmeas(proc.output, log=_read(log))
+    catalogue.record_uvfmeas(name, secondary, fit, log)
+    logger.log(logging.INFO, f"{name} {secondary}: {fit['flux']} Jy at {fit['ref_freq']} GHz, "\
+                             f"alpha {fit['alpha']}")
+
+    return 'measured'
+
+
+def _run(day: str, secondary: str=None, force: bool=False):
+    try:
+        return run(day, secondary=secondary, force=force)
+    except Exception as e:
+        logger.log(logging.WARNING, f"{day} could not be measured: {e}")
+        return 'failed'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the secondary of each day with uvfmeas')
+    parser.add_argument('days', nargs='*', help='Days to measure (default: the days in the catalogue)')
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help=f'Number of days measured at once (default {WORKERS})')
+    parser.add_argument('--force', action='store_true',
+                        help='Measure days whose measurement is up to date')
+    parser.add_argument('--glob', action='store_true',
+                        help='Find the days by globbing Data/201*, and their secondaries in '\
+                             'uv_calibrators, rather than from the catalogue')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s [%(threadName)-12.12s] [%(levelname)-5.5s]  %(message)s",
+                        level=logging.INFO)
+
+    if args.glob:
+        # Should be OK for the moment. No data in 2020's yet
+        days = {d: None for d in (args.days or sorted(glob.glob('Data/201*')))}
+    else:
+        days = catalogue_secondaries(args.days or None)
+        found = {os.path.basename(d) for d in days}
+        for d in args.days:
+            if os.path.basename(os.path.normpath(d)) not in found:
+                logger.log(logging.WARNING, f"{d} has no secondary of both IFs in the catalogue, "\
+                                            "use --glob to look in its uv_calibrators")
+
+    with ThreadPoolExecutor(max_workers=args.workers, thread_name_prefix='uvfmeas') as pool:
+        results = list(pool.map(lambda d: _run(d, secondary=days[d], force=args.force), days))
+
+    for status in ('measured', 'cached', 'failed', 'skipped'):
+        print(f"{status:<9} {results.count(status)}")
+
+    sys.exit(1 if 'failed' in results else 0)
@@ -0,0 +1,336 @@
+"""Staging of the reduction of a day on local scratch disk.
+
+The days live on shared network storage, where every pass of pgflag, gpcal
+and friends over a dataset pays the network latency. When GLASS_SCRATCH names
+a local folder (e.g. `GLASS_SCRATCH=$TMPDIR`), a reduce script copies `raw/`
+and the products an earlier run may restore from into a private folder on
+scratch, runs the whole reduction there and copies the products back. Copies
+in both directions run side by side and each file is checksummed on both ends.
+The checkpoint records stay in the day folder, so a staged run and an in-place
+run skip the same stages.
+
+Only the products of the IFs being reduced are staged in, and only the files
+created or changed on scratch are copied back, so the reductions of both IFs
+of a day can be staged at once without one copying stale products of the
+other over newer ones. Datasets removed on scratch are removed from the day,
+as are the items of a rewritten dataset that it no longer has.
+
+    with staging.staged(freqs=[5500]) as checkpoints:
+        ...
+        reduction.add_if_reduction(graph, ..., checkpoints=checkpoints)
+        graph.run()
+
+Without GLASS_SCRATCH, or if the scratch disk is too small for the day, the
+reduction runs in place as before.
+"""
+import os
+import glob
+import time
+import hashlib
+import logging
+import sqlite3
+import shutil as su
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import catalogue
+import mir_utils as mu
+from checkpoint import Checkpoints, CHECKPOINT_DIR
+
+logger = logging.getLogger()
+
+SCRATCH = os.environ.get('GLASS_SCRATCH')
+# Leave the scratch copy of a failed reduction in place to be inspected. It is
+# removed otherwise, so that repeated failures do not fill the scratch disk.
+KEEP_FAILED = os.environ.get('GLASS_KEEP_SCRATCH', '0') == '1'
+COPY_WORKERS = 8
+# Scratch space needed, as a multiple of the size of the RPFITS files
+SPACE_FACTOR = 3
+CHUNK = 1 << 22
+
+# Copied to scratch: the RPFITS files and their index and, for each IF, its
+# flagging, the solution intervals chosen for it and the products a rerun
+# restores rather than recreates, see `stage_in`
+STAGE_IN = ['raw', 'rpfits_index.json']
+STAGE_IN_IF = ['flag_select_{freq}.dat', 'calibration_tuning_{freq}.json', '*.{freq}',
+               'uv_calibrators/*.{freq}', 'uv_mosaic/*.{freq}']
+# Left behind on scratch: copies of the RPFITS files and the atlod output,
+# which can be recreated from them
+STAGE_OUT_SKIP = ['raw', 'uv_data']
+
+
+def checksum(path: str):
+    """MD5 digest of a file, read in chunks
+
+    Arguments:
+        path {str} -- File to checksum
+
+    Returns:
+        bytes -- Digest of the file
+    """
+    digest = hashlib.md5()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(CHUNK), b''):
+            digest.update(chunk)
+
+    return digest.digest()
+
+
+def copy_file(src: str, dest: str):
+    """Copy a file, checksumming it as it is read and again once written. The
+    copy keeps the modification time of the original and only replaces `dest`
+    once it has been verified.
+
+    Arguments:
+        src {str} -- File to copy
+        dest {str} -- Path to copy it to
+
+    Raises:
+        OSError -- The checksums of the original and the copy differ
+
+    Returns:
+        int -- Number of bytes copied
+    """
+    mu.make_dir(os.path.dirname(dest))
+    tmp = f"{dest}.staging"
+    original = hashlib.md5()
+    with open(src, 'rb') as infile, open(tmp, 'wb') as out:
+        for chunk in iter(lambda: infile.read(CHUNK), b''):
+            original.update(chunk)
+            out.write(chunk)
+    su.copystat(src, tmp)
+
+    if checksum(tmp) != original.digest():
+        os.remove(tmp)
+        raise OSError(f"Checksum of the copy of {src} in {dest} does not match")
+
+    os.replace(tmp, dest)
+
+    return os.path.getsize(dest)
+
+
+def stage_in(freqs: list=None):
+    """Entries of a day to copy to scratch for the reduction of a set of IFs
+
+    Keyword Arguments:
+        freqs {list} -- Frequencies of the IFs to be reduced. Those of every IF
+                        are staged if not given (default: {None})
+
+    Returns:
+        list -- Names and glob patterns, relative to the day
+    """
+    freqs = ['*'] if freqs is None else freqs
+
+    return STAGE_IN + [n.format(freq=freq) for freq in freqs for n in STAGE_IN_IF]
+
+
+def _changed(src: str, dest: str):
+    """Whether a file differs in size or modification time from its copy
+    """
+    if not os.path.exists(dest):
+        return True
+    a, b = os.stat(src), os.stat(dest)
+
+    return a.st_size != b.st_size or int(a.st_mtime) != int(b.st_mtime)
+
+
+def sync(src: str, dest: str, names: list, workers: int=COPY_WORKERS):
+    """Copy files, folders and miriad datasets from one folder to another,
+    skipping files whose copy is already up to date
+
+    Arguments:
+        src {str} -- Folder to copy from
+        dest {str} -- Folder to copy to
+        names {list} -- Names or glob patterns of the entries of `src` to copy
+
+    Keyword Arguments:
+        workers {int} -- Number of files copied at once (default: {COPY_WORKERS})
+
+    Returns:
+        tuple -- Number of files and bytes copied
+    """
+    files = []
+    for name in names:
+        for path in glob.glob(os.path.join(src, name)):
+            if not os.path.isdir(path):
+                files.append(path)
+                continue
+            for root, _, items in os.walk(path):
+                # Folders are made even if empty, i.e. a dataset with no items yet
+                mu.make_dir(os.path.join(dest, os.path.relpath(root, src)))
+                files += [os.path.join(root, f) for f in items]
+
+    pairs = [(f, os.path.join(dest, os.path.relpath(f, src))) for f in files]
+    pairs = [(a, b) for a, b in pairs if not a.endswith('.staging') and _changed(a, b)]
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='copy') as pool:
+        nbytes = sum(pool.map(lambda p: copy_file(*p), pairs))
+
+    return len(pairs), nbytes
+
+
+def _log_copy(src: str, dest: str, count: int, nbytes: int, start: float):
+    seconds = time.time() - start
+    logger.log(logging.INFO, f"Copied {count} files ({nbytes/1e9:.2f} GB) from {src} to {dest} "\
+                             f"in {seconds:.0f}s ({nbytes/1e6/max(seconds, 1e-3):.0f} MB/s)")
+
+
+def _transfer(src: str, dest: str, names: list):
+    start = time.time()
+    count, nbytes = sync(src, dest, names)
+    _log_copy(src, dest, count, nbytes, start)
+
+
+def snapshot(folder: str, skip: list=()):
+    """Size, modification time and inode of every file under a folder
+
+    Arguments:
+        folder {str} -- Folder to describe
+
+    Keyword Arguments:
+        skip {list} -- Entries at the top of the folder to leave out (default: {()})
+
+    Returns:
+        dict -- Mapping of the path of each file, relative to `folder`, to a
+                tuple that changes whenever the file is written or replaced
+    """
+    files = {}
+    for root, dirs, items in os.walk(folder):
+        if root == folder:
+            dirs[:] = [d for d in dirs if d not in skip]
+            items = [i for i in items if i not in skip]
+        for item in items:
+            if item.endswith('.staging'):
+                continue
+            path = os.path.join(root, item)
+            stat = os.stat(path)
+            files[os.path.relpath(path, folder)] = (stat.st_size, stat.st_mtime_ns, stat.st_ino)
+
+    return files
+
+
+def _datasets(files):
+    """Miriad datasets among a set of files, i.e. the folders holding a header
+    """
+    return set(os.path.dirname(f) for f in files if os.path.basename(f) == 'header')
+
+
+def _unchanged(day: str, dataset: str, before: dict):
+    """Whether the copy of a dataset in the day is still the one staged in
+    """
+    for root, _, items in os.walk(os.path.join(day, dataset)):
+        for item in items:
+            path = os.path.join(root, item)
+            stat = os.stat(path)
+            entry = before.get(os.path.relpath(path, day))
+            if entry is None or entry[0] != stat.st_size or entry[1] // 10**9 != int(stat.st_mtime):
+                return False
+
+    return True
+
+
+def copy_back(work: str, day: str, before: dict, workers: int=COPY_WORKERS):
+    """Bring the changes made on scratch back to the day. Files created or
+    changed since they were staged in are copied, datasets that were staged in
+    and since removed are removed from the day unless the day's copy has also
+    changed, and items that a dataset changed on scratch no longer has are
+    removed from the day's copy.
+
+    Arguments:
+        work {str} -- Copy of the day on scratch
+        day {str} -- Day folder
+        before {dict} -- `snapshot` of `work` once staged in
+
+    Keyword Arguments:
+        workers {int} -- Number of files copied at once (default: {COPY_WORKERS})
+    """
+    start = time.time()
+    after = snapshot(work, skip=STAGE_OUT_SKIP)
+    changed = [f for f, entry in after.items() if before.get(f) != entry]
+
+    for folder in set(os.path.dirname(f) for f in after):
+        mu.make_dir(os.path.join(day, folder))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='copy') as pool:
+        nbytes = sum(pool.map(lambda f: copy_file(os.path.join(work, f), os.path.join(day, f)),
+                              changed))
+    _log_copy(work, day, len(changed), nbytes, start)
+
+    datasets = _datasets(after)
+    for dataset in sorted(_datasets(before) - datasets):
+        if _unchanged(day, dataset, before):
+            logger.log(logging.INFO, f"Removing {dataset} from {day}, as it was removed on scratch")
+            mu.rm_uv(os.path.join(day, dataset))
+        else:
+            logger.log(logging.WARNING, f"{dataset} was removed on scratch but has changed in "\
+                                        f"{day}, leaving it in place")
+
+    for dataset in sorted(set(os.path.dirname(f) for f in changed) & datasets):
+        for root, _, items in os.walk(os.path.join(day, dataset)):
+            for item in items:
+                if os.path.relpath(os.path.join(root, item), day) not in after:
+                    os.remove(os.path.join(root, item))
+
+
+@contextmanager
+def staged(scratch: str=SCRATCH, freqs: list=None, keep_failed: bool=KEEP_FAILED):
+    """Run the body of a `with` block in a copy of the current day on scratch
+    disk, then copy the changes back. The copy is private to this process, so
+    both IFs of a day can be staged at once. The changes are copied back and
+    the copy removed whether or not the body succeeds.
+
+    Keyword Arguments:
+        scratch {str} -- Scratch folder. The reduction runs in place if not
+                         given (default: {SCRATCH})
+        freqs {list} -- Frequencies of the IFs being reduced, whose products
+                        are staged in. Those of every IF are staged if not
+                        given (default: {None})
+        keep_failed {bool} -- Leave the copy on scratch if the body fails
+                              (default: {KEEP_FAILED})
+
+    Yields:
+        Checkpoints -- The checkpoint records of the day, for the reduction
+    """
+    day = os.getcwd()
+    checkpoints = Checkpoints(os.path.join(day, CHECKPOINT_DIR))
+    if not scratch:
+        yield checkpoints
+        return
+
+    needed = SPACE_FACTOR * sum(mu.dataset_size(f) for f in glob.glob(os.path.join(day, 'raw', '*')))
+    mu.make_dir(scratch)
+    free = su.disk_usage(scratch).free
+    if free < needed:
+        logger.log(logging.WARNING, f"{scratch} has {free/1e9:.1f} GB free and the day needs "\
+                                    f"{needed/1e9:.1f} GB, running in place")
+        yield checkpoints
+        return
+
+    # Named after the day, as tasks take the day from the folder they run in
+    work = os.path.join(scratch, f"glass_{os.getpid()}", os.path.basename(day))
+    _transfer(day, work, stage_in(freqs))
+    before = snapshot(work, skip=STAGE_OUT_SKIP)
+
+    failed = True
+    os.chdir(work)
+    try:
+        yield checkpoints
+        failed = False
+    finally:
+        os.chdir(day)
+        try:
+            copy_back(work, day, before)
+            _relocate(work, day)
+        finally:
+            if failed and keep_failed:
+                logger.log(logging.WARNING, f"Keeping {work} of the failed reduction")
+            else:
+                su.rmtree(os.path.dirname(work), ignore_errors=True)
+
+
+def _relocate(work: str, day: str):
+    """Point the catalogue at the products copied back from scratch
+    """
+    try:
+        catalogue.relocate(work, day)
+    except (sqlite3.Error, OSError) as e:
+        logger.log(logging.WARNING, f"Could not update the catalogue: {e}")
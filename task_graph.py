@@ -0,0 +1,207 @@
+"""A small dependency aware scheduler to run the miriad steps of a reduction.
+
+Each task declares the files it reads and the files it writes. Dependencies
+are derived from the order tasks are added, in the same way a straight-line
+script would execute them:
+- a task that reads a file waits for the last task that wrote it
+- a task that writes a file waits for the last writer and any readers since
+
+Independent branches are then free to run at the same time. Miriad tasks run
+as subprocesses, so a pool of threads is enough to keep them busy. Tasks whose
+outputs are only known once they have run (e.g. uvsplit) can `expand` the
+graph with further tasks when they finish.
+
+Each task runs in a copy of the context (see `contextvars`) it was added from,
+as does its `expand`, so context variables set when building the graph carry
+through to the tasks.
+"""
+import threading
+import contextvars
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+logger = logging.getLogger()
+
+
+class Task:
+    """A single step of a reduction and its bookkeeping
+    """
+    def __init__(self, name: str, func, args: tuple, kwargs: dict, reads: list,
+                 writes: list, expand=None):
+        """Create a new task
+
+        Arguments:
+            name {str} -- Unique name of the task
+            func {callable} -- Function to call
+            args {tuple} -- Positional arguments to `func`
+            kwargs {dict} -- Keyword arguments to `func`
+            reads {list} -- Files (or other named resources) the task reads
+            writes {list} -- Files (or other named resources) the task creates or modifies
+
+        Keyword Arguments:
+            expand {callable} -- Called as `expand(graph, result)` once the task
+                                 has finished, to add further tasks (default: {None})
+        """
+        self.name = name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.reads = list(reads)
+        self.writes = list(writes)
+        self.expand = expand
+        self.deps = set()
+        self.state = 'pending'
+        self.result = None
+        self.seconds = None
+        self.context = contextvars.copy_context()
+
+    def __repr__(self):
+        return f"Task({self.name}, {self.state})"
+
+    def run(self):
+        """Execute the task in the current thread. The thread is renamed after the
+        task so that log records identify the task that produced them.
+        """
+        thread = threading.current_thread()
+        thread_name = thread.name
+        thread.name = self.name
+
+        start = time.time()
+        try:
+            return self.context.run(self.func, *self.args, **self.kwargs)
+        finally:
+            self.seconds = time.time() - start
+            thread.name = thread_name
+
+
+class TaskGraph:
+    """A set of tasks and the scheduler to execute them
+    """
+    def __init__(self, workers: int=4, on_failure=None):
+        """Create an empty task graph
+
+        Keyword Arguments:
+            workers {int} -- Maximum number of tasks to run at once (default: {4})
+            on_failure {callable} -- Called with no arguments when a task fails or
+                                     the graph is interrupted, before waiting
+                                     for the tasks still running, i.e. to stop
+                                     them (default: {None})
+        """
+        self.workers = max(1, workers)
+        self.on_failure = on_failure
+        self.tasks = {}
+        self._writer = {}
+        self._readers = {}
+        self._lock = threading.RLock()
+
+    def add(self, name: str, func, *args, reads: list=(), writes: list=(), expand=None, **kwargs):
+        """Add a task to the graph. Its dependencies are derived from the files
+        it reads and writes against the tasks already in the graph.
+
+        Arguments:
+            name {str} -- Unique name of the task
+            func {callable} -- Function to call, with any further positional and
+                               keyword arguments passed through to it
+
+        Keyword Arguments:
+            reads {list} -- Files the task reads (default: {()})
+            writes {list} -- Files the task creates or modifies (default: {()})
+            expand {callable} -- Called as `expand(graph, result)` once the task
+                                 has finished (default: {None})
+
+        Raises:
+            ValueError -- Raised if a task with the same name already exists
+
+        Returns:
+            Task -- The new task
+        """
+        with self._lock:
+            if name in self.tasks:
+                raise ValueError(f'Task {name} already exists in the graph')
+
+            task = Task(name, func, args, kwargs, reads, writes, expand=expand)
+            for f in task.reads + task.writes:
+                if f in self._writer:
+                    task.deps.add(self._writer[f])
+            for f in task.writes:
+                task.deps.update(self._readers.get(f, []))
+            task.deps.discard(name)
+
+            for f in task.reads:
+                self._readers.setdefault(f, []).append(name)
+            for f in task.writes:
+                self._writer[f] = name
+                self._readers[f] = []
+
+            self.tasks[name] = task
+
+        return task
+
+    def _ready(self):
+        """Return the pending tasks whose dependencies have all finished
+        """
+        with self._lock:
+            return [t for t in self.tasks.values() if t.state == 'pending' and
+                    all(self.tasks[d].state in ('done', 'skipped') for d in t.deps)]
+
+    def _failed(self):
+        """Call `on_failure` once the graph has failed
+        """
+        if self.on_failure is not None:
+            self.on_failure()
+
+    def run(self):
+        """Execute every task in the graph, respecting dependencies. If a task fails
+        no new tasks are started, `on_failure` is called, those still running are
+        waited for, and the exception is then raised.
+
+        Returns:
+            dict -- Mapping of task name to the value the task returned
+        """
+        failure = None
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                if failure is None:
+                    for task in self._ready():
+                        if len(running) >= self.workers:
+                            break
+                        task.state = 'running'
+                        logger.log(logging.INFO, f"Starting task {task.name}")
+                        running[pool.submit(task.run)] = task
+
+                if len(running) == 0:
+                    break
+
+                try:
+                    finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                except BaseException:
+                    # i.e. KeyboardInterrupt, the pool waits for the running tasks
+                    self._failed()
+                    raise
+                for future in finished:
+                    task = running.pop(future)
+                    try:
+                        task.result = future.result()
+                    except BaseException as e:
+                        task.state = 'failed'
+                        logger.log(logging.ERROR, f"Task {task.name} failed: {e!r}")
+                        if failure is None:
+                            failure = e
+                            self._failed()
+                        continue
+
+                    task.state = 'done'
+                    logger.log(logging.INFO, f"Finished task {task.name} in {task.seconds:.1f}s")
+                    if task.expand is not None and failure is None:
+                        task.context.run(task.expand, self, task.result)
+
+        if failure is not None:
+            raise failure
+
+        stuck = [t.name for t in self.tasks.values() if t.state == 'pending']
+        if len(stuck) > 0:
+            raise RuntimeError(f"Tasks could not be scheduled: {', '.join(stuck)}")
+
+        return {name: t.result for name, t in self.tasks.items()}
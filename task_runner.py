@@ -0,0 +1,202 @@
+"""Run many external tasks at once from a single process with asyncio.
+
+Each task is started as an asyncio subprocess. Its stdout and stderr are read
+line by line as they are written, and each line is passed on at once,
+prefixed with the name of the task, to the logger or to a log file. A
+semaphore limits how many tasks run at once. A task may be given a timeout, and
+a task that times out or is cancelled has its whole process group
+terminated, then killed if it does not exit within TERMINATE_GRACE seconds.
+No thread or interpreter is needed per task, so hundreds of pgflag or uvplt
+tasks can be driven by one event loop.
+
+    runner = AsyncRunner(limit=16)
+    result = asyncio.run(runner.run('uvplt vis=1934-638.5500 ...', timeout=600))
+
+Code that is not itself asynchronous, such as the tasks of a `TaskGraph`,
+hands its coroutines to a `BackgroundLoop` and gets a `concurrent.futures`
+future back.
+"""
+import os
+import time
+import shlex
+import signal
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger()
+
+# Number of tasks an AsyncRunner runs at once
+RUNNER_LIMIT = 64
+# Seconds a terminated task is given to exit before it is killed
+TERMINATE_GRACE = 10
+
+
+class AsyncRunner:
+    """Runs external tasks as asyncio subprocesses, streaming their output
+    """
+    def __init__(self, limit: int=RUNNER_LIMIT, timeout: float=None, grace: float=TERMINATE_GRACE):
+        """
+        Keyword Arguments:
+            limit {int} -- Number of tasks to run at once (default: {RUNNER_LIMIT})
+            timeout {float} -- Seconds a task may run for. Tasks may run for as
+                               long as they need if not given (default: {None})
+            grace {float} -- Seconds a terminated task is given to exit before
+                             it is killed (default: {TERMINATE_GRACE})
+        """
+        self.limit = max(1, limit)
+        self.timeout = timeout
+        self.grace = grace
+        self._semaphore = None
+
+    def _slots(self):
+        # Made on first use, within the event loop the runner is used from
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    async def run(self, cmd, name: str=None, cwd: str=None, env: dict=None, timeout: float=None,
+                  out=None):
+        """Run a task, streaming each line of its output as it is written
+
+        Arguments:
+            cmd {str,list} -- Task and its arguments
+
+        Keyword Arguments:
+            name {str} -- Prefix of each line of output. The name of the
+                          executable if not given (default: {None})
+            cwd {str} -- Folder to run the task in (default: {None})
+            env {dict} -- Environment of the task (default: {None})
+            timeout {float} -- Seconds the task may run for, in place of that of
+                               the runner (default: {None})
+            out {file} -- Open file to write the output to. The output is
+                          logged if not given (default: {None})
+
+        Raises:
+            CancelledError -- The task was cancelled. Its process has been
+                              stopped by the time this is raised
+
+        Returns:
+            dict -- The `cmd`, its combined `output`, `returncode`, `start`, `wall`
+                    time, and whether it `timed_out`
+        """
+        args = shlex.split(cmd) if isinstance(cmd, str) else list(cmd)
+        cmd = cmd if isinstance(cmd, str) else ' '.join(shlex.quote(a) for a in args)
+        name = name or os.path.basename(args[0])
+        timeout = timeout if timeout is not None else self.timeout
+
+        async with self._slots():
+            start = time.time()
+            # A session of its own, so that the whole task can be stopped
+            proc = await asyncio.create_subprocess_exec(*args, cwd=cwd, env=env,
+                                                        stdin=asyncio.subprocess.DEVNULL,
+                                                        stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.PIPE,
+                                                        start_new_session=True)
+            lines = []
+            streams = asyncio.gather(self._pump(proc, proc.stdout, name, lines, out),
+                                     self._pump(proc, proc.stderr, name, lines, out),
+                                     proc.wait())
+            timed_out = False
+            try:
+                await asyncio.wait_for(streams, timeout)
+            except asyncio.TimeoutError:
+                timed_out = True
+                logger.log(logging.WARNING, f"{name} did not finish within {timeout}s, stopping it")
+                await self._terminate(proc)
+            except asyncio.CancelledError:
+                await self._terminate(proc)
+                raise
+
+        if proc.returncode != 0:
+            logger.log(logging.WARNING, f"{name} exited with code {proc.returncode}")
+
+        return {'cmd': cmd, 'output': ''.join(lines), 'returncode': proc.returncode,
+                'start': start, 'wall': time.time() - start, 'timed_out': timed_out}
+
+    async def _pump(self, proc, stream, name: str, lines: list, out):
+        """Pass on each line of a stream of a task as it arrives. A line longer
+        than the limit of the stream can not be read, and the task is stopped
+        as if it had timed out.
+        """
+        while True:
+            try:
+                line = await stream.readline()
+            # readline raises ValueError for a LimitOverrunError
+            except (ValueError, asyncio.LimitOverrunError) as e:
+                logger.log(logging.WARNING, f"{name} wrote a line that could not be read ({e}), "\
+                                            "stopping it")
+                await self._terminate(proc)
+                break
+            if not line:
+                break
+            text = line.decode(errors='replace')
+            lines.append(text)
+            if out is not None:
+                out.write(f"[{name}] {text}")
+                out.flush()
+            else:
+                logger.log(logging.INFO, f"[{name}] {text.rstrip()}")
+
+    async def _terminate(self, proc):
+        """Stop the process group of a task, killing it if it does not exit in time
+        """
+        for sig in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+            try:
+                await asyncio.wait_for(proc.wait(), self.grace)
+                return
+            except asyncio.TimeoutError:
+                continue
+
+
+class BackgroundLoop:
+    """An event loop running on a thread of its own, for code that is not
+    asynchronous to run coroutines on
+    """
+    def __init__(self, name: str='runner'):
+        """
+        Keyword Arguments:
+            name {str} -- Name of the thread of the loop (default: {'runner'})
+        """
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever, name=name, daemon=True)
+        self._thread.start()
+
+    def submit(self, coro):
+        """Run a coroutine on the loop
+
+        Arguments:
+            coro {coroutine} -- Coroutine to run
+
+        Returns:
+            Future -- A `concurrent.futures.Future` of its result. Cancelling it
+                      cancels the coroutine
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def cancel(self):
+        """Cancel the coroutines running on the loop, and wait until they have
+        stopped, i.e. until the processes of cancelled tasks have exited
+        """
+        async def _cancel():
+            tasks = [t for t in asyncio.all_tasks() if t is not asyncio.current_task()]
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        if self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(_cancel(), self.loop).result()
+
+    def close(self):
+        """Stop the loop once the coroutines still running on it are cancelled
+        """
+        if self.loop.is_closed():
+            return
+        self.cancel()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
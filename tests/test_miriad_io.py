@@ -0,0 +1,99 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import miriad_io as mio
+
+# Variables of the generated dataset, in vartable order
+VARIABLES = [('source', 'a'), ('inttime', 'r'), ('time', 'd'), ('baseline', 'r'),
+             ('pol', 'i'), ('coord', 'd'), ('sfreq', 'd'), ('sdf', 'd'), ('corr', 'r')]
+
+
+def write_uv(path, records, good):
+    """Write a uv dataset laid out the way miriad's uvio writes one. A variable
+    is written, preceded by its size when that changes, only when its value
+    changes, and every entry is padded to UV_ALIGN.
+    """
+    path.mkdir()
+    (path / 'vartable').write_text(''.join(f"{kind} {name}\n" for name, kind in VARIABLES))
+
+    out = bytearray()
+    last, sizes = {}, {}
+
+    def pad(size):
+        out.extend(b'\0' * (mio._roundup(len(out), size) - len(out)))
+
+    for record in records:
+        for number, (name, kind) in enumerate(VARIABLES):
+            value = np.asarray(record[name], dtype=mio.VAR_TYPES[kind]).ravel()
+            data = value.tobytes()
+            if last.get(name) == data:
+                continue
+            if sizes.get(name) != len(data):
+                out.extend(bytes([number, 0, mio.VAR_SIZE, 0]))
+                out.extend(len(data).to_bytes(4, 'big'))
+                sizes[name] = len(data)
+            out.extend(bytes([number, 0, mio.VAR_DATA, 0]))
+            pad(mio.VAR_TYPES[kind].itemsize)
+            out.extend(data)
+            pad(mio.UV_ALIGN)
+            last[name] = data
+        out.extend(bytes([0, 0, mio.VAR_EOR, 0]))
+        pad(mio.UV_ALIGN)
+    (path / 'visdata').write_bytes(bytes(out))
+    mio.write_flags(str(path), good)
+
+
+def _records(nchan=3):
+    rng = np.random.default_rng(1)
+    records = []
+    for i in range(6):
+        # Source names of odd and even length, and a time that changes
+        # every other record
+        records.append({'source': list((b'1934-638', b'a_12.5500')[i // 3]),
+                        'inttime': 10.,
+                        'time': 2457700.5 + (i // 2) / 8640,
+                        'baseline': 256 + 2 + i % 2,
+                        'pol': -5 - i % 2,
+                        'coord': rng.normal(size=3),
+                        'sfreq': 4.476, 'sdf': 0.001,
+                        'corr': rng.normal(size=2 * nchan).astype(np.float32)})
+    return records
+
+
+def test_round_trip(tmp_path):
+    records = _records()
+    good = np.random.default_rng(2).random((len(records), 3)) > 0.3
+    write_uv(tmp_path / 'test.uv', records, good)
+
+    uv = mio.UVData(str(tmp_path / 'test.uv'), track=['source', 'inttime'])
+    assert len(uv) == len(records)
+    assert uv.nchan == 3
+
+    corr = np.array([r['corr'] for r in records])
+    assert np.array_equal(uv.data, corr[:, 0::2] + 1j * corr[:, 1::2])
+    assert np.array_equal(uv.time, [r['time'] for r in records])
+    assert np.array_equal(uv.uvw, [r['coord'] for r in records])
+    assert uv.antennas.tolist() == [[1, 2], [1, 3]] * 3
+    assert uv.pol.tolist() == [-5, -6] * 3
+    assert np.allclose(uv.frequencies(), 4.476 + 0.001 * np.arange(3))
+    assert np.array_equal(uv.variable('inttime')[:, 0], [10.] * 6)
+    assert np.array_equal(uv.flagged, ~good)
+    uv.close()
+
+
+def test_variable_changing_length(tmp_path):
+    write_uv(tmp_path / 'test.uv', _records(), np.ones((6, 3), dtype=bool))
+
+    uv = mio.UVData(str(tmp_path / 'test.uv'), track=['source'])
+    with pytest.raises(ValueError):
+        uv.variable('source')
+    uv.close()
+
+
+def test_flags_round_trip(tmp_path):
+    (tmp_path / 'test.uv').mkdir()
+    good = np.random.default_rng(3).random((7, 40)) > 0.5
+    mio.write_flags(str(tmp_path / 'test.uv'), good)
+
+    assert np.array_equal(mio.read_flags(str(tmp_path / 'test.uv'), 7, 40), good)
@@ -0,0 +1,80 @@
+import os
+
+from conftest import DATA
+import miriad_parsers
+from miriad_parsers import parse, parse_uvfmeas
+
+
+def _read(name):
+    with open(os.path.join(DATA, name), 'r') as infile:
+        return infile.read()
+
+
+def test_every_task_has_a_fixture():
+    for task in miriad_parsers.PARSERS:
+        assert os.path.exists(os.path.join(DATA, f"{task}.txt")), task
+
+
+def test_atlod():
+    record = parse('atlod', _read('atlod.txt'))
+    assert record['sources'] == ['1934-638', '2245-328', 'a_1', 'a_2']
+    assert record['counts'] == {'number of records read': 3024,
+                                'number of records written': 2992}
+    assert record['warnings'] == ['### Warning: Birdie channels flagged']
+
+
+def test_uvsplit():
+    record = parse('uvsplit', _read('uvsplit.txt'))
+    assert record['created'] == ['1934-638.5500', '2245-328.5500', 'a_1.5500', 'a_2.5500',
+                                 'b_1.5500']
+
+
+def test_mfcal():
+    record = parse('mfcal', _read('mfcal.txt'))
+    assert record['intervals'] == 13
+    assert record['iterations'] == 3
+    assert record['converged'] == 1
+    assert record['failed'] == 1
+
+
+def test_gpcal():
+    record = parse('gpcal', _read('gpcal.txt'))
+    assert record['intervals'] == 24
+    assert record['iterations'] == 3
+    assert record['converged'] == 2
+    assert record['failed'] == 0
+    assert record['xyphase'] == [-5.93, 12.33, 0.0, -1.27, 8.41, 21.7]
+
+
+def test_gpboot():
+    assert parse('gpboot', _read('gpboot.txt'))['scale'] == 1.035
+
+
+def test_mfboot():
+    # The lines applying the factor name the datasets, which are not factors
+    assert parse('mfboot', _read('mfboot.txt'))['scale'] == 0.9871
+
+
+def test_uvfmeas():
+    record = parse('uvfmeas', _read('uvfmeas.txt'))
+    assert record['coeffs'] == [-0.301, -0.712, 0.031]
+    assert (record['flux'], record['ref_freq'], record['alpha']) == (0.4601, 5.5, -0.712)
+    # The spectrum is only read from the log
+    assert record['npoints'] == 0
+
+
+def test_uvfmeas_log():
+    record = parse_uvfmeas(_read('uvfmeas.txt'), log=_read('uvfmeas.log'))
+    assert (record['fmin'], record['fmax'], record['npoints']) == (4.5, 6.5, 5)
+
+
+def test_unknown_task():
+    assert parse('invert', 'invert: Revision 1.0') is None
+
+
+def test_failing_parser(monkeypatch):
+    def broken(output):
+        raise TypeError('unexpected output')
+
+    monkeypatch.setitem(miriad_parsers.PARSERS, 'gpcal', broken)
+    assert parse('gpcal', _read('gpcal.txt')) is None
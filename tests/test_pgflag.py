@@ -0,0 +1,34 @@
+import os
+
+from conftest import DATA
+from miriad_parsers import parse
+
+
+def _read(name):
+    with open(os.path.join(DATA, name), 'r') as infile:
+        return infile.read()
+
+
+def test_flag_summary():
+    record = parse('pgflag', _read('pgflag.txt'))
+    assert record['flagged'] == 158720
+    assert abs(record['percent'] - 100 * 158720 / 7028736) < 1e-9
+
+
+def test_nothing_flagged():
+    assert parse('pgflag', _read('pgflag_unchanged.txt'))['flagged'] == 0
+
+
+def test_other_counts_are_not_trusted():
+    # Totals and thresholds that mention flagging are not the summary
+    output = "Flagging threshold 10.0 sigma, 3 iterations\n"\
+             "0 channels flagged by the birdie option\n"\
+             "Total flagged: 258048\n"
+    record = parse('pgflag', output)
+    assert record['flagged'] is None
+    assert record['percent'] is None
+
+
+def test_inconsistent_summary():
+    output = _read('pgflag.txt').replace('158720', '1')
+    assert parse('pgflag', output) is None
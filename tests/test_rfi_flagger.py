@@ -0,0 +1,20 @@
+import pytest
+
+pytest.importorskip('numpy')
+
+import rfi_flagger
+
+
+def test_flagpar_fields():
+    # Channel smoothing 5 wide, time smoothing switched off
+    params = rfi_flagger.parse_flagpar('10,1,0,3,5,3')
+    assert params == {'threshold': 10., 'chan_kernel': 2, 'time_kernel': 0, 'iterations': 3,
+                      'windows': rfi_flagger.WINDOWS}
+
+    params = rfi_flagger.parse_flagpar('15,1,1,3,5,3')
+    assert (params['chan_kernel'], params['time_kernel']) == (2, 1)
+
+
+def test_flagpar_too_short():
+    with pytest.raises(ValueError):
+        rfi_flagger.parse_flagpar('10,1,0')
@@ -0,0 +1,51 @@
+import os
+import struct
+
+import pytest
+
+import rpfits
+from conftest import DATA
+
+
+def _cards():
+    with open(os.path.join(DATA, 'rpfits_header.txt'), 'r') as infile:
+        return [line.rstrip('\n') for line in infile]
+
+
+def test_keywords():
+    header = rpfits.parse_header(_cards())
+    assert header['OBJECT'] == '1934-638'
+    assert header['DATE-OBS'] == '2016-11-08'
+    assert header['NAXIS4'] == 2049
+    assert header['RANDOM'] is True
+    # A slash within a quoted value is not the start of the comment
+    assert header['OBSERVER'] == 'Galvin / Huynh'
+    assert header['CAL'] == ''
+
+
+def test_tables():
+    tables = rpfits.parse_header(_cards())['tables']
+    assert [r['IF_FREQ'] for r in tables['IF']] == [5.5e9, 9.5e9]
+    assert tables['IF'][1]['IF_CHAIN'] == 2
+
+    # Quoted names padded with, or holding, spaces do not shift the columns
+    su = tables['SU']
+    assert [r['SU_NAME'] for r in su] == ['1934-638', 'a_1.5500 field']
+    assert su[0]['SU_DEC'] == pytest.approx(-1.110479066919)
+    assert su[1]['SU_RA'] == pytest.approx(5.90123456789)
+    assert su[0]['SU_CALCODE'] == 'C'
+
+
+def test_scan_file(tmp_path):
+    header = ''.join(c.ljust(rpfits.CARD) for c in _cards()).encode('ascii')
+    header += b' ' * (-len(header) % rpfits.BLOCK)
+    group = struct.pack('>5f', 0., 0., 0., 258., 3600.)
+    path = tmp_path / '2016-11-08_0333.C3132'
+    path.write_bytes(2 * (header + group + b'\0' * (rpfits.BLOCK - len(group))))
+
+    scans = rpfits.scan_file(str(path))
+    assert len(scans) == 2
+    assert scans[0]['sources'] == ['1934-638', 'a_1.5500 field']
+    assert scans[0]['ut'] == 3600.
+    assert scans[0]['duration'] == 0.
+    assert [i['freq'] for i in scans[0]['ifs']] == [5.5e9, 9.5e9]
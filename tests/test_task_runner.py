@@ -0,0 +1,110 @@
+import sys
+import time
+import asyncio
+import logging
+import threading
+
+import pytest
+
+import mir_utils as mu
+from task_runner import AsyncRunner
+from task_graph import TaskGraph
+
+
+def _run(runner, cmd, **kwargs):
+    return asyncio.run(runner.run(cmd, **kwargs))
+
+
+def test_output_and_returncode():
+    result = _run(AsyncRunner(), [sys.executable, '-c', 'print("one"); print("two")'])
+    assert result['output'] == 'one\ntwo\n'
+    assert result['returncode'] == 0
+    assert not result['timed_out']
+
+
+def test_timeout():
+    result = _run(AsyncRunner(grace=1), [sys.executable, '-c', 'import time; time.sleep(30)'],
+                  timeout=0.5)
+    assert result['timed_out']
+    assert result['returncode'] != 0
+    assert result['wall'] < 10
+
+
+def test_overlong_line_stops_the_task():
+    # Longer than the 64 KiB limit of the stream, and then left running
+    code = 'import sys, time; sys.stdout.write("x" * 200000 + "\\n"); sys.stdout.flush(); '\
+           'time.sleep(30)'
+    result = _run(AsyncRunner(grace=1), [sys.executable, '-c', code])
+    assert result['returncode'] != 0
+    assert result['wall'] < 10
+
+
+def _alive(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # An exited child nobody has reaped yet is a zombie
+            return f.read().rsplit(')', 1)[1].split()[0] != 'Z'
+    except FileNotFoundError:
+        return False
+
+
+def test_run_task_timeout():
+    proc = mu.run_task('sleep 30', timeout=0.5)
+    assert proc.record['timed_out']
+    assert proc.returncode != 0
+
+
+def test_run_task_logs_each_line(caplog):
+    with caplog.at_level(logging.INFO):
+        proc = mu.run_task(f"{sys.executable} -c 'print(1); print(2)' vis=a_1.5500")
+    assert proc.output == '1\n2\n'
+    assert [r.getMessage() for r in caplog.records][:2] == \
+           [f"[{sys.executable} a_1.5500] 1", f"[{sys.executable} a_1.5500] 2"]
+
+
+def test_terminate_tasks_stops_the_process_group():
+    # The task starts a child of its own, which has to be stopped with it
+    code = 'import subprocess, time; print(subprocess.Popen(["sleep", "30"]).pid, flush=True); '\
+           'time.sleep(30)'
+    procs = []
+    thread = threading.Thread(target=lambda: procs.append(mu.run_task(
+        f"{sys.executable} -c '{code}'")))
+    thread.start()
+    while len(mu._running_tasks['tasks']) == 0:
+        time.sleep(0.05)
+
+    start = time.time()
+    mu.terminate_tasks(grace=1)
+    thread.join(10)
+    assert not thread.is_alive()
+    assert procs[0].returncode != 0
+    assert time.time() - start < 10
+    # The pipe is closed a moment before the child is marked as exited
+    child = int(procs[0].output)
+    deadline = time.time() + 5
+    while _alive(child) and time.time() < deadline:
+        time.sleep(0.05)
+    assert not _alive(child)
+
+
+def test_graph_failure_stops_running_tasks():
+    graph = TaskGraph(workers=2, on_failure=mu.terminate_tasks)
+    graph.add('slow', mu.mir_run, 'sleep 30')
+    graph.add('fails', mu.mir_run, 'false')
+
+    start = time.time()
+    with pytest.raises(mu.MirTaskError):
+        graph.run()
+    assert time.time() - start < mu.task_runner.TERMINATE_GRACE
+    assert graph.tasks['slow'].state == 'failed'
+
+
+def test_mir_run_raises():
+    with pytest.raises(mu.MirTaskError):
+        mu.mir_run('false')
+    assert mu.mir_run('false', check=False).returncode == 1
+
+
+@pytest.mark.parametrize('workers,graph,plots', [(8, 6, 2), (4, 3, 1), (2, 1, 1), (1, 1, 1)])
+def test_split_workers(workers, graph, plots):
+    assert mu.split_workers(workers) == (graph, plots)